@@ -1 +1,6 @@
+import django
+
 __version__ = "3.1.0"
+
+if django.VERSION < (3, 2):
+    default_app_config = 'select2.apps.Select2Config'
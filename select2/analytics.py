@@ -0,0 +1,110 @@
+"""
+Aggregated statistics of the terms searched with fetch_items.
+
+When enabled (with the ``record_terms`` field option or the
+``SELECT2_RECORD_TERMS`` setting), each fetch_items request adds one hit and
+its latency to the normalized search term of its field. Hits are aggregated
+in memory and merged into the ``SELECT2_CACHE`` cache at most every
+``SELECT2_RECORD_TERMS_INTERVAL`` seconds (60 by default), where only the
+``SELECT2_RECORD_TERMS_MAX`` (1000) most searched terms of each field are
+kept. Merges from different processes are not atomic, so counts are
+approximate.
+
+The ``select2_warm`` management command replays the most searched terms.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+from . import cache
+
+
+#: Hits not yet merged into the cache: {field key: {term: [hits, seconds]}}
+pending = {}
+
+lock = threading.Lock()
+
+last_flush = time.time()
+
+#: The cache key of the list of fields with statistics
+fields_key = 'select2:terms'
+
+
+def is_enabled(field):
+    if getattr(field, 'record_terms', None) is not None:
+        return field.record_terms
+    return getattr(settings, 'SELECT2_RECORD_TERMS', False)
+
+
+def stats_key(field_key):
+    return 'select2:terms:%s' % field_key
+
+
+def record(field_key, term, seconds):
+    """
+    Records a search for ``term`` that took ``seconds`` on the field
+    ``field_key`` ('<app_label>.<model_name>.<field_name>')
+    """
+    global last_flush
+
+    with lock:
+        stats = pending.setdefault(field_key, {}).setdefault(term, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        interval = getattr(settings, 'SELECT2_RECORD_TERMS_INTERVAL', 60)
+        if time.time() - last_flush < interval:
+            return
+        last_flush = time.time()
+    flush()
+
+
+def flush():
+    """Merges the pending hits of this process into the cache"""
+    with lock:
+        flushed = dict(pending)
+        pending.clear()
+    if not flushed:
+        return
+    backend = cache.get_cache()
+    max_terms = getattr(settings, 'SELECT2_RECORD_TERMS_MAX', 1000)
+    for field_key, terms in flushed.items():
+        stored = backend.get(stats_key(field_key)) or {}
+        for term, (hits, seconds) in terms.items():
+            stored_hits, stored_seconds = stored.get(term, (0, 0.0))
+            stored[term] = (stored_hits + hits, stored_seconds + seconds)
+        if len(stored) > max_terms:
+            top = sorted(stored.items(), key=lambda item: -item[1][0])[:max_terms]
+            stored = dict(top)
+        backend.set(stats_key(field_key), stored, None)
+    field_keys = set(backend.get(fields_key) or ())
+    if not field_keys.issuperset(flushed):
+        backend.set(fields_key, sorted(field_keys.union(flushed)), None)
+
+
+def get_field_keys():
+    """Returns the keys of the fields with statistics"""
+    flush()
+    return list(cache.get_cache().get(fields_key) or ())
+
+
+def get_top_terms(field_key, limit=None):
+    """
+    Returns a list of ``(term, hits, average seconds)`` tuples of the most
+    searched terms of a field, most searched first
+    """
+    flush()
+    stored = cache.get_cache().get(stats_key(field_key)) or {}
+    top = sorted(stored.items(), key=lambda item: (-item[1][0], item[0]))
+    if limit is not None:
+        top = top[:limit]
+    return [(term, hits, seconds / hits) for term, (hits, seconds) in top]
+
+
+def clear():
+    backend = cache.get_cache()
+    with lock:
+        pending.clear()
+    for field_key in backend.get(fields_key) or ():
+        backend.delete(stats_key(field_key))
+    backend.delete(fields_key)
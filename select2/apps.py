@@ -0,0 +1,20 @@
+from django.apps import AppConfig, apps
+
+
+class Select2Config(AppConfig):
+
+    name = 'select2'
+
+    def ready(self):
+        from . import cache, registry
+        from .fields import RelatedFieldMixin, compat_rel_to
+
+        cache.connect_signals()
+        registry.populate()
+
+        for model in apps.get_models():
+            for field in model._meta.get_fields():
+                if not isinstance(field, RelatedFieldMixin) or not field.ajax:
+                    continue
+                if cache.is_tracked(field):
+                    cache.track_model(compat_rel_to(field))
@@ -0,0 +1,194 @@
+"""
+Caching of select2 ajax results.
+
+Cached results are invalidated with per-model generation counters rather than
+timeouts: every cache key includes the current generation of the target
+model, and the generation is replaced whenever a row of that model is saved,
+deleted or has its many-to-many relations changed. Stale entries are then
+simply never read again and expire on their own.
+
+For invalidation to be seen by every process the cache configured with
+``SELECT2_CACHE`` must be shared between them (e.g. memcached or redis).
+"""
+import hashlib
+import uuid
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import signals
+
+
+#: Models whose generation is tracked, keyed by concrete model class
+tracked_models = set()
+
+
+def get_cache():
+    return caches[getattr(settings, 'SELECT2_CACHE', 'default')]
+
+
+def get_timeout():
+    return getattr(settings, 'SELECT2_CACHE_TIMEOUT', 3600)
+
+
+def generation_key(model):
+    return 'select2:generation:%s' % model._meta.concrete_model._meta.label_lower
+
+
+def get_generation(model):
+    cache = get_cache()
+    key = generation_key(model)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_generation(model):
+    get_cache().set(generation_key(model), uuid.uuid4().hex, None)
+
+
+def get_replica_lag():
+    return getattr(settings, 'SELECT2_REPLICA_LAG', 0)
+
+
+def written_key(model):
+    return 'select2:written:%s' % model._meta.concrete_model._meta.label_lower
+
+
+def mark_written(model):
+    lag = get_replica_lag()
+    if lag:
+        get_cache().set(written_key(model), True, lag)
+
+
+def recently_written(model):
+    """
+    Whether ``model`` was changed less than SELECT2_REPLICA_LAG seconds ago,
+    so that replicas may not have the change yet
+    """
+    return bool(get_replica_lag()) and get_cache().get(written_key(model)) is not None
+
+
+def make_key(prefix, model, *parts, generation=None):
+    """
+    Returns a cache key for ``parts`` that is only valid for the current
+    generation of ``model`` (or ``generation``, if it was already read).
+    """
+    if generation is None:
+        generation = get_generation(model)
+    digest = hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+    return 'select2:%s:%s:%s' % (prefix, generation, digest)
+
+
+def get_queryset_key(queryset):
+    """
+    Returns a key for the rows of ``queryset``, without evaluating it or
+    the querysets it filters on: its SQL and parameters, and the current
+    generations of the other models whose tables it reads (through joins
+    or subqueries, e.g. from limit_choices_to). Those models are tracked,
+    so that keys that include the key change when they do.
+    """
+    try:
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return None, (), ()
+    quote_name = connections[queryset.db].ops.quote_name
+    target_model = queryset.model._meta.concrete_model
+    generations = []
+    for model in apps.get_models(include_auto_created=True):
+        if model is target_model or quote_name(model._meta.db_table) not in sql:
+            continue
+        track_model(model)
+        generations.append((model._meta.label_lower, get_generation(model)))
+    return sql, tuple(params), tuple(generations)
+
+
+def track_model(model):
+    tracked_models.add(model._meta.concrete_model)
+
+
+def model_changed(sender, **kwargs):
+    opts = sender._meta
+    for model in [opts.concrete_model] + opts.get_parent_list():
+        if model in tracked_models:
+            bump_generation(model)
+            mark_written(model)
+
+
+def m2m_changed(sender, instance, model, action, **kwargs):
+    if not action.startswith('post_'):
+        return
+    for changed_model in (instance.__class__, model):
+        model_changed(changed_model)
+
+
+def connect_signals():
+    signals.post_save.connect(model_changed, dispatch_uid='select2.cache.post_save')
+    signals.post_delete.connect(model_changed, dispatch_uid='select2.cache.post_delete')
+    signals.m2m_changed.connect(m2m_changed, dispatch_uid='select2.cache.m2m_changed')
+
+
+def get_database(field):
+    """
+    The alias of the database that ajax results for ``field`` are read from,
+    or None to let the database routers choose
+    """
+    if getattr(field, 'using', None) is not None:
+        return field.using
+    return getattr(settings, 'SELECT2_DATABASE', None)
+
+
+def is_tracked(field):
+    """Whether the target model of ``field`` needs its changes tracked"""
+    from . import recent
+
+    return any([
+        is_enabled(field), field.search_index, etags_enabled(field), get_database(field),
+        get_replica_lag(), recent.get_size(field), get_browse_pages(field)])
+
+
+def is_enabled(field):
+    """Whether ajax results for the select2 model ``field`` are cached"""
+    if getattr(field, 'cache_results', None) is not None:
+        return field.cache_results
+    return getattr(settings, 'SELECT2_CACHE_RESULTS', False)
+
+
+def subsume_enabled(field):
+    """
+    Whether cached complete results for a term answer searches for the
+    terms that start with it
+    """
+    if not is_enabled(field):
+        return False
+    if getattr(field, 'subsume_results', None) is not None:
+        return field.subsume_results
+    return getattr(settings, 'SELECT2_SUBSUME_RESULTS', False)
+
+
+def get_browse_pages(field):
+    """
+    The number of leading pages of the unsearched results of ``field``
+    that are cached together
+    """
+    if getattr(field, 'browse_pages', None) is not None:
+        return field.browse_pages
+    return getattr(settings, 'SELECT2_BROWSE_PAGES', 0)
+
+
+def etags_enabled(field):
+    """Whether ajax responses for the select2 model ``field`` carry ETags"""
+    if getattr(field, 'etag', None) is not None:
+        return field.etag
+    return getattr(settings, 'SELECT2_ETAGS', False)
+
+
+def get_max_age(field):
+    """The Cache-Control max-age of ajax responses for ``field``, if any"""
+    if getattr(field, 'max_age', None) is not None:
+        return field.max_age
+    return getattr(settings, 'SELECT2_MAX_AGE', None)
@@ -0,0 +1,95 @@
+"""
+JSON encoding of ajax responses.
+
+The encoder is chosen with the ``SELECT2_JSON_ENCODER`` setting:
+
+* ``'auto'`` (the default) uses orjson or msgspec if either is installed,
+  and the standard library otherwise;
+* ``'orjson'``, ``'msgspec'`` or ``'json'`` select one explicitly;
+* any other string is the dotted path of a callable that takes an object
+  and returns its JSON encoding as ``bytes`` or ``str``.
+
+Values the encoders do not support natively (e.g. Decimal or lazy
+translation strings) are encoded as they would be by DjangoJSONEncoder.
+"""
+import json
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+
+
+_encoders = {}
+
+
+def encode_default(obj):
+    return DjangoJSONEncoder().default(obj)
+
+
+def get_orjson_encoder():
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=encode_default)
+    return dumps
+
+
+def get_msgspec_encoder():
+    import msgspec
+
+    encoder = msgspec.json.Encoder(enc_hook=encode_default)
+    return encoder.encode
+
+
+def get_json_encoder():
+    def dumps(obj):
+        return json.dumps(obj, cls=DjangoJSONEncoder).encode('utf-8')
+    return dumps
+
+
+def get_auto_encoder():
+    for get_encoder in (get_orjson_encoder, get_msgspec_encoder):
+        try:
+            return get_encoder()
+        except ImportError:
+            pass
+    return get_json_encoder()
+
+
+builtin_encoders = {
+    'auto': get_auto_encoder,
+    'orjson': get_orjson_encoder,
+    'msgspec': get_msgspec_encoder,
+    'json': get_json_encoder,
+}
+
+
+def get_encoder():
+    """Returns the configured function that encodes an object to JSON bytes"""
+    name = getattr(settings, 'SELECT2_JSON_ENCODER', 'auto')
+    try:
+        return _encoders[name]
+    except KeyError:
+        pass
+    if name in builtin_encoders:
+        try:
+            encoder = builtin_encoders[name]()
+        except ImportError as e:
+            raise ImproperlyConfigured(
+                "SELECT2_JSON_ENCODER is '%s', but it could not be imported: %s" % (name, e))
+    else:
+        func = import_string(name)
+
+        def encoder(obj):
+            content = func(obj)
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            return content
+    _encoders[name] = encoder
+    return encoder
+
+
+def dumps(obj):
+    """Returns the JSON encoding of ``obj``, as bytes"""
+    return get_encoder()(obj)
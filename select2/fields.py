@@ -1,7 +1,9 @@
 import django
 from django import forms
+from django.conf import settings
 from django.db import models
-from django.core.exceptions import ImproperlyConfigured, ValidationError, FieldDoesNotExist
+from django.core.exceptions import (
+    EmptyResultSet, FieldDoesNotExist, ImproperlyConfigured, ValidationError)
 from django.forms.models import ModelChoiceIterator
 from django.utils.encoding import force_str
 from django.utils.functional import Promise
@@ -16,6 +18,7 @@ else:
 from sortedm2m.fields import SortedManyToManyField
 from sortedm2m.forms import SortedMultipleChoiceField
 
+from .search import ContainsSearch, RankedSearch
 from .widgets import Select, SelectMultiple
 
 
@@ -111,18 +114,67 @@ class MultipleChoiceField(Select2FieldMixin, forms.MultipleChoiceField):
         return super(MultipleChoiceField, self).has_changed(initial, data)
 
 
+class InitialSelections(object):
+    """
+    Looks up the labels of the selected values of all the ajax fields of a
+    form, so that they can be rendered inline with the widgets rather than
+    fetched with an init_selection request once the page has loaded.
+
+    The lookup happens when the first widget is rendered, and fields that
+    share a target model and queryset are looked up with a single query.
+    """
+
+    def __init__(self, form):
+        self.form = form
+        self.selections = None
+
+    def get(self, field_name):
+        if self.selections is None:
+            self.selections = self.lookup()
+        return self.selections.get(field_name)
+
+    def lookup(self):
+        groups = {}
+        for name, field in self.form.fields.items():
+            if not isinstance(field, Select2ModelFieldMixin) or not field.select2_widget.ajax:
+                continue
+            pks = field.get_selected_pks(self.form[name].value())
+            if not pks:
+                continue
+            try:
+                sql = str(field.queryset.query)
+            except EmptyResultSet:
+                continue
+            group_key = (
+                field.queryset.model, field.to_field_name, sql,
+                field.get_model_field().get_label_key())
+            groups.setdefault(group_key, []).append((name, field, pks))
+
+        selections = {}
+        for members in groups.values():
+            group_pks = set()
+            for name, field, pks in members:
+                group_pks.update(pks)
+            choices = list(members[0][1].iter_selection_choices(list(group_pks)))
+            for name, field, pks in members:
+                selections[name] = field.get_selection_data(choices)
+        return selections
+
+
 class Select2ModelFieldMixin(Select2FieldMixin):
 
     search_field = None
+    search_backend = None
     case_sensitive = False
 
     choice_iterator_cls = ModelChoiceIterator
 
     def __init__(self, search_field=None, case_sensitive=False, *args, **kwargs):
-        if search_field is None and kwargs.get('ajax'):
+        self.search_backend = kwargs.pop('search_backend', None)
+        if search_field is None and self.search_backend is None and kwargs.get('ajax'):
             raise TypeError(
                 ("keyword argument 'search_field' is required for field "
-                 "%s <%s>") % (self.name, self.__class__.__name__))
+                 "%s <%s>") % (kwargs.get('name'), self.__class__.__name__))
         self.search_field = search_field
         self.case_sensitive = case_sensitive
         self.name = kwargs.pop('name')
@@ -136,6 +188,99 @@ class Select2ModelFieldMixin(Select2FieldMixin):
             return self.choice_iterator_cls(self)
         return self._choices
 
+    @property
+    def select2_widget(self):
+        """
+        The select2 widget of the field, which the admin wraps in a
+        RelatedFieldWidgetWrapper
+        """
+        widget = self.widget
+        while not isinstance(widget, Select) and hasattr(widget, 'widget'):
+            widget = widget.widget
+        return widget
+
+    def get_bound_field(self, form, field_name):
+        widget = self.select2_widget
+        if widget.ajax:
+            # Share a single InitialSelections between all widgets of the form
+            initial_selections = getattr(form, '_select2_initial_selections', None)
+            if initial_selections is None:
+                initial_selections = form._select2_initial_selections = InitialSelections(form)
+            widget.initial_selections = initial_selections
+            widget.selection_field_name = field_name
+        return super(Select2ModelFieldMixin, self).get_bound_field(form, field_name)
+
+    def get_selected_pks(self, value):
+        """Returns the list of valid primary keys in a widget ``value``"""
+        if value is None:
+            return []
+        if isinstance(value, str):
+            value = value.split(',')
+        elif not isinstance(value, (list, tuple)):
+            value = [value]
+        opts = self.queryset.model._meta
+        key_field = opts.get_field(self.to_field_name) if self.to_field_name else opts.pk
+        pks = []
+        for pk in value:
+            if pk is None or pk == '':
+                continue
+            try:
+                pks.append(key_field.to_python(pk))
+            except ValidationError:
+                continue
+        return pks
+
+    def get_selection_queryset(self, pks):
+        return self.queryset.filter(**{
+            '%s__in' % (self.to_field_name or 'pk'): pks,
+        })
+
+    def get_model_field(self):
+        """The select2 model field this form field was created from"""
+        return self.model._meta.get_field(self.name)
+
+    def iter_selection_choices(self, pks):
+        """
+        Yields the ``(value, label, extra_values)`` choices of the ``pks``
+        that exist, labelled by the model field like the ajax views do
+        """
+        return self.get_model_field().iter_choices(self.get_selection_queryset(pks))
+
+    def get_selection_data(self, choices):
+        """
+        Returns a dict of the select2 data for ``choices``, keyed on the
+        string value of each choice
+        """
+        data = {}
+        for value, label, extra_values in choices:
+            data[force_str(value)] = {
+                'id': value,
+                'text': label,
+            }
+        return data
+
+    def get_initial_selection(self, value, initial_selections=None, field_name=None):
+        """
+        Returns the select2 data for the selected ``value``: a list for
+        widgets that allow multiple selections, else a single dict. Returns
+        None if not every selected value could be found.
+        """
+        pks = self.get_selected_pks(value)
+        if not pks:
+            return None
+        selection_data = None
+        if initial_selections is not None:
+            selection_data = initial_selections.get(field_name)
+        if selection_data is None:
+            selection_data = self.get_selection_data(self.iter_selection_choices(pks))
+        try:
+            results = [selection_data[force_str(pk)] for pk in pks]
+        except KeyError:
+            return None
+        if not self.select2_widget.allow_multiple_selected:
+            return results[0]
+        return results
+
     @choices.setter
     def choices(self, value):
         super(self.__class__, self.__class__).choices.__set__(self, value)
@@ -220,13 +365,139 @@ class RelatedFieldMixin(object):
     overlay = None
     case_sensitive = False
     ajax = False
+    #: How fetch_items pages through results: 'offset' (the default), which
+    #: uses the ``page`` parameter, or 'keyset', which additionally returns an
+    #: opaque ``next`` token that seeks past the last row of the previous page.
+    pagination = 'offset'
+    #: How fetch_items computes the ``total`` of its results: 'exact' runs a
+    #: COUNT query, 'estimate' asks the query planner for an estimate and
+    #: 'none' leaves the total out. Defaults to settings.SELECT2_COUNT_MODE,
+    #: or 'exact' if that is not set.
+    count_mode = None
+    #: Whether the COUNT query of fetch_items runs on a worker thread while
+    #: the page of results is read (see select2.workers). Defaults to
+    #: settings.SELECT2_CONCURRENT_COUNT, or False if that is not set.
+    concurrent_count = None
+    #: Whether fetch_items results are cached (see select2.cache). Defaults
+    #: to settings.SELECT2_CACHE_RESULTS, or False if that is not set.
+    cache_results = None
+    #: Whether fetch_items answers a search from the cached results of a
+    #: shorter term it starts with, when those were complete (see
+    #: Select2View.get_subsumed_data). Requires ``cache_results``. Defaults to
+    #: settings.SELECT2_SUBSUME_RESULTS, or False if that is not set.
+    subsume_results = None
+    #: The number of leading pages of the results of the empty term, which
+    #: opening a dropdown requests, that are fetched together with a single
+    #: query and cached until the target model changes, whether or not
+    #: ``cache_results`` is set. Defaults to settings.SELECT2_BROWSE_PAGES,
+    #: or 0 (none) if that is not set.
+    browse_pages = None
+    #: How identical concurrent fetch_items requests for cached results are
+    #: coalesced (see select2.singleflight): 'process' (the default) within
+    #: each process, 'cache' across processes with a lease in the cache, or
+    #: 'none'. Defaults to settings.SELECT2_COALESCE.
+    coalesce = None
+    #: A select2.search.SearchBackend that filters fetch_items results on the
+    #: search term. Defaults to a ContainsSearch on ``search_field``.
+    search_backend = None
+    #: Names of fields of the target model to search with a RankedSearch,
+    #: in place of ``search_field``
+    search_fields = None
+    #: Whether fetch_items answers from an in-memory index of the queryset
+    #: rather than the database (see select2.index)
+    search_index = False
+    #: Names of the fields of the target model that make up the label of a
+    #: choice. If set, ajax results are fetched with values_list() rather
+    #: than by instantiating models and calling __str__.
+    label_fields = None
+    #: A format string for the values of ``label_fields``, which are passed
+    #: as both positional and keyword arguments. By default the non-empty
+    #: values are joined with spaces.
+    label_format = None
+    #: A query expression (e.g. Concat) that computes the label in the
+    #: database, in place of ``label_fields``
+    label_expression = None
+    #: select_related() and only() arguments for the ajax querysets, for
+    #: fields that still need model instances to compute their labels
+    select_related = None
+    only = None
+    #: The label_from_instance() of the form field, as a 1-tuple once
+    #: resolved by get_label_from_instance()
+    _label_from_instance = None
+    #: Whether ajax responses carry an ETag built from the generation of
+    #: the target model (see select2.cache), so that clients can revalidate
+    #: them. Defaults to the SELECT2_ETAGS setting.
+    etag = None
+    #: The Cache-Control max-age of ajax responses, in seconds. Defaults to
+    #: the SELECT2_MAX_AGE setting.
+    max_age = None
+    #: Whether fetch_items responses are streamed, encoding each result as
+    #: it is read from the database. Defaults to the SELECT2_STREAMING
+    #: setting.
+    streaming = None
+    #: The minimum length of the fetch_items search term. Defaults to the
+    #: SELECT2_MIN_SEARCH_LENGTH setting.
+    min_search_length = None
+    #: The maximum fetch_items page_limit. Defaults to the
+    #: SELECT2_MAX_PAGE_LIMIT setting.
+    max_page_limit = None
+    #: The rate at which each client may request results, e.g. '30/m' (see
+    #: select2.ratelimit). Defaults to the SELECT2_RATE_LIMIT setting.
+    rate_limit = None
+    #: The alias of the database that ajax results are read from, e.g. a
+    #: read replica. Defaults to the SELECT2_DATABASE setting, and otherwise
+    #: to the database chosen by the routers.
+    using = None
+    #: Whether the terms searched with fetch_items are recorded (see
+    #: select2.analytics). Defaults to the SELECT2_RECORD_TERMS setting.
+    record_terms = None
+    #: The number of choices each user made most often and most recently
+    #: that are remembered and offered before anything is typed (see
+    #: select2.recent). Defaults to the SELECT2_RECENT_CHOICES setting, or
+    #: 0 (none) if that is not set.
+    recent_choices = None
 
     def __init__(self, *args, **kwargs):
         self.search_field = kwargs.pop('search_field', None)
+        self.search_backend = kwargs.pop('search_backend', None)
+        if isinstance(self.search_backend, type):
+            self.search_backend = self.search_backend()
+        self.search_fields = kwargs.pop('search_fields', self.search_fields)
+        if self.search_fields and self.search_backend is None:
+            self.search_backend = RankedSearch(list(self.search_fields))
         self.js_options = kwargs.pop('js_options', None)
         self.overlay = kwargs.pop('overlay', self.overlay)
         self.case_sensitive = kwargs.pop('case_sensitive', self.case_sensitive)
         self.ajax = kwargs.pop('ajax', self.ajax)
+        self.pagination = kwargs.pop('pagination', self.pagination)
+        if self.pagination not in ('offset', 'keyset'):
+            raise TypeError(
+                "keyword argument 'pagination' must be either 'offset' or 'keyset'")
+        self.count_mode = kwargs.pop('count_mode', self.count_mode)
+        if self.count_mode not in (None, 'exact', 'estimate', 'none'):
+            raise TypeError(
+                "keyword argument 'count_mode' must be one of 'exact', "
+                "'estimate' or 'none'")
+        self.concurrent_count = kwargs.pop('concurrent_count', self.concurrent_count)
+        self.cache_results = kwargs.pop('cache_results', self.cache_results)
+        self.subsume_results = kwargs.pop('subsume_results', self.subsume_results)
+        self.browse_pages = kwargs.pop('browse_pages', self.browse_pages)
+        self.coalesce = kwargs.pop('coalesce', self.coalesce)
+        self.search_index = kwargs.pop('search_index', self.search_index)
+        self.label_fields = kwargs.pop('label_fields', self.label_fields)
+        self.label_format = kwargs.pop('label_format', self.label_format)
+        self.label_expression = kwargs.pop('label_expression', self.label_expression)
+        self.select_related = kwargs.pop('select_related', self.select_related)
+        self.only = kwargs.pop('only', self.only)
+        self.etag = kwargs.pop('etag', self.etag)
+        self.max_age = kwargs.pop('max_age', self.max_age)
+        self.streaming = kwargs.pop('streaming', self.streaming)
+        self.min_search_length = kwargs.pop('min_search_length', self.min_search_length)
+        self.max_page_limit = kwargs.pop('max_page_limit', self.max_page_limit)
+        self.rate_limit = kwargs.pop('rate_limit', self.rate_limit)
+        self.using = kwargs.pop('using', self.using)
+        self.record_terms = kwargs.pop('record_terms', self.record_terms)
+        self.recent_choices = kwargs.pop('recent_choices', self.recent_choices)
         super(RelatedFieldMixin, self).__init__(*args, **kwargs)
 
     def _get_queryset(self, db=None):
@@ -237,13 +508,126 @@ class RelatedFieldMixin(object):
     def queryset(self):
         return self._get_queryset()
 
+    def get_search_backend(self):
+        return self.search_backend or ContainsSearch()
+
+    def format_label(self, values):
+        if self.label_format is not None:
+            return self.label_format.format(*values, **dict(zip(self.label_fields or (), values)))
+        return u' '.join([force_str(v) for v in values if v is not None and v != ''])
+
+    def get_label_rows(self, queryset, extra_fields):
+        """
+        Returns the values_list() queryset of the choice values, label
+        columns and ``extra_fields`` of ``queryset``, or None if the field is
+        labelled with ``__str__``
+        """
+        if not self.label_fields and self.label_expression is None:
+            return None
+        if self.label_expression is not None:
+            queryset = queryset.annotate(select2_label=self.label_expression)
+            label_fields = ['select2_label']
+        else:
+            label_fields = list(self.label_fields)
+        value_field = compat_rel(self).get_related_field().attname
+        return queryset.values_list(*([value_field] + label_fields + list(extra_fields)))
+
+    def get_row_choice(self, row):
+        if self.label_expression is not None:
+            return row[0], force_str(row[1]), row[2:]
+        num_labels = len(self.label_fields)
+        return row[0], self.format_label(row[1:1 + num_labels]), row[1 + num_labels:]
+
+    def get_label_from_instance(self):
+        """
+        Returns the ``label_from_instance`` of the form field created by
+        formfield() if its class overrides ModelChoiceField's, else None.
+        The form field is only constructed the first time (the registry
+        resolves it when a field is registered, see select2.registry).
+        """
+        if self._label_from_instance is None:
+            label_from_instance = getattr(self.formfield(), 'label_from_instance', None)
+            default = forms.ModelChoiceField.label_from_instance
+            if getattr(label_from_instance, '__func__', None) is default:
+                label_from_instance = None
+            self._label_from_instance = (label_from_instance,)
+        return self._label_from_instance[0]
+
+    def get_label_key(self):
+        """
+        Returns a key that is equal for fields whose choices are labelled,
+        and fetched, the same way
+        """
+        return (
+            tuple(self.label_fields or ()), self.label_format, repr(self.label_expression),
+            tuple(self.select_related or ()), tuple(self.only or ()))
+
+    def iter_choices(self, queryset, extra_fields=(), iterator=False):
+        """
+        Yields a ``(value, label, extra_values)`` tuple for each row of
+        ``queryset``, where ``extra_values`` are the values of the
+        ``extra_fields`` attnames of the row. If ``iterator`` is True, rows
+        are read with QuerySet.iterator().
+        """
+        rows = self.get_label_rows(queryset, extra_fields)
+        if rows is not None:
+            for row in (rows.iterator() if iterator else rows):
+                yield self.get_row_choice(row)
+            return
+
+        extra_fields = list(extra_fields)
+        value_field = compat_rel(self).get_related_field().attname
+        label_from_instance = self.get_label_from_instance() or force_str
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.only:
+            queryset = queryset.only(*(list(self.only) + [value_field] + extra_fields))
+        # The same values as ModelChoiceField.prepare_value() and
+        # label_from_instance(), without constructing a form field per call
+        for obj in (queryset.iterator() if iterator else queryset):
+            yield (
+                getattr(obj, value_field),
+                force_str(label_from_instance(obj)),
+                [getattr(obj, name) for name in extra_fields])
+
+    async def aiter_choices(self, queryset, extra_fields=()):
+        """
+        The async version of iter_choices(). Rows are fetched with the async
+        ORM when labels come from ``label_fields`` or ``label_expression``;
+        otherwise, since ``__str__`` may query related objects, the choices
+        are computed in a thread.
+        """
+        from asgiref.sync import sync_to_async
+
+        rows = self.get_label_rows(queryset, extra_fields)
+        if rows is not None:
+            async for row in rows:
+                yield self.get_row_choice(row)
+            return
+        choices = await sync_to_async(
+            lambda: list(self.iter_choices(queryset, extra_fields)))()
+        for choice in choices:
+            yield choice
+
+    def get_js_options(self):
+        js_options = self.js_options
+        min_search_length = self.min_search_length
+        if min_search_length is None:
+            min_search_length = getattr(settings, 'SELECT2_MIN_SEARCH_LENGTH', 0)
+        if self.ajax and min_search_length:
+            # Don't let the widget send searches the server would reject
+            js_options = dict(js_options or {})
+            js_options.setdefault('minimum_input_length', min_search_length)
+        return js_options
+
     def formfield(self, **kwargs):
         db = kwargs.pop('using', None)
         defaults = {
             'form_class': ModelChoiceField,
             'queryset': self._get_queryset(db),
-            'js_options': self.js_options,
+            'js_options': self.get_js_options(),
             'search_field': self.search_field,
+            'search_backend': self.search_backend,
             'ajax': self.ajax,
             'name': self.name,
             'model': self.model,
@@ -264,14 +648,15 @@ class RelatedFieldMixin(object):
     def contribute_to_related_class(self, cls, related):
         if not self.ajax:
             return super(RelatedFieldMixin, self).contribute_to_related_class(cls, related)
-        if self.search_field is None:
+        if self.search_field is None and self.search_backend is None:
             raise TypeError(
                 ("keyword argument 'search_field' is required for field "
                  "'%(field_name)s' of model %(app_label)s.%(object_name)s") % {
                     'field_name': self.name,
                     'app_label': self.model._meta.app_label,
                     'object_name': self.model._meta.object_name})
-        if not callable(self.search_field) and not isinstance(self.search_field, str):
+        valid_search_field = callable(self.search_field) or isinstance(self.search_field, str)
+        if self.search_backend is None and not valid_search_field:
             raise TypeError(
                 ("keyword argument 'search_field' must be either callable or "
                  "string on field '%(field_name)s' of model "
@@ -279,20 +664,25 @@ class RelatedFieldMixin(object):
                     'field_name': self.name,
                     'app_label': self.model._meta.app_label,
                     'object_name': self.model._meta.object_name})
+        search_fields = [('search_fields', name) for name in self.search_fields or ()]
         if isinstance(self.search_field, str):
+            search_fields.insert(0, ('search_field', self.search_field))
+        if search_fields:
             try:
                 opts = related.parent_model._meta
             except AttributeError:
                 # Django 1.8
                 opts = related.model._meta
+        for kwarg, search_field in search_fields:
             try:
-                opts.get_field(self.search_field)
+                opts.get_field(search_field)
             except FieldDoesNotExist:
                 raise ImproperlyConfigured(
-                    ("keyword argument 'search_field' references non-existent "
+                    ("keyword argument '%(kwarg)s' references non-existent "
                      "field '%(search_field)s' in %(field_name)s of model "
                      "<%(app_label)s.%(object_name)s>") % {
-                        'search_field': self.search_field,
+                        'kwarg': kwarg,
+                        'search_field': search_field,
                         'field_name': self.name,
                         'app_label': opts.app_label,
                         'object_name': opts.object_name})
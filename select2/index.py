@@ -0,0 +1,215 @@
+"""
+In-memory search indexes for ajax fields.
+
+For target tables of up to a few hundred thousand rows, fields declared with
+``search_index=True`` answer fetch_items from an index held in the memory of
+each process instead of querying the database. The index holds the id, label
+and case-folded search value of every row of the field's queryset, in
+queryset order, along with:
+
+* a sorted array of the search values, for bisect lookups of prefixes
+  (fields using select2.search.PrefixSearch), and
+* a map of the n-grams of each search value to the rows containing them,
+  for substring lookups (fields using the default ContainsSearch).
+
+Indexes are built the first time they are used. Once the generation of the
+target model (see select2.cache) changes, the next use starts a rebuild on a
+background thread, and searches are answered from the previous index until
+it finishes. Indexes are only rebuilt in the request thread inside a
+transaction, whose changes other connections can not see.
+"""
+import bisect
+import sys
+import threading
+import time
+from array import array
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.utils.encoding import force_str
+
+from . import cache, workers
+from .search import ContainsSearch, PrefixSearch
+
+
+#: Built indexes, keyed on (app label, model name, field name)
+indexes = {}
+
+#: Locks held while an index is built, keyed like ``indexes``
+locks = {}
+
+#: The keys of the indexes being rebuilt on background threads
+rebuilding = set()
+
+lock = threading.Lock()
+
+
+class SearchIndex(object):
+
+    ngram_size = 3
+
+    def __init__(self, field, queryset, generation=None):
+        backend = field.get_search_backend()
+        if type(backend) not in (ContainsSearch, PrefixSearch):
+            raise ImproperlyConfigured(
+                "search_index=True on field '%s' requires a ContainsSearch or "
+                "PrefixSearch search backend" % field.name)
+        search_field = backend.get_search_field(field)
+        if not isinstance(search_field, str):
+            raise ImproperlyConfigured(
+                "search_index=True on field '%s' requires search_field to be "
+                "the name of a field" % field.name)
+
+        self.prefix = isinstance(backend, PrefixSearch)
+        self.case_sensitive = backend.get_case_sensitive(field)
+        self.generation = generation
+
+        start = time.time()
+        self.build(field, queryset, search_field)
+        self.build_seconds = time.time() - start
+        self.memory_bytes = self.get_memory_bytes()
+
+    def build(self, field, queryset, search_field):
+        search_attname = queryset.model._meta.get_field(search_field).attname
+
+        self.ids = []
+        self.labels = []
+        self.keys = []
+        for value, label, (search_value,) in field.iter_choices(queryset, [search_attname]):
+            self.ids.append(value)
+            self.labels.append(label)
+            if search_value is None:
+                search_value = ''
+            self.keys.append(self.normalize(force_str(search_value)))
+
+        order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        self.sorted_keys = [self.keys[i] for i in order]
+        self.sorted_positions = array('I', order)
+
+        ngrams = {}
+        for position, key in enumerate(self.keys):
+            for gram in set(self.get_ngrams(key)):
+                ngrams.setdefault(gram, []).append(position)
+        self.ngrams = dict([(gram, array('I', positions)) for gram, positions in ngrams.items()])
+
+    def get_ngrams(self, key):
+        n = self.ngram_size
+        return [key[i:i + n] for i in range(len(key) - n + 1)]
+
+    def normalize(self, value):
+        return value if self.case_sensitive else value.casefold()
+
+    def get_memory_bytes(self):
+        """An estimate of the memory used by the index"""
+        size = sum([sys.getsizeof(v) for v in (
+            self.ids, self.labels, self.keys, self.sorted_keys,
+            self.sorted_positions, self.ngrams)])
+        size += sum([sys.getsizeof(v) for v in self.ids])
+        size += sum([sys.getsizeof(v) for v in self.labels])
+        size += sum([sys.getsizeof(v) for v in self.keys])
+        size += sum([sys.getsizeof(k) + sys.getsizeof(v) for k, v in self.ngrams.items()])
+        return size
+
+    def search(self, q):
+        """
+        Returns the positions of the rows matching the search term ``q``, in
+        queryset order
+        """
+        q = self.normalize(q)
+        if not q:
+            return range(len(self.keys))
+        if self.prefix:
+            positions = []
+            i = bisect.bisect_left(self.sorted_keys, q)
+            while i < len(self.sorted_keys) and self.sorted_keys[i].startswith(q):
+                positions.append(self.sorted_positions[i])
+                i += 1
+            return sorted(positions)
+        if len(q) < self.ngram_size:
+            return [i for i, key in enumerate(self.keys) if q in key]
+        candidates = min(
+            [self.ngrams.get(gram, ()) for gram in self.get_ngrams(q)], key=len)
+        return [i for i in candidates if q in self.keys[i]]
+
+    def get_data(self, q, page, page_limit):
+        positions = self.search(q)
+        offset = (page - 1) * page_limit
+        return {
+            'total': len(positions),
+            'more': len(positions) > offset + page_limit,
+            'results': [
+                {'id': self.ids[i], 'text': self.labels[i]}
+                for i in positions[offset:offset + page_limit]],
+        }
+
+    def get_stats(self):
+        return {
+            'entries': len(self.keys),
+            'memory_bytes': self.memory_bytes,
+            'build_seconds': self.build_seconds,
+        }
+
+
+def get_index_key(field):
+    opts = field.model._meta
+    return (opts.app_label, opts.model_name, field.name)
+
+
+def get_lock(key):
+    with lock:
+        return locks.setdefault(key, threading.Lock())
+
+
+def build(field, get_queryset, key, generation):
+    """Builds the index of ``field`` for ``generation``, unless it is built"""
+    with get_lock(key):
+        index = indexes.get(key)
+        if index is None or index.generation != generation:
+            index = indexes[key] = SearchIndex(field, get_queryset(), generation)
+    return index
+
+
+def rebuild(field, get_queryset, key, generation):
+    """Rebuilds an index on a background thread"""
+    try:
+        build(field, get_queryset, key, generation)
+    finally:
+        with lock:
+            rebuilding.discard(key)
+        # The thread's own connections
+        connections.close_all()
+
+
+def get_index(field, get_queryset):
+    """
+    Returns the SearchIndex of ``field``, building it from the queryset
+    returned by ``get_queryset`` if needed. An index that is out of date is
+    returned while it is rebuilt in the background.
+    """
+    from .fields import compat_rel_to
+
+    target_model = compat_rel_to(field)
+    cache.track_model(target_model)
+    key = get_index_key(field)
+    generation = cache.get_generation(target_model)
+    index = indexes.get(key)
+    if index is not None and index.generation == generation:
+        return index
+    if index is not None and workers.can_submit(get_queryset().db):
+        with lock:
+            started = key in rebuilding
+            rebuilding.add(key)
+        if not started:
+            threading.Thread(
+                target=rebuild, args=(field, get_queryset, key, generation),
+                name='select2-index', daemon=True).start()
+        return index
+    return build(field, get_queryset, key, generation)
+
+
+def get_stats():
+    """
+    Returns the number of entries, estimated memory use and build time of
+    each built index, keyed on '<app_label>.<model_name>.<field_name>'
+    """
+    return dict([('.'.join(key), index.get_stats()) for key, index in list(indexes.items())])
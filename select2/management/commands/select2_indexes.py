@@ -0,0 +1,86 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, migrations
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.writer import MigrationWriter
+
+from select2 import registry
+from select2.fields import compat_rel_to
+
+
+class Command(BaseCommand):
+    help = (
+        "Prints the SQL that creates the database indexes serving the searches "
+        "of every ajax select2 field, or a migration that runs it.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--database', default=DEFAULT_DB_ALIAS,
+            help="The database to create indexes for (default: '%s')" % DEFAULT_DB_ALIAS)
+        parser.add_argument(
+            '--migration', metavar='APP_LABEL',
+            help="Prints a migration of the app APP_LABEL that creates the indexes")
+
+    def get_indexes(self, connection):
+        """
+        Returns a list of ``(field, target model, search backend, indexes)``
+        tuples for every ajax select2 field
+        """
+        fields = []
+        for model, field in registry.iter_fields():
+            target_model = compat_rel_to(field)
+            backend = field.get_search_backend()
+            fields.append((
+                field, target_model, backend,
+                backend.get_indexes(target_model, connection, field)))
+        return fields
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        fields = self.get_indexes(connection)
+        if options['migration']:
+            self.stdout.write(self.get_migration(options['migration'], fields), ending='')
+            return
+
+        seen = set()
+        for field, target_model, backend, indexes in fields:
+            self.stdout.write('-- %s: %s on %s' % (
+                field, backend.__class__.__name__, target_model._meta.label))
+            if not indexes:
+                self.stdout.write('-- No index can serve this search on %s' % connection.vendor)
+            for name, sql, reverse_sql in indexes:
+                if name in seen:
+                    self.stdout.write('-- %s is created above' % name)
+                    continue
+                seen.add(name)
+                for statement in sql:
+                    # Such as CREATE EXTENSION, shared by several indexes
+                    if statement not in seen:
+                        seen.add(statement)
+                        self.stdout.write('%s;' % statement)
+            self.stdout.write('')
+
+    def get_migration(self, app_label, fields):
+        try:
+            apps.get_app_config(app_label)
+        except LookupError as e:
+            raise CommandError(str(e))
+        loader = MigrationLoader(None, ignore_no_migrations=True)
+        dependencies = set()
+        operations = []
+        seen = set()
+        for field, target_model, backend, indexes in fields:
+            for name, sql, reverse_sql in indexes:
+                if name in seen:
+                    continue
+                seen.add(name)
+                operations.append(migrations.RunSQL(sql, reverse_sql))
+                dependencies.add(target_model._meta.app_label)
+        dependencies.add(app_label)
+
+        migration = migrations.Migration('select2_indexes', app_label)
+        migration.dependencies = sorted([
+            node for label in dependencies if label in loader.migrated_apps
+            for node in loader.graph.leaf_nodes(label)])
+        migration.operations = operations
+        return MigrationWriter(migration).as_string()
@@ -0,0 +1,57 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+
+from select2 import analytics
+from select2.views import InvalidParameter, Select2View
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the most searched fetch_items terms recorded by select2.analytics, "
+        "so that their results are in the result cache and the search index of "
+        "their fields.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--top', type=int, default=20,
+            help="The number of terms run per field (default: 20)")
+        parser.add_argument(
+            '--field', action='append', dest='fields', metavar='APP_LABEL.MODEL.FIELD',
+            help="A field to warm; may be repeated. Defaults to every field with statistics.")
+        parser.add_argument(
+            '--page-limit', type=int, default=10,
+            help="The page_limit of the warmed results (default: 10)")
+        parser.add_argument(
+            '--list', action='store_true',
+            help="Lists the most searched terms instead of running them")
+
+    def handle(self, *args, **options):
+        field_keys = options['fields'] or analytics.get_field_keys()
+        for field_key in field_keys:
+            try:
+                app_label, model_name, field_name = field_key.split('.')
+            except ValueError:
+                raise CommandError(
+                    "Invalid field '%s', expected app_label.model.field" % field_key)
+            model_name = model_name.lower()
+            field_key = '%s.%s.%s' % (app_label, model_name, field_name)
+            terms = analytics.get_top_terms(field_key, options['top'])
+            if options['list']:
+                self.stdout.write('%s:' % field_key)
+                for term, hits, seconds in terms:
+                    self.stdout.write('  %r: %d hits, %.1f ms' % (term, hits, seconds * 1000))
+                continue
+            warmed = 0
+            for term, hits, seconds in terms:
+                view = Select2View(None, app_label, model_name, field_name)
+                try:
+                    data = view.get_items(term, 1, options['page_limit'])
+                except (LookupError, FieldDoesNotExist) as e:
+                    raise CommandError("Invalid field '%s': %s" % (field_key, e))
+                except InvalidParameter:
+                    continue
+                if not isinstance(data, dict):
+                    # Streamed responses are only encoded when consumed
+                    list(data)
+                warmed += 1
+            self.stdout.write('%s: warmed %d of %d terms' % (field_key, warmed, len(terms)))
@@ -0,0 +1,50 @@
+"""
+Token bucket rate limiting of the ajax views, per client.
+
+A rate such as ``'30/m'`` allows bursts of up to 30 requests, refilled at 30
+requests per minute. Buckets are stored in the cache configured with
+``SELECT2_CACHE``, which must be shared between processes for the limit to
+apply across them. Updates of a bucket are not atomic, so concurrent
+requests from the same client may occasionally exceed the limit slightly.
+"""
+import re
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+
+from . import cache
+
+
+re_rate = re.compile(r'^\s*(\d+)\s*/\s*(\d*)\s*([smhd])\w*\s*$')
+
+periods = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def parse_rate(rate):
+    """
+    Returns the ``(requests, seconds)`` of a rate such as ``'30/m'`` or
+    ``'100/5m'``
+    """
+    match = re_rate.match(rate)
+    if match is None:
+        raise ImproperlyConfigured("Invalid select2 rate limit '%s'" % rate)
+    requests, multiplier, period = match.groups()
+    return int(requests), int(multiplier or 1) * periods[period]
+
+
+def acquire(key, rate):
+    """
+    Takes a token from the bucket ``key``, refilled at ``rate``. Returns 0
+    if a token was available, else the number of seconds until one is.
+    """
+    capacity, period = parse_rate(rate)
+    cache_key = 'select2:ratelimit:%s' % key
+    backend = cache.get_cache()
+    now = time.time()
+    tokens, updated = backend.get(cache_key) or (capacity, now)
+    tokens = min(capacity, tokens + (now - updated) * capacity / period)
+    if tokens < 1:
+        backend.set(cache_key, (tokens, now), period)
+        return (1 - tokens) * period / capacity
+    backend.set(cache_key, (tokens - 1, now), period)
+    return 0
@@ -0,0 +1,126 @@
+"""
+The choices each user made most often and most recently in ajax fields.
+
+When enabled (with the ``recent_choices`` field option or the
+``SELECT2_RECENT_CHOICES`` setting, the number of choices to remember), the
+values a user picks are recorded when a form is saved, with
+``record_form()``; ModelAdmins do so by including ``RecentChoicesAdminMixin``.
+Each user keeps a list per field in the ``SELECT2_CACHE`` cache, for
+``SELECT2_RECENT_TIMEOUT`` seconds (30 days) after the last choice, ordered
+by the number of times a value was picked, then by when it was last picked.
+When the list is full, the value at its end makes way for the new one.
+
+The ``select2_recent_choices`` view serves the list of the requesting user,
+so that the dropdown can offer it when it opens, before anything is typed.
+The labels of the choices are looked up once and stored with the list until
+the target model changes (see select2.cache).
+"""
+import time
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.utils.encoding import force_str
+
+from . import cache, registry
+from .fields import Select2ModelFieldMixin, compat_rel_to
+
+
+def get_size(field):
+    """The number of recent choices kept for the select2 model ``field``"""
+    if getattr(field, 'recent_choices', None) is not None:
+        return field.recent_choices
+    return getattr(settings, 'SELECT2_RECENT_CHOICES', 0)
+
+
+def get_timeout():
+    return getattr(settings, 'SELECT2_RECENT_TIMEOUT', 30 * 24 * 60 * 60)
+
+
+def get_key(user, model, field_name):
+    return 'select2:recent:%s:%s' % (user.pk, '.'.join(registry.get_key(model, field_name)))
+
+
+def record(user, model, field, values):
+    """
+    Records that ``user`` picked ``values`` for the select2 ``field`` of
+    ``model``
+    """
+    size = get_size(field)
+    if not size or not values or not getattr(user, 'is_authenticated', False):
+        return
+    backend = cache.get_cache()
+    key = get_key(user, model, field.name)
+    stored = backend.get(key) or {'entries': []}
+    entries = dict([(force_str(entry[0]), entry) for entry in stored['entries']])
+    now = time.time()
+    for value in values:
+        entry = entries.setdefault(force_str(value), [value, 0, now])
+        entry[1] += 1
+        entry[2] = now
+    ranked = sorted(entries.values(), key=lambda entry: (entry[1], entry[2]), reverse=True)
+    # Labels are looked up again on the next request
+    backend.set(key, {'entries': ranked[:size]}, get_timeout())
+
+
+def get_results(user, model, field, iter_choices):
+    """
+    Returns the select2 results of the recent choices of ``user`` for the
+    select2 ``field`` of ``model``. ``iter_choices(values)`` yields the
+    ``(value, label, extra_values)`` choices of the values that still exist,
+    and is only called when the labels are not stored or are out of date.
+    """
+    backend = cache.get_cache()
+    key = get_key(user, model, field.name)
+    stored = backend.get(key)
+    if not stored:
+        return []
+    generation = cache.get_generation(compat_rel_to(field))
+    if stored.get('generation') != generation or 'results' not in stored:
+        values = [entry[0] for entry in stored['entries']]
+        stored['results'] = [
+            {'id': value, 'text': label} for value, label, extra_values in iter_choices(values)]
+        stored['generation'] = generation
+        backend.set(key, stored, get_timeout())
+    return stored['results']
+
+
+def record_form(request, form):
+    """
+    Records the values that the user of ``request`` added to the ajax
+    select2 fields of a saved ``form``
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated or not hasattr(form, 'cleaned_data'):
+        return
+    for name, form_field in form.fields.items():
+        if not isinstance(form_field, Select2ModelFieldMixin) or not form_field.select2_widget.ajax:
+            continue
+        if name not in form.cleaned_data or name not in form.changed_data:
+            continue
+        try:
+            field = form_field.model._meta.get_field(form_field.name)
+        except FieldDoesNotExist:
+            continue
+        if not get_size(field):
+            continue
+        initial = set([force_str(pk) for pk in form_field.get_selected_pks(
+            form_field.prepare_value(form[name].initial))])
+        values = [
+            pk for pk in form_field.get_selected_pks(form[name].value())
+            if force_str(pk) not in initial]
+        record(user, form_field.model, field, values)
+
+
+class RecentChoicesAdminMixin(object):
+    """
+    A ModelAdmin mixin that records the choices made in the select2 fields
+    of saved change forms and their inlines
+    """
+
+    def save_related(self, request, form, formsets, change):
+        super(RecentChoicesAdminMixin, self).save_related(request, form, formsets, change)
+        record_form(request, form)
+        for formset in formsets:
+            for inline_form in formset.forms:
+                if not getattr(inline_form, 'cleaned_data', {}).get('DELETE'):
+                    record_form(request, inline_form)
@@ -0,0 +1,127 @@
+"""
+A registry of the ajax fields served by select2.views.
+
+Resolving the field of a request (the model lookup, the field lookup, the
+``<field_name>_queryset`` hook on the model and the search backend) is done
+once per field rather than once per request. The registry is populated with
+every ajax select2 field when the app is ready; fields that are not found
+in it (for instance, on models created after startup) are resolved and
+added on first use.
+
+Entries hold the field options that are resolved when they are built, so
+code that changes the options of a field at runtime must call ``clear()``
+afterwards.
+"""
+import threading
+
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+
+from .fields import RelatedFieldMixin, compat_rel, compat_rel_to
+
+
+#: FieldSpec instances, keyed on (app label, model name, field name)
+registry = {}
+
+lock = threading.Lock()
+
+
+class FieldSpec(object):
+    """The resolved view configuration of a select2 model field"""
+
+    def __init__(self, model, field):
+        #: The model the field is declared on
+        self.model = model
+        self.field = field
+        #: The model that choices are fetched from
+        self.target_model = compat_rel_to(field)
+        #: The field of ``target_model`` whose value is submitted
+        self.related_field = compat_rel(field).get_related_field()
+        self.search_backend = field.get_search_backend()
+        # Construct the form field for its label_from_instance() now, rather
+        # than during a request
+        field.get_label_from_instance()
+
+        # A callable <field_name>_queryset method on the model class filters
+        # the Select2 queryset. This is useful for model inheritance, where
+        # limit_choices_to can not easily be overridden in child classes.
+        queryset_hook = getattr(model, '%s_queryset' % field.name, None)
+        self.queryset_hook = queryset_hook if callable(queryset_hook) else None
+
+    def get_queryset(self, using=None, recently_written=False):
+        """
+        Returns a new queryset of the choices of the field, read from the
+        database ``using``. Without one the routers choose the database,
+        and can recognize the queryset by its ``select2_field`` hint. Its
+        ``select2_recently_written`` hint is True when the target model
+        changed less than SELECT2_REPLICA_LAG seconds ago, so that replicas
+        may not have the change yet.
+        """
+        manager = self.target_model._default_manager.db_manager(using, hints={
+            'select2_field': self.field,
+            'select2_recently_written': recently_written,
+        })
+        return manager.complex_filter(self.field.get_limit_choices_to())
+
+    def filter_queryset(self, queryset):
+        if self.queryset_hook is not None:
+            queryset = self.queryset_hook(queryset)
+        return queryset
+
+
+def get_key(model, field_name):
+    opts = model._meta
+    return (opts.app_label, opts.model_name, field_name)
+
+
+def register(model, field):
+    spec = FieldSpec(model, field)
+    registry[get_key(model, field.name)] = spec
+    return spec
+
+
+def get_spec(app_label, model_name, field_name):
+    """
+    Returns the FieldSpec of a field, resolving it if it is not registered.
+    Raises LookupError if the model does not exist, and FieldDoesNotExist
+    if the field does not or is not an ajax select2 field.
+    """
+    try:
+        return registry[(app_label, model_name, field_name)]
+    except KeyError:
+        pass
+    model = apps.get_model(app_label, model_name)
+    # The requested model name may differ in case from the canonical one
+    key = get_key(model, field_name)
+    try:
+        return registry[key]
+    except KeyError:
+        pass
+    field = model._meta.get_field(field_name)
+    if not isinstance(field, RelatedFieldMixin) or not field.ajax:
+        raise FieldDoesNotExist(
+            "%s has no ajax select2 field named '%s'" % (model._meta.object_name, field_name))
+    with lock:
+        spec = registry[key] = FieldSpec(model, field)
+    return spec
+
+
+def iter_fields():
+    """Yields the ``(model, field)`` of every ajax select2 field of the installed models"""
+    for model in apps.get_models():
+        for field in model._meta.get_fields():
+            if isinstance(field, RelatedFieldMixin) and field.ajax:
+                yield model, field
+
+
+def populate():
+    """Registers every ajax select2 field of the installed models"""
+    for model, field in iter_fields():
+        register(model, field)
+
+
+def clear():
+    for spec in list(registry.values()):
+        # Resolved again when the field is next registered
+        spec.field._label_from_instance = None
+    registry.clear()
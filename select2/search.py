@@ -0,0 +1,505 @@
+"""
+Search backends for ajax fields.
+
+A search backend filters the queryset of an ajax field on the search term
+typed by the user. Backends are passed to select2 model fields with the
+``search_backend`` keyword argument::
+
+    author = select2.fields.ForeignKey(Author,
+        ajax=True,
+        search_backend=select2.search.PrefixSearch('name'),
+        on_delete=models.CASCADE)
+
+Fields without a ``search_backend`` use ContainsSearch, which implements the
+``search_field`` and ``case_sensitive`` keyword arguments.
+
+Backends also describe the database indexes that serve their searches (see
+``get_indexes()`` and the ``select2_indexes`` management command).
+"""
+import hashlib
+import re
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections, models
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import RawSQL
+from django.utils.encoding import force_str
+
+
+re_words = re.compile(r"\w+", re.UNICODE)
+
+
+def get_index_name(model, *parts):
+    """Returns a name for an index on the table of ``model``, unique to ``parts``"""
+    table = model._meta.db_table
+    digest = hashlib.md5(repr((table,) + parts).encode('utf-8')).hexdigest()[:8]
+    return '%s_%s_select2' % (table[:40], digest)
+
+
+def create_index(model, connection, name, expression, method=None):
+    """
+    Returns the ``(name, sql, reverse_sql)`` of the index ``name`` on
+    ``expression``, where ``sql`` and ``reverse_sql`` are lists of
+    statements
+    """
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    sql = 'CREATE INDEX %s ON %s%s (%s)' % (
+        qn(name), table, ' USING %s' % method if method else '', expression)
+    reverse_sql = connection.schema_editor().sql_delete_index % {
+        'name': qn(name), 'table': table}
+    return (name, [sql], [reverse_sql])
+
+
+def get_lookup_index(model, connection, search_field, lookup_name, case_sensitive):
+    """
+    Returns the ``(name, sql, reverse_sql)`` of an index that serves
+    ``contains`` or ``startswith`` lookups (or their case-insensitive
+    versions) on the ``search_field`` column of ``model``, or None if no
+    index can
+    """
+    try:
+        model_field = model._meta.get_field(search_field)
+    except FieldDoesNotExist:
+        return None
+    if model_field.is_relation or not model_field.concrete:
+        return None
+    column = connection.ops.quote_name(model_field.column)
+    name = get_index_name(model, model_field.column, lookup_name, case_sensitive)
+    if connection.vendor == 'postgresql':
+        # The expressions of Django's lookups: UPPER("column"::text) for
+        # case-insensitive ones
+        expression = column if case_sensitive else 'UPPER(%s::text)' % column
+        if lookup_name == 'contains':
+            index = create_index(
+                model, connection, name, '%s gin_trgm_ops' % expression, 'gin')
+            index[1].insert(0, 'CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            return index
+        if case_sensitive and model_field.db_type(connection).startswith('varchar'):
+            opclass = 'varchar_pattern_ops'
+        else:
+            opclass = 'text_pattern_ops'
+        return create_index(model, connection, name, '%s %s' % (expression, opclass))
+    if lookup_name == 'contains':
+        # Only trigram indexes serve LIKE patterns with a leading wildcard
+        return None
+    if connection.vendor == 'sqlite':
+        # LIKE is case-insensitive on SQLite, and only uses indexes with the
+        # NOCASE collation
+        return create_index(model, connection, name, '%s COLLATE NOCASE' % column)
+    return create_index(model, connection, name, column)
+
+
+def get_ranked_ordering(queryset):
+    """
+    Returns the ordering that breaks ties between rows of the same rank: the
+    ordering of ``queryset`` (or else of its model), then the primary key, so
+    that pages neither repeat nor skip rows
+    """
+    ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+    if 'pk' not in ordering:
+        ordering.append('pk')
+    return ordering
+
+
+class SearchBackend(object):
+    """
+    Base class of search backends. Subclasses must implement ``filter()``.
+
+    ``search_field`` and ``case_sensitive`` default to the values of the
+    select2 model field the backend is used with.
+    """
+
+    search_field = None
+    case_sensitive = None
+
+    def __init__(self, search_field=None, case_sensitive=None):
+        if search_field is not None:
+            self.search_field = search_field
+        if case_sensitive is not None:
+            self.case_sensitive = case_sensitive
+
+    def get_search_field(self, field):
+        return self.search_field if self.search_field is not None else field.search_field
+
+    def get_case_sensitive(self, field):
+        if self.case_sensitive is not None:
+            return self.case_sensitive
+        return field.case_sensitive
+
+    def filter(self, queryset, q, field):
+        """Returns ``queryset`` filtered on the search term ``q``"""
+        raise NotImplementedError
+
+    def normalize_term(self, q, field):
+        """
+        Returns ``q`` normalized so that terms with the same results are
+        equal, for use in cache keys.
+        """
+        return q
+
+    def get_match_field(self, field):
+        """
+        Returns the name of the target model field that match() tests, or
+        None if results can only be searched in the database
+        """
+        return None
+
+    def get_indexes(self, model, connection, field):
+        """
+        Returns a list of the ``(name, sql, reverse_sql)`` of the indexes
+        that serve filter() on ``model`` with the database ``connection``.
+        ``sql`` and ``reverse_sql`` are lists of statements.
+        """
+        return []
+
+    def match(self, value, q, field):
+        """
+        Returns whether a row whose get_match_field() field is ``value`` is
+        found by a search for the normalized term ``q``
+        """
+        raise NotImplementedError
+
+
+class LookupSearch(SearchBackend):
+    """
+    Searches with a field lookup on ``search_field``, which may also be a
+    callable that takes the search term and returns a Q object.
+    """
+
+    lookup_name = None
+
+    #: The Python equivalents of the lookups, for match()
+    python_lookups = {
+        'contains': str.__contains__,
+        'startswith': str.startswith,
+    }
+
+    def filter(self, queryset, q, field):
+        search_field = self.get_search_field(field)
+        if callable(search_field):
+            search_field = search_field(q)
+        if isinstance(search_field, models.Q):
+            q_obj = search_field
+        else:
+            lookup = '%(search_field)s__%(insensitive)s%(lookup_name)s' % {
+                'search_field': search_field,
+                'insensitive': 'i' if not self.get_case_sensitive(field) else '',
+                'lookup_name': self.lookup_name,
+            }
+            q_obj = models.Q(**{lookup: q})
+        return queryset.filter(q_obj)
+
+    def normalize_term(self, q, field):
+        # Case-insensitive lookups return the same results for terms that
+        # differ only in case. Nothing is known about callables.
+        if isinstance(self.get_search_field(field), str) and not self.get_case_sensitive(field):
+            return q.lower()
+        return q
+
+    def get_match_field(self, field):
+        search_field = self.get_search_field(field)
+        if not isinstance(search_field, str) or LOOKUP_SEP in search_field:
+            return None
+        if self.lookup_name not in self.python_lookups:
+            return None
+        return search_field
+
+    def match(self, value, q, field):
+        if value is None:
+            return False
+        value = force_str(value)
+        if not self.get_case_sensitive(field):
+            value = value.lower()
+        return self.python_lookups[self.lookup_name](value, q)
+
+    def get_indexes(self, model, connection, field):
+        search_field = self.get_match_field(field)
+        if search_field is None:
+            return []
+        index = get_lookup_index(
+            model, connection, search_field, self.lookup_name, self.get_case_sensitive(field))
+        return [index] if index is not None else []
+
+
+class ContainsSearch(LookupSearch):
+    """
+    The default backend: a ``contains`` (or ``icontains``) lookup. Leading
+    wildcard matches cannot use a B-tree index, so on large tables every
+    search is a sequential scan.
+    """
+
+    lookup_name = 'contains'
+
+
+class PrefixSearch(LookupSearch):
+    """
+    A ``startswith`` (or ``istartswith``) lookup, which can be served by an
+    index on the search column (for case-insensitive searches, a functional
+    index on ``UPPER(column)``; on PostgreSQL with a non-C collation, an index
+    with ``varchar_pattern_ops``).
+    """
+
+    lookup_name = 'startswith'
+
+
+class RankedSearch(SearchBackend):
+    """
+    Searches several fields (``search_field`` is a list of field names) and
+    ranks the results by how well they match.
+
+    Every word of the search term must be contained in at least one of the
+    fields. Results are then ordered, ahead of the queryset's own ordering,
+    by the best match of the whole term in any field: an exact match first,
+    then a match at the start of the field, then at the start of a word,
+    then anywhere.
+
+    This is the backend of fields declared with ``search_fields``.
+    """
+
+    #: The rank of each kind of match, from best to worst
+    RANK_EXACT, RANK_PREFIX, RANK_WORD_START, RANK_CONTAINS = range(4)
+
+    def get_search_fields(self, field):
+        search_fields = self.get_search_field(field)
+        if isinstance(search_fields, str):
+            search_fields = [search_fields]
+        return list(search_fields)
+
+    def get_lookup(self, search_field, lookup_name, field):
+        insensitive = 'i' if not self.get_case_sensitive(field) else ''
+        return '%s__%s%s' % (search_field, insensitive, lookup_name)
+
+    def match_any(self, search_fields, lookup_name, value, field):
+        q_obj = models.Q()
+        for search_field in search_fields:
+            q_obj |= models.Q(**{self.get_lookup(search_field, lookup_name, field): value})
+        return q_obj
+
+    def filter(self, queryset, q, field):
+        words = q.split()
+        if not words:
+            return queryset
+        search_fields = self.get_search_fields(field)
+        for word in words:
+            queryset = queryset.filter(self.match_any(search_fields, 'contains', word, field))
+
+        term = ' '.join(words)
+        rank = models.Case(
+            models.When(
+                self.match_any(search_fields, 'exact', term, field),
+                then=models.Value(self.RANK_EXACT)),
+            models.When(
+                self.match_any(search_fields, 'startswith', term, field),
+                then=models.Value(self.RANK_PREFIX)),
+            models.When(
+                self.match_any(search_fields, 'contains', ' %s' % term, field),
+                then=models.Value(self.RANK_WORD_START)),
+            default=models.Value(self.RANK_CONTAINS),
+            output_field=models.IntegerField())
+        return queryset.annotate(select2_rank=rank).order_by(
+            'select2_rank', *get_ranked_ordering(queryset))
+
+    def normalize_term(self, q, field):
+        q = ' '.join(q.split())
+        return q if self.get_case_sensitive(field) else q.lower()
+
+    def get_indexes(self, model, connection, field):
+        indexes = []
+        for name in self.get_search_fields(field):
+            index = get_lookup_index(
+                model, connection, name, 'contains', self.get_case_sensitive(field))
+            if index is not None:
+                indexes.append(index)
+        return indexes
+
+
+class TrigramSearch(SearchBackend):
+    """
+    PostgreSQL trigram similarity search, served by a GIN or GiST index with
+    ``gin_trgm_ops``. Requires the ``pg_trgm`` extension and
+    ``django.contrib.postgres`` in ``INSTALLED_APPS``.
+
+    If ``order_by_similarity`` is True, the most similar results are returned
+    first.
+    """
+
+    order_by_similarity = True
+
+    def __init__(self, search_field=None, order_by_similarity=None, **kwargs):
+        super(TrigramSearch, self).__init__(search_field, **kwargs)
+        if order_by_similarity is not None:
+            self.order_by_similarity = order_by_similarity
+
+    def filter(self, queryset, q, field):
+        from django.contrib.postgres.search import TrigramSimilarity
+
+        search_field = self.get_search_field(field)
+        if not q:
+            return queryset
+        queryset = queryset.filter(**{'%s__trigram_similar' % search_field: q})
+        if self.order_by_similarity:
+            queryset = queryset.annotate(
+                select2_similarity=TrigramSimilarity(search_field, q),
+            ).order_by('-select2_similarity', *get_ranked_ordering(queryset))
+        return queryset
+
+    def normalize_term(self, q, field):
+        return q.lower()
+
+    def get_indexes(self, model, connection, field):
+        search_field = self.get_search_field(field)
+        if connection.vendor != 'postgresql' or not isinstance(search_field, str):
+            return []
+        try:
+            column = model._meta.get_field(search_field).column
+        except FieldDoesNotExist:
+            return []
+        index = create_index(
+            model, connection, get_index_name(model, column, 'trigram'),
+            '%s gin_trgm_ops' % connection.ops.quote_name(column), 'gin')
+        index[1].insert(0, 'CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        return [index]
+
+
+class FullTextSearch(SearchBackend):
+    """
+    PostgreSQL full text search over one or more fields.
+
+    ``search_field`` is a field name or a list of field names combined into
+    a ``SearchVector``; if ``vector_field`` names a precomputed (and indexed)
+    ``SearchVectorField`` it is searched instead. ``config`` and
+    ``search_type`` are passed to ``SearchQuery``.
+    """
+
+    config = None
+    search_type = 'plain'
+    vector_field = None
+
+    def __init__(self, search_field=None, config=None, search_type=None,
+                 vector_field=None, **kwargs):
+        super(FullTextSearch, self).__init__(search_field, **kwargs)
+        if config is not None:
+            self.config = config
+        if search_type is not None:
+            self.search_type = search_type
+        if vector_field is not None:
+            self.vector_field = vector_field
+
+    def filter(self, queryset, q, field):
+        from django.contrib.postgres.search import SearchQuery, SearchVector
+
+        if not q.strip():
+            return queryset
+        query = SearchQuery(q, config=self.config, search_type=self.search_type)
+        if self.vector_field is not None:
+            return queryset.filter(**{self.vector_field: query})
+        search_fields = self.get_search_field(field)
+        if isinstance(search_fields, str):
+            search_fields = [search_fields]
+        vector = SearchVector(*search_fields, config=self.config)
+        return queryset.annotate(select2_search=vector).filter(select2_search=query)
+
+    def get_indexes(self, model, connection, field):
+        # Vectors computed in the query can not use an index; an indexed
+        # vector_field is needed
+        if connection.vendor != 'postgresql' or self.vector_field is None:
+            return []
+        column = model._meta.get_field(self.vector_field).column
+        return [create_index(
+            model, connection, get_index_name(model, column, 'vector'),
+            connection.ops.quote_name(column), 'gin')]
+
+
+class SQLiteFTS5Search(SearchBackend):
+    """
+    SQLite full text search with an external-content FTS5 table over the
+    columns of ``search_field`` (a field name or a list of field names).
+
+    Every word of the search term must match the start of a word in the
+    indexed columns. The FTS5 table, and the triggers that keep it in sync
+    with the model table, are created by executing the statements returned
+    by ``sql_create()``.
+    """
+
+    def get_fields(self, model, field=None):
+        search_fields = self.search_field
+        if search_fields is None and field is not None:
+            search_fields = field.search_field
+        if isinstance(search_fields, str):
+            search_fields = [search_fields]
+        return [model._meta.get_field(name) for name in search_fields]
+
+    def get_table_name(self, model):
+        return '%s_select2_fts' % model._meta.db_table
+
+    def sql_create(self, model, connection, field=None):
+        """
+        Returns the SQL statements that create and populate the FTS5 table
+        for ``model``
+        """
+        qn = connection.ops.quote_name
+        fts_table = qn(self.get_table_name(model))
+        table = qn(model._meta.db_table)
+        pk = qn(model._meta.pk.column)
+        columns = [qn(f.column) for f in self.get_fields(model, field)]
+        context = {
+            'fts_table': fts_table,
+            'table': table,
+            'pk': pk,
+            'columns': ', '.join(columns),
+            'new_columns': ', '.join(['new.%s' % c for c in columns]),
+            'old_columns': ', '.join(['old.%s' % c for c in columns]),
+            'trigger': self.get_table_name(model),
+        }
+        return [sql % context for sql in [
+            "CREATE VIRTUAL TABLE %(fts_table)s USING fts5("
+            "%(columns)s, content=%(table)s, content_rowid=%(pk)s)",
+            "CREATE TRIGGER \"%(trigger)s_ai\" AFTER INSERT ON %(table)s BEGIN "
+            "INSERT INTO %(fts_table)s(rowid, %(columns)s) VALUES (new.%(pk)s, %(new_columns)s); "
+            "END",
+            "CREATE TRIGGER \"%(trigger)s_ad\" AFTER DELETE ON %(table)s BEGIN "
+            "INSERT INTO %(fts_table)s(%(fts_table)s, rowid, %(columns)s) "
+            "VALUES ('delete', old.%(pk)s, %(old_columns)s); "
+            "END",
+            "CREATE TRIGGER \"%(trigger)s_au\" AFTER UPDATE ON %(table)s BEGIN "
+            "INSERT INTO %(fts_table)s(%(fts_table)s, rowid, %(columns)s) "
+            "VALUES ('delete', old.%(pk)s, %(old_columns)s); "
+            "INSERT INTO %(fts_table)s(rowid, %(columns)s) VALUES (new.%(pk)s, %(new_columns)s); "
+            "END",
+            "INSERT INTO %(fts_table)s(%(fts_table)s) VALUES ('rebuild')",
+        ]]
+
+    def sql_drop(self, model, connection):
+        """Returns the SQL statements that drop the FTS5 table for ``model``"""
+        qn = connection.ops.quote_name
+        trigger = self.get_table_name(model)
+        return [
+            'DROP TRIGGER IF EXISTS "%s_%s"' % (trigger, suffix)
+            for suffix in ('ai', 'ad', 'au')
+        ] + ['DROP TABLE IF EXISTS %s' % qn(self.get_table_name(model))]
+
+    def get_indexes(self, model, connection, field):
+        if connection.vendor != 'sqlite':
+            return []
+        return [(
+            self.get_table_name(model),
+            self.sql_create(model, connection, field),
+            self.sql_drop(model, connection))]
+
+    def get_match_expression(self, q):
+        words = re_words.findall(q)
+        return ' '.join(['"%s"*' % word for word in words])
+
+    def filter(self, queryset, q, field):
+        match = self.get_match_expression(q)
+        if not match:
+            return queryset
+        qn = connections[queryset.db].ops.quote_name
+        fts_table = qn(self.get_table_name(queryset.model))
+        return queryset.filter(pk__in=RawSQL(
+            'SELECT rowid FROM %s WHERE %s MATCH %%s' % (fts_table, fts_table),
+            (match,)))
+
+    def normalize_term(self, q, field):
+        return self.get_match_expression(q).lower()
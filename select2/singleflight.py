@@ -0,0 +1,102 @@
+"""
+Coalescing of identical concurrent fetch_items computations.
+
+When the cached results of a popular search are invalidated, every request
+for it misses the cache at the same moment and runs the same queries. With
+coalescing, the first request for a cache key computes the results, and
+identical requests made meanwhile wait for them instead:
+
+* within a process, followers wait on the leader's call and share its
+  result;
+* with ``shared=True``, the leader also takes a lease in the cache
+  configured with ``SELECT2_CACHE``, and requests in other processes poll
+  the cache for the result until the lease is released or expires.
+
+Followers never wait longer than ``SELECT2_COALESCE_TIMEOUT`` seconds (10 by
+default), after which, or if the leader fails, they compute the results
+themselves.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+from . import cache
+
+
+#: Calls in progress in this process, keyed on cache key
+calls = {}
+
+lock = threading.Lock()
+
+#: Seconds between polls of the cache while another process holds the lease
+poll_interval = 0.05
+
+
+class Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.succeeded = False
+
+
+def get_timeout():
+    return getattr(settings, 'SELECT2_COALESCE_TIMEOUT', 10)
+
+
+def lease_key(key):
+    return 'select2:lease:%s' % key
+
+
+def do(key, func, shared=False):
+    """
+    Returns ``func()``, which stores its result in the cache under ``key``.
+    If a call for ``key`` is already in progress in this process (or, if
+    ``shared``, in another process), waits for its result instead.
+    """
+    with lock:
+        call = calls.get(key)
+        leader = call is None
+        if leader:
+            call = calls[key] = Call()
+    if not leader:
+        if call.event.wait(get_timeout()) and call.succeeded:
+            return call.result
+        return func()
+
+    try:
+        call.result = run_leased(key, func) if shared else func()
+        call.succeeded = True
+    finally:
+        with lock:
+            del calls[key]
+        call.event.set()
+    return call.result
+
+
+def run_leased(key, func):
+    """
+    Returns ``func()`` once this process holds the cache lease on ``key``,
+    or the result stored under ``key`` by the process that held it
+    """
+    backend = cache.get_cache()
+    timeout = get_timeout()
+    deadline = time.time() + timeout
+    while not backend.add(lease_key(key), True, timeout):
+        if time.time() >= deadline:
+            # The holder of the lease is too slow (or died)
+            return func()
+        time.sleep(poll_interval)
+        result = backend.get(key)
+        if result is not None:
+            return result
+    try:
+        # The previous holder may have finished just before the lease was
+        # taken
+        result = backend.get(key)
+        if result is None:
+            result = func()
+        return result
+    finally:
+        backend.delete(lease_key(key))
@@ -6,19 +6,264 @@ var DjangoSelect2 = window.DjangoSelect2 || {};
         $ = DjangoSelect2.jQuery = (window.django || {}).jQuery || window.jQuery;
     }
 
+    DjangoSelect2.pendingInitSelections = {};
+
+    // A least-recently-used cache of ajax responses, keyed on the request
+    // url and parameters, whose entries expire after `ttl` milliseconds.
+    DjangoSelect2.ResultCache = function(size, ttl) {
+        this.size = size;
+        this.ttl = ttl;
+        this.keys = [];
+        this.entries = {};
+    };
+
+    DjangoSelect2.ResultCache.prototype.get = function(key) {
+        var entry = this.entries['k:' + key];
+        if (!entry) {
+            return undefined;
+        }
+        this.remove(key);
+        if (new Date().getTime() - entry.time > this.ttl) {
+            return undefined;
+        }
+        this.keys.push(key);
+        this.entries['k:' + key] = entry;
+        return entry.data;
+    };
+
+    DjangoSelect2.ResultCache.prototype.set = function(key, data) {
+        this.remove(key);
+        this.keys.push(key);
+        this.entries['k:' + key] = {data: data, time: new Date().getTime()};
+        while (this.keys.length > this.size) {
+            delete this.entries['k:' + this.keys.shift()];
+        }
+    };
+
+    DjangoSelect2.ResultCache.prototype.remove = function(key) {
+        if (this.entries.hasOwnProperty('k:' + key)) {
+            delete this.entries['k:' + key];
+            this.keys.splice($.inArray(key, this.keys), 1);
+        }
+    };
+
+    // Shared by every widget on the page. The size and ttl can be changed by
+    // defining DjangoSelect2.resultCacheSize and resultCacheTTL before this
+    // script is loaded.
+    DjangoSelect2.resultCache = new DjangoSelect2.ResultCache(
+        DjangoSelect2.resultCacheSize || 200,
+        DjangoSelect2.resultCacheTTL || 5 * 60 * 1000);
+
+    DjangoSelect2.resultCacheKey = function(url, data) {
+        return url + '?' + $.param(data || {});
+    };
+
+    // Returns the results for a search term from the cached, complete
+    // (`more: false`) first page of a prefix of the term, filtered by
+    // matching their text with `mode` ('contains' or 'startswith').
+    DjangoSelect2.filterCachedResults = function(url, data, mode) {
+        if (!data || data.next || String(data.page) !== '1') {
+            return undefined;
+        }
+        var q = String(data.q || '');
+        var term = q.toLowerCase();
+        for (var i = q.length - 1; i >= 0; i--) {
+            var cached = DjangoSelect2.resultCache.get(
+                DjangoSelect2.resultCacheKey(url, $.extend({}, data, {q: q.substring(0, i)})));
+            if (!cached || cached.more || !$.isArray(cached.results)) {
+                continue;
+            }
+            var results = $.grep(cached.results, function(result) {
+                var index = String(result.text).toLowerCase().indexOf(term);
+                return (mode === 'startswith') ? index === 0 : index !== -1;
+            });
+            return {results: results, more: false, total: results.length};
+        }
+        return undefined;
+    };
+
+    // An ajax transport for select2 that answers from the result cache when
+    // it can, and otherwise adds the response of the request to it.
+    DjangoSelect2.cachedTransport = function(params, localFilter) {
+        var cache = DjangoSelect2.resultCache;
+        var key = DjangoSelect2.resultCacheKey(params.url, params.data);
+        var data = cache.get(key);
+        if (data === undefined && localFilter) {
+            data = DjangoSelect2.filterCachedResults(params.url, params.data, localFilter);
+        }
+        if (data !== undefined) {
+            var timeout = window.setTimeout(function() {
+                params.success($.extend(true, {}, data));
+            }, 0);
+            return {abort: function() { window.clearTimeout(timeout); }};
+        }
+        var success = params.success;
+        params.success = function(data) {
+            if (typeof(data) == 'object' && data !== null && !data.error) {
+                cache.set(key, $.extend(true, {}, data));
+            }
+            return success.apply(this, arguments);
+        };
+        return $.ajax(params);
+    };
+
+    // An ajax transport for fields that remember the recent choices of the
+    // user (see select2.recent). The first page of a term shorter than
+    // `minimumInputLength` lists the recent choices whose text contains it.
+    // For fields without a minimum, the recent choices are listed above
+    // the first page of all the results when the dropdown opens. Other
+    // requests are handed to `transport`.
+    DjangoSelect2.recentTransport = function(params, recentUrl, minimumInputLength, transport) {
+        var data = params.data || {};
+        var q = String(data.q || '');
+        if ((q.length && q.length >= minimumInputLength) || data.next || String(data.page) !== '1') {
+            return transport(params);
+        }
+        var term = q.toLowerCase();
+        var request = DjangoSelect2.cachedTransport($.extend({}, params, {
+            url: recentUrl,
+            data: {},
+            success: function(recent) {
+                var results = $.grep((recent && recent.results) || [], function(result) {
+                    return String(result.text).toLowerCase().indexOf(term) !== -1;
+                });
+                if (minimumInputLength) {
+                    params.success({results: results, more: false});
+                    return;
+                }
+                var ids = {};
+                $.each(results, function(i, result) {
+                    ids['k:' + result.id] = true;
+                });
+                request = transport($.extend({}, params, {
+                    success: function(page) {
+                        if (typeof(page) == 'object' && page !== null && $.isArray(page.results)) {
+                            page = $.extend({}, page, {
+                                results: results.concat($.grep(page.results, function(result) {
+                                    return !ids['k:' + result.id];
+                                }))
+                            });
+                        }
+                        return params.success.call(this, page);
+                    }
+                }));
+            },
+            error: function() {
+                // Without the recent choices, behave as if there were none
+                if (minimumInputLength) {
+                    params.success({results: [], more: false});
+                } else {
+                    request = transport(params);
+                }
+            }
+        }));
+        return {abort: function() { request.abort(); }};
+    };
+
+    // Looks up the initial selection of a single widget
+    DjangoSelect2.fetchInitSelection = function(url, data, callback) {
+        $.ajax({
+            url: url,
+            dataType: 'json',
+            data: data,
+            success: function(data) {
+                if (typeof(data) == 'object' && typeof(data.results) == 'object' && data.results) {
+                    callback(data.results);
+                }
+            }
+        });
+    };
+
+    // The CSRF token of the page, from a form on the page or the cookie
+    DjangoSelect2.getCsrfToken = function() {
+        var token = $('input[name=csrfmiddlewaretoken]').first().val();
+        if (token) {
+            return token;
+        }
+        var match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]*)/);
+        return match ? decodeURIComponent(match[1]) : '';
+    };
+
+    // Queues an initSelection lookup. All lookups queued while the page (or
+    // a newly added inline) is being initialized are sent to the server
+    // together in a single request, once the current event has finished.
+    // If that request fails, each widget falls back to a lookup of its own
+    // with fallback().
+    DjangoSelect2.queueInitSelection = function(url, selection, callback, fallback) {
+        var pending = DjangoSelect2.pendingInitSelections[url];
+        if (!pending) {
+            pending = DjangoSelect2.pendingInitSelections[url] = [];
+            window.setTimeout(function() {
+                DjangoSelect2.flushInitSelections(url);
+            }, 0);
+        }
+        pending.push({selection: selection, callback: callback, fallback: fallback});
+    };
+
+    DjangoSelect2.flushInitSelections = function(url) {
+        var pending = DjangoSelect2.pendingInitSelections[url] || [];
+        delete DjangoSelect2.pendingInitSelections[url];
+        if (!pending.length) {
+            return;
+        }
+        var selections = [];
+        $.each(pending, function(i, item) {
+            selections.push($.extend({key: String(i)}, item.selection));
+        });
+        $.ajax({
+            url: url,
+            type: 'POST',
+            contentType: 'application/json',
+            dataType: 'json',
+            headers: {'X-CSRFToken': DjangoSelect2.getCsrfToken()},
+            data: JSON.stringify({selections: selections}),
+            success: function(data) {
+                var results = (typeof(data) == 'object' && data) ? data.results || {} : {};
+                $.each(pending, function(i, item) {
+                    if (typeof(results[String(i)]) == 'object' && results[String(i)]) {
+                        item.callback(results[String(i)]);
+                    }
+                });
+            },
+            error: function() {
+                $.each(pending, function(i, item) {
+                    if (item.fallback) {
+                        item.fallback();
+                    }
+                });
+            }
+        });
+    };
+
     DjangoSelect2.init = function(input) {
         var $input = $(input);
         var ajaxOptions = {
             ajax: {
-                data: function(term, page) {
-                    return {
+                // Don't add a cache-busting parameter to requests, so that
+                // responses with ETag or Cache-Control headers can be reused
+                cache: true,
+                data: function(term, page, context) {
+                    var params = {
                         q: term,
                         page: page,
                         page_limit: 10
                     };
+                    // With keyset pagination the server returns an opaque
+                    // 'next' token, which select2 hands back to us as the
+                    // query context when loading the following page.
+                    if (context) {
+                        params.next = context;
+                    }
+                    return params;
                 },
                 results: function(data, page) {
+                    if (data.next) {
+                        data.context = data.next;
+                    }
                     return data;
+                },
+                transport: function(params) {
+                    return DjangoSelect2.cachedTransport(params, options.ajax.localFilter);
                 }
             },
             initSelection: function (element, callback) {
@@ -26,6 +271,18 @@ var DjangoSelect2 = window.DjangoSelect2 || {};
                 if (!inputVal) {
                     return;
                 }
+                // Use the selection rendered inline with the widget, unless
+                // the value of the input has changed since.
+                var initial = $input.data('initSelection');
+                if (typeof initial == 'object' && initial !== null) {
+                    var ids = $.map($.isArray(initial) ? initial : [initial], function(item) {
+                        return String(item.id);
+                    });
+                    if (ids.join(',') === inputVal) {
+                        callback(initial);
+                        return;
+                    }
+                }
                 var data = {
                     q: inputVal
                 };
@@ -33,21 +290,45 @@ var DjangoSelect2 = window.DjangoSelect2 || {};
                 if (typeof select2.opts == 'object' && select2.opts !== null) {
                     data.multiple = (select2.opts.multiple) ? 1 : 0;
                 }
-                $.ajax({
-                    url: $input.data('initSelectionUrl'),
-                    dataType: 'json',
-                    data: data,
-                    success: function(data) {
-                        if (typeof(data) == 'object' && typeof(data.results) == 'object' && data.results) {
-                            callback(data.results);
-                        }
-                    }
-                });
+                var url = $input.data('initSelectionUrl');
+                var batchUrl = $input.data('initSelectionBatchUrl');
+                var field = $input.data('select2Field');
+                if (batchUrl && typeof field == 'object' && field !== null) {
+                    DjangoSelect2.queueInitSelection(
+                        batchUrl, $.extend({}, field, data), callback, function() {
+                            DjangoSelect2.fetchInitSelection(url, data, callback);
+                        });
+                    return;
+                }
+                DjangoSelect2.fetchInitSelection(url, data, callback);
             }
         };
         var options =  $input.data('select2Options') || {};
         if (typeof options.ajax == 'object') {
             options = $.extend(true, ajaxOptions, options);
+            var recentUrl = $input.data('recentChoicesUrl');
+            if (recentUrl) {
+                // Open the dropdown on the recent choices rather than a
+                // prompt to type
+                var minimumInputLength = options.minimumInputLength || 0;
+                var transport = options.ajax.transport;
+                var defaults = $.fn.select2.defaults;
+                var formatNoMatches = options.formatNoMatches || defaults.formatNoMatches;
+                var formatInputTooShort = options.formatInputTooShort || defaults.formatInputTooShort;
+                options.minimumInputLength = 0;
+                options.ajax.transport = function(params) {
+                    return DjangoSelect2.recentTransport(
+                        params, recentUrl, minimumInputLength, transport);
+                };
+                // Prompt for a longer term, as select2 would, when no recent
+                // choice matches a short one
+                options.formatNoMatches = function(term) {
+                    if (String(term || '').length < minimumInputLength) {
+                        return formatInputTooShort.call(this, term, minimumInputLength);
+                    }
+                    return formatNoMatches.apply(this, arguments);
+                };
+            }
         }
         $input.select2(options);
         if ($input.data('sortable') && typeof $.fn.djs2sortable == 'function') {
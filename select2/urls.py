@@ -1,11 +1,34 @@
+import django
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.urls import re_path
 
 import select2.views
 
 
+if getattr(settings, 'SELECT2_ASYNC_VIEWS', False):
+    if django.VERSION < (4, 1):
+        raise ImproperlyConfigured("SELECT2_ASYNC_VIEWS requires Django 4.1 or later")
+    fetch_items = select2.views.afetch_items
+    init_selection = select2.views.ainit_selection
+else:
+    fetch_items = select2.views.fetch_items
+    init_selection = select2.views.init_selection
+
+
+field_path = r'(?P<app_label>[^\/]+)/(?P<model_name>[^\/]+)/(?P<field_name>[^\/]+)/$'
+
 urlpatterns = [
-    re_path(r'^fetch_items/(?P<app_label>[^\/]+)/(?P<model_name>[^\/]+)/(?P<field_name>[^\/]+)/$',
-        select2.views.fetch_items, name='select2_fetch_items'),
-    re_path(r'^init_selection/(?P<app_label>[^\/]+)/(?P<model_name>[^\/]+)/(?P<field_name>[^\/]+)/$',
-        select2.views.init_selection, name='select2_init_selection'),
+    re_path(
+        r'^fetch_items/' + field_path,
+        fetch_items, name='select2_fetch_items'),
+    re_path(
+        r'^init_selection/' + field_path,
+        init_selection, name='select2_init_selection'),
+    re_path(
+        r'^recent_choices/' + field_path,
+        select2.views.recent_choices, name='select2_recent_choices'),
+    re_path(
+        r'^init_selection/$',
+        select2.views.init_selection_batch, name='select2_init_selection_batch'),
 ]
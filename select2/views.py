@@ -1,17 +1,24 @@
-import copy
+import asyncio
+import hashlib
 import json
+import math
+import time
+from itertools import chain
 
-from django.db import models
-from django.apps import apps
-from django.forms.models import ModelChoiceIterator
-from django.http import HttpResponse
-from django.utils.encoding import force_str
-try:
-    from django.forms.models import ModelChoiceIteratorValue
-except ImportError:
-    ModelChoiceIteratorValue = None
+from django.db import connections, models, router
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist, ValidationError
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.encoding import force_bytes, force_str
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_POST
 
-from .fields import ManyToManyField, compat_rel
+from . import (
+    analytics, cache, encoders, index as search_index, ratelimit, recent, registry,
+    singleflight, workers)
+from .fields import ManyToManyField
 
 
 class ViewException(Exception):
@@ -22,22 +29,164 @@ class InvalidParameter(ViewException):
     pass
 
 
+class RejectedParameter(InvalidParameter):
+    """A parameter outside the limits configured for the field"""
+
+    status = 400
+
+
+class RateLimitExceeded(ViewException):
+
+    status = 429
+
+    def __init__(self, message, retry_after):
+        super(RateLimitExceeded, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class Keyset(object):
+    """
+    The ordering key of a queryset, used for keyset (seek) pagination.
+
+    Instead of skipping ``offset`` rows, the next page is selected with a
+    filter on the ordering values of the last row of the previous page, so
+    that fetching page 400 costs the same as fetching page 1. The position is
+    passed back and forth as an opaque, signed ``next`` token.
+    """
+
+    salt = 'select2.views.Keyset'
+
+    def __init__(self, fields):
+        #: list of (model field, descending) tuples
+        self.fields = fields
+
+    @classmethod
+    def from_queryset(cls, queryset):
+        """
+        Returns the Keyset for the ordering of ``queryset``, or None if the
+        ordering cannot be used for seeking (random ordering, ordering on
+        expressions, related lookups or nullable columns).
+        """
+        opts = queryset.model._meta
+        query = queryset.query
+        if query.order_by:
+            ordering = query.order_by
+        elif query.default_ordering:
+            ordering = opts.ordering
+        else:
+            ordering = ()
+
+        fields = []
+        for name in ordering:
+            if not isinstance(name, str) or name == '?' or '__' in name:
+                return None
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            if name == 'pk':
+                model_field = opts.pk
+            else:
+                try:
+                    model_field = opts.get_field(name)
+                except FieldDoesNotExist:
+                    return None
+            if model_field.is_relation or model_field.null:
+                return None
+            fields.append((model_field, descending))
+
+        # The primary key is appended as a tie-breaker so that the ordering
+        # is total and no row is skipped or repeated between pages.
+        if opts.pk not in [f for f, descending in fields]:
+            fields.append((opts.pk, False))
+        return cls(fields)
+
+    @property
+    def ordering(self):
+        return ['%s%s' % ('-' if descending else '', f.attname)
+                for f, descending in self.fields]
+
+    @property
+    def attnames(self):
+        return [f.attname for f, descending in self.fields]
+
+    def encode(self, values):
+        """Returns the ``next`` token for a row with the ordering ``values``"""
+        return signing.dumps(
+            [v.isoformat() if hasattr(v, 'isoformat') else force_str(v) for v in values],
+            salt=self.salt, compress=True)
+
+    def decode(self, token):
+        try:
+            values = signing.loads(token, salt=self.salt)
+        except signing.BadSignature:
+            raise InvalidParameter("Invalid next '%s' passed" % token)
+        if not isinstance(values, list) or len(values) != len(self.fields):
+            raise InvalidParameter("Invalid next '%s' passed" % token)
+        try:
+            return [f.to_python(v) for (f, descending), v in zip(self.fields, values)]
+        except ValidationError:
+            raise InvalidParameter("Invalid next '%s' passed" % token)
+
+    def filter_after(self, values):
+        """
+        Returns a Q object matching the rows that sort after ``values``, i.e.
+        ``(a > x) OR (a = x AND b > y) OR ...``
+        """
+        q_obj = None
+        for i, (f, descending) in enumerate(self.fields):
+            clause = models.Q(**{
+                '%s__%s' % (f.attname, 'lt' if descending else 'gt'): values[i],
+            })
+            for j, (prev_field, _) in enumerate(self.fields[:i]):
+                clause &= models.Q(**{prev_field.attname: values[j]})
+            q_obj = clause if q_obj is None else (q_obj | clause)
+        return q_obj
+
+
+def estimate_count(queryset):
+    """
+    Returns the number of rows the database planner expects ``queryset`` to
+    return, or None if the database backend does not provide an estimate.
+    """
+    if connections[queryset.db].vendor != 'postgresql':
+        return None
+    plan = queryset.explain(format='json')
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    try:
+        return int(plan[0]['Plan']['Plan Rows'])
+    except (LookupError, TypeError, ValueError):
+        return None
+
+
 class JsonResponse(HttpResponse):
 
     callback = None
 
     def __init__(self, content='', callback=None, content_type="application/json", *args, **kwargs):
-        if not isinstance(content, str):
-            content = json.dumps(content)
+        if not isinstance(content, (bytes, str)):
+            content = encoders.dumps(content)
         if callback is not None:
             self.callback = callback
         if self.callback is not None:
-            content = u"%s(\n%s\n)" % (self.callback, content)
+            content = b"%s(\n%s\n)" % (force_bytes(self.callback), force_bytes(content))
             content_type = "text/javascript"
         return super(JsonResponse, self).__init__(content=content,
             content_type=content_type, *args, **kwargs)
 
 
+class StreamingJsonResponse(StreamingHttpResponse):
+    """A JsonResponse whose content is an iterator of encoded chunks"""
+
+    def __init__(self, streaming_content=(), callback=None, content_type="application/json",
+                 *args, **kwargs):
+        if callback is not None:
+            streaming_content = chain(
+                [b"%s(\n" % force_bytes(callback)], streaming_content, [b"\n)"])
+            content_type = "text/javascript"
+        super(StreamingJsonResponse, self).__init__(streaming_content,
+                                                    content_type=content_type, *args, **kwargs)
+
+
 class Select2View(object):
 
     def __init__(self, request, app_label, model_name, field_name):
@@ -46,171 +195,861 @@ class Select2View(object):
         self.model_name = model_name
         self.field_name = field_name
 
-    _field = None
+    _spec = None
+
+    def get_spec(self):
+        if self._spec is None:
+            self._spec = registry.get_spec(self.app_label, self.model_name, self.field_name)
+        return self._spec
 
     def get_field_and_model(self):
-        model_cls = apps.get_model(self.app_label, self.model_name)
-        if model_cls is None:
-            raise ViewException('Model %s.%s does not exist' % (self.app_label, self.model_name))
-        if self._field is None:
-            self._field = model_cls._meta.get_field(self.field_name)
-        return self._field, model_cls
+        spec = self.get_spec()
+        return spec.field, spec.model
 
     def get_response(self, data, **kwargs):
         callback = self.request.GET.get('callback', None)
-        if callback is None:
-            response_cls = JsonResponse
-        else:
-            response_cls = type('JsonpResponse', (JsonResponse,), {
-                'callback': callback,
-            })
-        return response_cls(data, **kwargs)
+        if isinstance(data, dict):
+            return JsonResponse(data, callback=callback, **kwargs)
+        return StreamingJsonResponse(data, callback=callback, **kwargs)
+
+    def get_error_response(self, e):
+        response = self.get_response({'error': str(e)}, status=getattr(e, 'status', 500))
+        if isinstance(e, RateLimitExceeded):
+            response['Retry-After'] = '%d' % math.ceil(e.retry_after)
+        return response
+
+    def get_client_key(self):
+        """
+        Returns the key that identifies the client for rate limiting: its
+        session if it has one, else its IP address
+        """
+        session_key = getattr(getattr(self.request, 'session', None), 'session_key', None)
+        if session_key:
+            return 'session:%s' % session_key
+        return 'ip:%s' % self.request.META.get('REMOTE_ADDR', '')
+
+    def get_rate_limit(self):
+        field = self.get_spec().field
+        if field.rate_limit is not None:
+            return field.rate_limit
+        return getattr(settings, 'SELECT2_RATE_LIMIT', None)
+
+    def check_rate_limit(self):
+        rate = self.get_rate_limit()
+        if not rate:
+            return
+        key = '%s:%s.%s.%s' % (
+            self.get_client_key(), self.app_label, self.model_name, self.field_name)
+        retry_after = ratelimit.acquire(key, rate)
+        if retry_after:
+            raise RateLimitExceeded("Rate limit exceeded", retry_after)
+
+    def get_min_search_length(self):
+        field = self.get_spec().field
+        if field.min_search_length is not None:
+            return field.min_search_length
+        return getattr(settings, 'SELECT2_MIN_SEARCH_LENGTH', 0)
+
+    def get_max_page_limit(self):
+        field = self.get_spec().field
+        if field.max_page_limit is not None:
+            return field.max_page_limit
+        return getattr(settings, 'SELECT2_MAX_PAGE_LIMIT', None)
+
+    _database = None
+    _recently_written = False
+
+    def get_database(self):
+        """
+        Returns the alias of the database to read results from, or None to
+        let the routers choose. Reads are sent to the primary database for
+        SELECT2_REPLICA_LAG seconds after the target model changes, so
+        that they include the change; routers are told so with the
+        ``select2_recently_written`` hint.
+        """
+        if self._database is None:
+            spec = self.get_spec()
+            using = cache.get_database(spec.field)
+            if cache.get_replica_lag():
+                cache.track_model(spec.target_model)
+                self._recently_written = cache.recently_written(spec.target_model)
+            if using is not None and self._recently_written:
+                using = router.db_for_write(spec.target_model)
+            self._database = using or ''
+        return self._database or None
+
+    def get_queryset(self):
+        using = self.get_database()
+        return self.get_spec().get_queryset(using, self._recently_written)
+
+    def filter_queryset(self, queryset):
+        return self.get_spec().filter_queryset(queryset)
 
-    def get_data(self, queryset, page=None, page_limit=None):
+    _choices_key = None
+
+    def get_choices_key(self):
+        """
+        Returns the part of cache keys that identifies the choices of the
+        field, with its limit_choices_to and queryset hook (see
+        cache.get_queryset_key)
+        """
+        if self._choices_key is None:
+            self._choices_key = cache.get_queryset_key(self.filter_queryset(self.get_queryset()))
+        return self._choices_key
+
+    def get_count_mode(self):
         field, model_cls = self.get_field_and_model()
+        return field.count_mode or getattr(settings, 'SELECT2_COUNT_MODE', 'exact')
 
-        # Check for the existences of a callable %s_queryset method on the
-        # model class and use it to filter the Select2 queryset.
-        #
-        # This is useful for model inheritance where the limit_choices_to can
-        # not easily be overriden in child classes.
-        model_queryset_method = '%s_queryset' % field.name
-        if callable(getattr(model_cls, model_queryset_method, None)):
-            queryset = getattr(model_cls, model_queryset_method)(queryset)
+    def get_coalesce_mode(self):
+        field, model_cls = self.get_field_and_model()
+        return field.coalesce or getattr(settings, 'SELECT2_COALESCE', 'process')
 
-        formfield = field.formfield()
-        total_count = None
-        if page is not None and page_limit is not None:
-            total_count = queryset.count()
-            offset = (page - 1) * page_limit
-            end = offset + page_limit
-            queryset = queryset[offset:end]
+    def get_page_queryset(self, queryset, page=None, page_limit=None, cursor=None):
+        """
+        Returns a ``(queryset, page_queryset, keyset, offset)`` tuple of the
+        filtered queryset to count, the queryset of the rows of the requested
+        page (plus one), the Keyset used to paginate, if any, and the offset
+        of the page.
+        """
+        field, model_cls = self.get_field_and_model()
+        queryset = self.filter_queryset(queryset)
+
+        keyset = None
+        if page_limit is not None and field.pagination == 'keyset':
+            keyset = Keyset.from_queryset(queryset)
+            if keyset is not None:
+                queryset = queryset.order_by(*keyset.ordering)
+        if cursor is not None and keyset is None:
+            raise InvalidParameter("Invalid next '%s' passed" % cursor)
+
+        if page_limit is None:
+            return queryset, queryset, keyset, 0
+        if cursor is not None:
+            page_queryset = queryset.filter(keyset.filter_after(keyset.decode(cursor)))
+            offset = 0
         else:
-            offset = None
+            page_queryset = queryset
+            offset = (page - 1) * page_limit
+        # Fetch one row past the end of the page to determine whether
+        # there are more results
+        return queryset, page_queryset[offset:offset + page_limit + 1], keyset, offset
 
-        formfield.queryset = queryset
-        iterator = ModelChoiceIterator(formfield)
+    def get_total_count(self, queryset, page_limit=None):
+        if page_limit is None:
+            return None
+        count_mode = self.get_count_mode()
+        if count_mode == 'exact':
+            return queryset.count()
+        elif count_mode == 'estimate':
+            return estimate_count(queryset)
+        return None
 
-        if offset is None:
-            total_count = len(iterator)
-            more = False
+    def is_concurrent_count(self, queryset, page_limit=None):
+        """
+        Whether the total count of ``queryset`` is computed on a worker
+        thread while the page is read
+        """
+        field, model_cls = self.get_field_and_model()
+        if field.concurrent_count is not None:
+            enabled = field.concurrent_count
         else:
-            paged_count = offset + len(iterator)
-            more = bool(paged_count < total_count)
+            enabled = getattr(settings, 'SELECT2_CONCURRENT_COUNT', False)
+        if not enabled or page_limit is None or self.get_count_mode() == 'none':
+            return False
+        return workers.can_submit(queryset.db)
+
+    def get_data(self, queryset, page=None, page_limit=None, cursor=None):
+        field, model_cls = self.get_field_and_model()
+        queryset, page_queryset, keyset, offset = self.get_page_queryset(
+            queryset, page, page_limit, cursor)
+        if self.is_concurrent_count(queryset, page_limit):
+            future = workers.submit(
+                lambda: self.get_total_count(queryset, page_limit), queryset.db)
+            choices = list(field.iter_choices(page_queryset, keyset.attnames if keyset else ()))
+            total_count = future.result()
+        else:
+            total_count = self.get_total_count(queryset, page_limit)
+            choices = list(field.iter_choices(page_queryset, keyset.attnames if keyset else ()))
+        return self.format_data(choices, total_count, keyset, offset, page_limit, cursor)
+
+    def get_data_stream(self, queryset, page=None, page_limit=None, cursor=None):
+        """
+        Returns an iterator of the chunks of the JSON encoding of the data
+        returned by get_data(), which encodes each result as it is read from
+        the database. Invalid parameters are raised before it is returned.
+        """
+        field, model_cls = self.get_field_and_model()
+        queryset, page_queryset, keyset, offset = self.get_page_queryset(
+            queryset, page, page_limit, cursor)
+        total_count = self.get_total_count(queryset, page_limit)
+        choices = field.iter_choices(
+            page_queryset, keyset.attnames if keyset else (), iterator=True)
+        return self.iter_data_chunks(choices, total_count, keyset, offset, page_limit, cursor)
+
+    def iter_data_chunks(self, choices, total_count, keyset, offset, page_limit, cursor):
+        dumps = encoders.get_encoder()
+        yield b'{"results":['
+        num_choices = 0
+        last_choice = None
+        more = False
+        for choice in choices:
+            if page_limit is not None and num_choices == page_limit:
+                more = True
+                break
+            value, label, keyset_values = choice
+            chunk = dumps({'id': value, 'text': label})
+            yield b',' + chunk if num_choices else chunk
+            num_choices += 1
+            last_choice = choice
+        page_data = self.get_page_data(
+            num_choices, last_choice, more, total_count, keyset, offset, page_limit, cursor)
+        # The remaining keys of the page data object
+        yield b'],' + dumps(page_data)[1:]
+
+    async def aget_data(self, queryset, page=None, page_limit=None, cursor=None):
+        """
+        The async version of get_data(), which requires Django 4.1 or later
+        """
+        from asgiref.sync import sync_to_async
+
+        field, model_cls = self.get_field_and_model()
+        queryset, page_queryset, keyset, offset = self.get_page_queryset(
+            queryset, page, page_limit, cursor)
+
+        if await sync_to_async(self.is_concurrent_count)(queryset, page_limit):
+            future = workers.submit(
+                lambda: self.get_total_count(queryset, page_limit), queryset.db)
+            choices = [c async for c in field.aiter_choices(
+                page_queryset, keyset.attnames if keyset else ())]
+            total_count = await asyncio.wrap_future(future)
+            return self.format_data(choices, total_count, keyset, offset, page_limit, cursor)
+
+        count_mode = self.get_count_mode()
+        total_count = None
+        if page_limit is not None:
+            if count_mode == 'exact':
+                total_count = await queryset.acount()
+            elif count_mode == 'estimate':
+                total_count = await sync_to_async(estimate_count)(queryset)
+
+        choices = [c async for c in field.aiter_choices(
+            page_queryset, keyset.attnames if keyset else ())]
+        return self.format_data(choices, total_count, keyset, offset, page_limit, cursor)
+
+    def format_data(self, choices, total_count, keyset, offset, page_limit, cursor):
+        more = page_limit is not None and len(choices) > page_limit
+        if more:
+            choices = choices[:page_limit]
+        data = self.get_page_data(
+            len(choices), choices[-1] if choices else None, more, total_count,
+            keyset, offset, page_limit, cursor)
+        data['results'] = [{
+            'id': value,
+            'text': label,
+        } for value, label, keyset_values in choices]
+        return data
+
+    def get_page_data(self, num_choices, last_choice, more, total_count, keyset,
+                      offset, page_limit, cursor):
+        """
+        Returns the data of a page of ``num_choices`` results other than the
+        results themselves: ``total``, ``more`` and ``next``
+        """
+        count_mode = self.get_count_mode()
+        if page_limit is None:
+            total_count = num_choices
 
         data = {
             'total': total_count,
             'more': more,
-            'results': [],
         }
-        for value, label in iterator:
-            if value is u'':
-                continue
-            
-            if ModelChoiceIteratorValue and isinstance(value, ModelChoiceIteratorValue):
-                # ModelChoiceIteratorValue was added in Django 3.1
-                value = value.value
-
-            data['results'].append({
-                'id': value,
-                'text': label,
-            })
+        if count_mode != 'exact' and page_limit is not None:
+            if not more and cursor is None:
+                # On the last page the total is known without counting
+                data['total'] = offset + num_choices
+            elif total_count is None:
+                del data['total']
+            else:
+                data['total_approximate'] = True
+        if more and keyset is not None:
+            data['next'] = keyset.encode(last_choice[2])
         return data
 
-    def init_selection(self):
+    def parse_fetch_params(self):
+        """
+        Returns the ``(q, page, page_limit, cursor)`` parameters of a
+        fetch_items request
+        """
+        q = self.request.GET.get('q', None)
+        page_limit = self.request.GET.get('page_limit', 10)
+        page = self.request.GET.get('page', 1)
+        cursor = self.request.GET.get('next') or None
+
+        if q is None:
+            raise InvalidParameter("q parameter required")
+        min_search_length = self.get_min_search_length()
+        if len(q.strip()) < min_search_length:
+            raise RejectedParameter(
+                "q must be at least %d characters long" % min_search_length)
         try:
-            field, model_cls = self.get_field_and_model()
-        except ViewException as e:
-            return self.get_response({'error': str(e)}, status=500)
+            page_limit = int(page_limit)
+        except (TypeError, ValueError):
+            raise InvalidParameter("Invalid page_limit '%s' passed" % page_limit)
+        else:
+            if page_limit < 1:
+                raise InvalidParameter("Invalid page_limit '%s' passed" % page_limit)
+        max_page_limit = self.get_max_page_limit()
+        if max_page_limit is not None and page_limit > max_page_limit:
+            raise RejectedParameter("page_limit must be at most %d" % max_page_limit)
 
-        q = self.request.GET.get('q', None)
         try:
-            if q is None:
-                raise InvalidParameter("q parameter required")
-            pks = q.split(u',')
-            try:
-                pks = [int(pk) for pk in pks]
-            except TypeError:
-                raise InvalidParameter("q parameter must be comma separated "
-                                       "list of integers")
-        except InvalidParameter as e:
-            return self.get_response({'error': str(e)}, status=500)
+            page = int(page)
+        except (TypeError, ValueError):
+            raise InvalidParameter("Invalid page '%s' passed" % page)
+        else:
+            if page < 1:
+                raise InvalidParameter("Invalid page '%s' passed" % page)
+        return q, page, page_limit, cursor
 
-        queryset = field.queryset.filter(**{
-            (u'%s__in' % compat_rel(field).get_related_field().name): pks,
-        }).distinct()
-        pk_ordering = dict([(force_str(pk), i) for i, pk in enumerate(pks)])
+    def parse_selection(self, q):
+        """Returns the list of primary keys in the comma separated ``q``"""
+        if q is None:
+            raise InvalidParameter("q parameter required")
+        try:
+            return [int(pk) for pk in q.split(u',')]
+        except (TypeError, ValueError):
+            raise InvalidParameter("q parameter must be comma separated "
+                                   "list of integers")
+
+    def get_selection_queryset(self, pks):
+        spec = self.get_spec()
+        queryset = self.get_queryset().filter(**{
+            (u'%s__in' % spec.related_field.name): pks,
+        })
+        # Rows can only be repeated by joins to multi-valued relations, from
+        # limit_choices_to or the queryset hook
+        if len(self.filter_queryset(queryset).query.alias_map) > 1:
+            queryset = queryset.distinct()
+        return queryset
+
+    def get_selection_batch_size(self):
+        return getattr(settings, 'SELECT2_SELECTION_BATCH_SIZE', 500)
 
-        data = self.get_data(queryset)
+    def iter_selection_batches(self, pks):
+        """Yields the distinct ``pks`` in lists of at most the batch size"""
+        pks = list(dict.fromkeys(pks))
+        batch_size = self.get_selection_batch_size()
+        for start in range(0, len(pks), batch_size):
+            yield pks[start:start + batch_size]
+
+    def iter_selection_choices(self, pks):
+        """
+        Yields the ``(value, label, extra_values)`` choices of the ``pks``
+        that exist, in the order of ``pks``. The choices are looked up in
+        batches, so that neither the number of query parameters nor the
+        memory used grows with the number of ``pks``.
+        """
+        field, model_cls = self.get_field_and_model()
+        for batch in self.iter_selection_batches(pks):
+            queryset = self.filter_queryset(self.get_selection_queryset(batch))
+            choices = dict([
+                (force_str(choice[0]), choice) for choice in field.iter_choices(queryset)])
+            for pk in batch:
+                choice = choices.get(force_str(pk))
+                if choice is not None:
+                    yield choice
+
+    async def aiter_selection_choices(self, pks):
+        """The async version of iter_selection_choices()"""
+        field, model_cls = self.get_field_and_model()
+        for batch in self.iter_selection_batches(pks):
+            queryset = self.filter_queryset(self.get_selection_queryset(batch))
+            choices = dict([
+                (force_str(choice[0]), choice) async for choice in field.aiter_choices(queryset)])
+            for pk in batch:
+                choice = choices.get(force_str(pk))
+                if choice is not None:
+                    yield choice
+
+    def get_selection_data(self, choices, pks, multiple=None):
+        data = self.format_data(list(choices), None, None, 0, None, None)
+        data['results'] = self.format_selection(data['results'], pks, multiple)
+        return data
+
+    def iter_selection_chunks(self, choices, multiple=None):
+        """
+        Yields the chunks of the JSON encoding of the init_selection data of
+        ``choices``, which are in the order of the selection
+        """
+        dumps = encoders.get_encoder()
+        first = None
+        num_choices = 0
+        for value, label, extra_values in choices:
+            chunk = dumps({'id': value, 'text': label})
+            num_choices += 1
+            # A single result may be returned on its own, so the first one
+            # is held back until the second is read
+            if num_choices == 1:
+                first = chunk
+                continue
+            if num_choices == 2:
+                yield b'{"results":[' + first
+            yield b',' + chunk
+        if num_choices == 0:
+            yield b'{"results":[]'
+        elif num_choices == 1:
+            yield b'{"results":' + (b'[%s]' % first if self.is_multiple(multiple) else first)
+        else:
+            yield b']'
+        page_data = self.get_page_data(num_choices, None, False, None, None, 0, None, None)
+        yield b',' + dumps(page_data)[1:]
+
+    def get_selection_group_key(self):
+        """
+        Returns a key that is shared by all fields whose selections can be
+        looked up with the same query (see init_selection_batch).
+        """
+        spec = self.get_spec()
+        queryset_hook = None
+        if spec.queryset_hook is not None:
+            queryset_hook = (spec.model, spec.field.name)
+        try:
+            sql = str(self.filter_queryset(self.get_queryset()).query)
+        except EmptyResultSet:
+            sql = None
+        return (
+            spec.target_model, spec.related_field.name, sql, queryset_hook,
+            self.get_database(), spec.field.get_label_key())
+
+    def format_selection(self, results, pks, multiple=None):
+        field, model_cls = self.get_field_and_model()
 
         # Make sure we return in the same order we were passed
+        pk_ordering = dict([(force_str(pk), i) for i, pk in enumerate(pks)])
+
         def results_sort_callback(item):
             pk = force_str(item['id'])
             return pk_ordering[pk]
-        data['results'] = sorted(data['results'], key=results_sort_callback)
-
-        if len(data['results']) == 1:
-            is_multiple = isinstance(field, ManyToManyField)
-            try:
-                multiple_param = int(self.request.GET.get('multiple'))
-            except (TypeError, ValueError):
-                pass
-            else:
-                is_multiple = (multiple_param == 1)
-            if not is_multiple:
-                data['results'] = data['results'][0]
+        results = sorted(results, key=results_sort_callback)
 
-        return self.get_response(data)
+        if len(results) == 1 and not self.is_multiple(multiple):
+            return results[0]
+        return results
 
-    def fetch_items(self):
+    def is_multiple(self, multiple=None):
+        """
+        Whether a selection of a single result is returned as a list, per
+        the ``multiple`` request parameter or else the type of the field
+        """
+        field, model_cls = self.get_field_and_model()
         try:
-            field, model_cls = self.get_field_and_model()
-        except ViewException as e:
-            return self.get_response({'error': str(e)}, status=500)
+            return int(multiple) == 1
+        except (TypeError, ValueError):
+            return isinstance(field, ManyToManyField)
 
-        queryset = copy.deepcopy(field.queryset)
+    def get_etag(self):
+        """
+        Returns the ETag of the response to the request, built from the
+        generation of the target model (see select2.cache) and the request
+        parameters, or None if ETags are not enabled for the field
+        """
+        spec = self.get_spec()
+        if not cache.etags_enabled(spec.field):
+            return None
+        cache.track_model(spec.target_model)
+        # Leave out the cache-busting parameter added by jQuery
+        params = sorted([(k, v) for k, v in self.request.GET.lists() if k != '_'])
+        key = cache.make_key(
+            'etag', spec.target_model, self.request.path, params, self.get_choices_key())
+        return quote_etag(hashlib.md5(key.encode('utf-8')).hexdigest())
 
-        q = self.request.GET.get('q', None)
-        page_limit = self.request.GET.get('page_limit', 10)
-        page = self.request.GET.get('page', 1)
+    def get_not_modified_response(self, etag):
+        """
+        Returns a 304 response if the client's copy of the response is
+        current, else None
+        """
+        if etag is None:
+            return None
+        response = get_conditional_response(self.request, etag=etag)
+        if response is not None:
+            self.patch_cache_headers(response, etag)
+        return response
+
+    def patch_cache_headers(self, response, etag=None):
+        if etag is not None:
+            response['ETag'] = etag
+        max_age = cache.get_max_age(self.get_spec().field)
+        if max_age:
+            patch_cache_control(response, max_age=max_age)
+        elif etag is not None:
+            # Clients may store the response, but must revalidate it
+            patch_cache_control(response, no_cache=True)
+        return response
 
+    def init_selection(self):
         try:
-            if q is None:
-                raise InvalidParameter("q parameter required")
-            try:
-                page_limit = int(page_limit)
-            except TypeError:
-                raise InvalidParameter("Invalid page_limit '%s' passed" % page_limit)
-            else:
-                if page_limit < 1:
-                    raise InvalidParameter("Invalid page_limit '%s' passed" % page_limit)
+            self.get_spec()
+            self.check_rate_limit()
+            pks = self.parse_selection(self.request.GET.get('q', None))
+        except (LookupError, FieldDoesNotExist, ViewException) as e:
+            return self.get_error_response(e)
 
-            try:
-                page = int(page)
-            except TypeError:
-                raise InvalidParameter("Invalid page '%s' passed")
+        etag = self.get_etag()
+        response = self.get_not_modified_response(etag)
+        if response is not None:
+            return response
+
+        multiple = self.request.GET.get('multiple')
+        choices = self.iter_selection_choices(pks)
+        if self.is_streaming() or len(pks) > self.get_selection_batch_size():
+            data = self.iter_selection_chunks(choices, multiple)
+        else:
+            data = self.get_selection_data(choices, pks, multiple)
+        return self.patch_cache_headers(self.get_response(data), etag)
+
+    def recent_choices(self):
+        """
+        Returns the recent choices of the requesting user (see
+        select2.recent), which are private to the user and need no search
+        term. Anonymous users have none.
+        """
+        try:
+            spec = self.get_spec()
+            self.check_rate_limit()
+        except (LookupError, FieldDoesNotExist, ViewException) as e:
+            return self.get_error_response(e)
+
+        results = []
+        user = getattr(self.request, 'user', None)
+        if user is not None and user.is_authenticated and recent.get_size(spec.field):
+            cache.track_model(spec.target_model)
+            results = recent.get_results(
+                user, spec.model, spec.field, self.iter_selection_choices)
+        response = self.get_response({'results': results, 'more': False})
+        patch_cache_control(response, private=True)
+        return response
+
+    def get_cache_key(self, q, page, page_limit, cursor=None):
+        spec = self.get_spec()
+        q = spec.search_backend.normalize_term(q, spec.field)
+        return cache.make_key(
+            'results', spec.target_model, self.app_label, self.model_name,
+            self.field_name, q, page, page_limit, cursor, self.get_choices_key())
+
+    def get_subsume_attname(self):
+        """
+        Returns the attname of the target model column that the search
+        backend matches in Python, or None if searches for the field can not
+        be answered from the complete results of a shorter term
+        """
+        spec = self.get_spec()
+        if not cache.subsume_enabled(spec.field):
+            return None
+        name = spec.search_backend.get_match_field(spec.field)
+        if name is None:
+            return None
+        try:
+            model_field = spec.target_model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if model_field.is_relation or not model_field.concrete:
+            return None
+        return model_field.attname
+
+    def get_complete_key(self, q, generation=None):
+        spec = self.get_spec()
+        return cache.make_key(
+            'complete', spec.target_model, self.app_label, self.model_name,
+            self.field_name, q, self.get_choices_key(), generation=generation)
+
+    def get_complete_data(self, queryset, q, page_limit, attname):
+        """
+        get_data() for the first page of the results of the normalized term
+        ``q``. If the page holds every result, the results and their
+        ``attname`` values are cached as the complete results of ``q``.
+        """
+        field, model_cls = self.get_field_and_model()
+        # Built before the query, so that changes made while it runs
+        # invalidate its results
+        complete_key = self.get_complete_key(q)
+        queryset, page_queryset, keyset, offset = self.get_page_queryset(
+            queryset, 1, page_limit)
+        extra_fields = (keyset.attnames if keyset else []) + [attname]
+        choices = [
+            (value, label, tuple(extra_values[:-1]), extra_values[-1])
+            for value, label, extra_values in field.iter_choices(page_queryset, extra_fields)]
+        if len(choices) <= page_limit:
+            cache.get_cache().set(complete_key, choices, cache.get_timeout())
+            # The total is known without counting
+            total_count = len(choices) if self.get_count_mode() == 'exact' else None
+        else:
+            total_count = self.get_total_count(queryset, page_limit)
+        choices = [choice[:3] for choice in choices]
+        return self.format_data(choices, total_count, keyset, offset, page_limit, None)
+
+    def get_subsumed_data(self, q, page, page_limit):
+        """
+        Returns the fetch_items data for the normalized term ``q`` filtered
+        from the complete results of the longest term that ``q`` starts
+        with, or None if none are cached. Every result of ``q`` is among
+        the results of such a term.
+        """
+        spec = self.get_spec()
+        generation = cache.get_generation(spec.target_model)
+        keys = [self.get_complete_key(q[:n], generation) for n in range(len(q), -1, -1)]
+        found = cache.get_cache().get_many(keys)
+        complete = next((found[key] for key in keys if key in found), None)
+        if complete is None:
+            return None
+        choices = [
+            (value, label, keyset_values)
+            for value, label, keyset_values, match_value in complete
+            if spec.search_backend.match(match_value, q, spec.field)]
+        # Only the keyset and offset are used; no query is run
+        queryset, page_queryset, keyset, offset = self.get_page_queryset(
+            self.get_queryset(), page, page_limit)
+        total_count = len(choices) if self.get_count_mode() == 'exact' else None
+        return self.format_data(
+            choices[offset:offset + page_limit + 1], total_count, keyset, offset,
+            page_limit, None)
+
+    def get_browse_key(self, page_limit):
+        spec = self.get_spec()
+        return cache.make_key(
+            'browse', spec.target_model, self.app_label, self.model_name,
+            self.field_name, page_limit, self.get_choices_key())
+
+    def get_browse_pages(self, page_limit, cache_key=None):
+        """
+        Returns the list of the fetch_items data of the leading pages of
+        the results of the empty term, fetched with a single query (and a
+        single count), and stores it in the cache under ``cache_key``. The
+        list stops at the last page if there are fewer results.
+        """
+        spec = self.get_spec()
+        field = spec.field
+        num_pages = cache.get_browse_pages(field)
+        queryset = spec.search_backend.filter(self.get_queryset(), '', field)
+        queryset, page_queryset, keyset, offset = self.get_page_queryset(
+            queryset, 1, num_pages * page_limit)
+        total_count = self.get_total_count(queryset, page_limit)
+        choices = list(field.iter_choices(page_queryset, keyset.attnames if keyset else ()))
+        pages = []
+        for start in range(0, num_pages * page_limit, page_limit):
+            data = self.format_data(
+                choices[start:start + page_limit + 1], total_count, keyset, start,
+                page_limit, None)
+            pages.append(data)
+            if not data['more']:
+                break
+        if cache_key is not None:
+            cache.get_cache().set(cache_key, pages, cache.get_timeout())
+        return pages
+
+    def get_browse_data(self, page, page_limit, cursor=None):
+        """
+        Returns the fetch_items data of a page of the results of the empty
+        term from the cached leading pages, or None if it is not one of them
+        """
+        spec = self.get_spec()
+        cache.track_model(spec.target_model)
+        cache_key = self.get_browse_key(page_limit)
+        pages = cache.get_cache().get(cache_key)
+        if pages is None:
+            coalesce = self.get_coalesce_mode()
+            if coalesce == 'none':
+                pages = self.get_browse_pages(page_limit, cache_key)
             else:
-                if page < 1:
-                    raise InvalidParameter("Invalid page '%s' passed")
-        except InvalidParameter as e:
-            return self.get_response({'error': str(e)}, status=500)
+                pages = singleflight.do(
+                    cache_key, lambda: self.get_browse_pages(page_limit, cache_key),
+                    shared=coalesce == 'cache')
+        return self.find_browse_page(pages, page, cursor)
 
-        search_field = field.search_field
-        if callable(search_field):
-            search_field = search_field(q)
-        if isinstance(search_field, models.Q):
-            q_obj = search_field
+    def find_browse_page(self, pages, page, cursor=None):
+        if cursor is None:
+            index = page - 1
         else:
-            qset_contains_filter_key = '%(search_field)s__%(insensitive)scontains' % {
-                'search_field': search_field,
-                'insensitive': 'i' if not field.case_sensitive else '',
-            }
-            q_obj = models.Q(**{qset_contains_filter_key: q})
+            # With keyset pagination, the page that follows the page whose
+            # next token is the cursor
+            index = next((
+                i + 1 for i, data in enumerate(pages) if data.get('next') == cursor), None)
+        if index is None or index >= len(pages):
+            return None
+        return pages[index]
 
-        queryset = queryset.filter(q_obj)
+    def record_term(self, q, seconds):
+        """Records the search for ``q`` in the term statistics of the field"""
+        spec = self.get_spec()
+        if not analytics.is_enabled(spec.field):
+            return
+        analytics.record(
+            '.'.join(registry.get_key(spec.model, spec.field.name)),
+            spec.search_backend.normalize_term(q, spec.field), seconds)
 
-        data = self.get_data(queryset, page, page_limit)
-        return self.get_response(data)
+    def is_streaming(self):
+        field = self.get_spec().field
+        if field.streaming is not None:
+            return field.streaming
+        return getattr(settings, 'SELECT2_STREAMING', False)
+
+    def get_items(self, q, page, page_limit, cursor=None):
+        """
+        Returns the fetch_items data for a search, or an iterator of its
+        encoded chunks for fields with streaming enabled
+        """
+        spec = self.get_spec()
+        field = spec.field
+        if field.search_index:
+            index = search_index.get_index(
+                field, lambda: spec.filter_queryset(self.get_queryset()))
+            return index.get_data(q, page, page_limit)
+
+        if q == '' and cache.get_browse_pages(field):
+            data = self.get_browse_data(page, page_limit, cursor)
+            if data is not None:
+                return data
+
+        cache_key = None
+        if cache.is_enabled(field):
+            cache.track_model(spec.target_model)
+            cache_key = self.get_cache_key(q, page, page_limit, cursor)
+            data = cache.get_cache().get(cache_key)
+            if data is not None:
+                return data
+            coalesce = self.get_coalesce_mode()
+            if coalesce != 'none':
+                return singleflight.do(
+                    cache_key,
+                    lambda: self.get_uncached_items(q, page, page_limit, cursor, cache_key),
+                    shared=coalesce == 'cache')
+        return self.get_uncached_items(q, page, page_limit, cursor, cache_key)
+
+    def get_uncached_items(self, q, page, page_limit, cursor=None, cache_key=None):
+        """
+        Computes the data returned by get_items(), and stores it in the
+        result cache under ``cache_key``, if given
+        """
+        spec = self.get_spec()
+        field = spec.field
+        queryset = spec.search_backend.filter(self.get_queryset(), q, field)
+        data = None
+        attname = None
+        if cache_key is not None and cursor is None:
+            attname = self.get_subsume_attname()
+        if attname is not None:
+            term = spec.search_backend.normalize_term(q, field)
+            data = self.get_subsumed_data(term, page, page_limit)
+            if data is None and page == 1:
+                data = self.get_complete_data(queryset, term, page_limit, attname)
+        if data is None:
+            if cache_key is None and self.is_streaming():
+                return self.get_data_stream(queryset, page, page_limit, cursor=cursor)
+            data = self.get_data(queryset, page, page_limit, cursor=cursor)
+        if cache_key is not None:
+            cache.get_cache().set(cache_key, data, cache.get_timeout())
+        return data
+
+    def fetch_items(self):
+        try:
+            self.get_spec()
+            self.check_rate_limit()
+            q, page, page_limit, cursor = self.parse_fetch_params()
+        except (LookupError, FieldDoesNotExist, ViewException) as e:
+            return self.get_error_response(e)
+
+        etag = self.get_etag()
+        response = self.get_not_modified_response(etag)
+        if response is not None:
+            return response
+
+        start = time.perf_counter()
+        try:
+            data = self.get_items(q, page, page_limit, cursor)
+        except InvalidParameter as e:
+            return self.get_error_response(e)
+        self.record_term(q, time.perf_counter() - start)
+        return self.patch_cache_headers(self.get_response(data), etag)
+
+    async def ainit_selection(self):
+        from asgiref.sync import sync_to_async
+
+        try:
+            self.get_spec()
+            await sync_to_async(self.check_rate_limit)()
+            pks = self.parse_selection(self.request.GET.get('q', None))
+        except (LookupError, FieldDoesNotExist, ViewException) as e:
+            return self.get_error_response(e)
+        await sync_to_async(self.get_database)()
+
+        etag = await sync_to_async(self.get_etag)()
+        response = self.get_not_modified_response(etag)
+        if response is not None:
+            return response
+
+        choices = [choice async for choice in self.aiter_selection_choices(pks)]
+        data = self.get_selection_data(choices, pks, self.request.GET.get('multiple'))
+        return self.patch_cache_headers(self.get_response(data), etag)
+
+    async def aget_items(self, q, page, page_limit, cursor=None):
+        """The async version of get_items()"""
+        from asgiref.sync import sync_to_async
+
+        spec = self.get_spec()
+        field = spec.field
+        if field.search_index:
+            index = await sync_to_async(search_index.get_index)(
+                field, lambda: spec.filter_queryset(self.get_queryset()))
+            return index.get_data(q, page, page_limit)
+
+        if q == '' and cache.get_browse_pages(field):
+            data = await sync_to_async(self.get_browse_data)(page, page_limit, cursor)
+            if data is not None:
+                return data
+
+        cache_key = None
+        if cache.is_enabled(field):
+            cache.track_model(spec.target_model)
+            cache_key = await sync_to_async(self.get_cache_key)(q, page, page_limit, cursor)
+            data = await cache.get_cache().aget(cache_key)
+            if data is not None:
+                return data
+
+        data = None
+        if cache_key is not None and cursor is None and self.get_subsume_attname() is not None:
+            # Complete results are only cached by get_items()
+            data = await sync_to_async(self.get_subsumed_data)(
+                spec.search_backend.normalize_term(q, field), page, page_limit)
+        if data is None:
+            queryset = spec.search_backend.filter(self.get_queryset(), q, field)
+            data = await self.aget_data(queryset, page, page_limit, cursor=cursor)
+        if cache_key is not None:
+            await cache.get_cache().aset(cache_key, data, cache.get_timeout())
+        return data
+
+    async def afetch_items(self):
+        from asgiref.sync import sync_to_async
+
+        try:
+            self.get_spec()
+            await sync_to_async(self.check_rate_limit)()
+            q, page, page_limit, cursor = self.parse_fetch_params()
+        except (LookupError, FieldDoesNotExist, ViewException) as e:
+            return self.get_error_response(e)
+        await sync_to_async(self.get_database)()
+
+        etag = await sync_to_async(self.get_etag)()
+        response = self.get_not_modified_response(etag)
+        if response is not None:
+            return response
+
+        start = time.perf_counter()
+        try:
+            data = await self.aget_items(q, page, page_limit, cursor)
+        except InvalidParameter as e:
+            return self.get_error_response(e)
+        await sync_to_async(self.record_term)(q, time.perf_counter() - start)
+        return self.patch_cache_headers(self.get_response(data), etag)
 
 
 def init_selection(request, app_label, model_name, field_name):
@@ -221,3 +1060,104 @@ def init_selection(request, app_label, model_name, field_name):
 def fetch_items(request, app_label, model_name, field_name):
     view_cls = Select2View(request, app_label, model_name, field_name)
     return view_cls.fetch_items()
+
+
+def recent_choices(request, app_label, model_name, field_name):
+    view_cls = Select2View(request, app_label, model_name, field_name)
+    return view_cls.recent_choices()
+
+
+async def ainit_selection(request, app_label, model_name, field_name):
+    view_cls = Select2View(request, app_label, model_name, field_name)
+    return await view_cls.ainit_selection()
+
+
+async def afetch_items(request, app_label, model_name, field_name):
+    view_cls = Select2View(request, app_label, model_name, field_name)
+    return await view_cls.afetch_items()
+
+
+@require_POST
+def init_selection_batch(request):
+    """
+    Looks up the initial selections of many widgets at once.
+
+    The request body is a JSON object of the form::
+
+        {"selections": [
+            {"key": "0", "app_label": "myapp", "model_name": "entry",
+             "field_name": "authors", "q": "1,2", "multiple": 1},
+            ...
+        ]}
+
+    Lookups that can share a query (same target model, queryset SQL and
+    labels) are grouped together, so that a change form with many
+    inlines needs one query per target model rather than one per widget.
+    The response holds the results of each selection under its key, and an
+    error message for any selection that could not be looked up.
+
+    Each selection counts as one request against the rate limit of its
+    field, and a request with more than ``SELECT2_BATCH_MAX_SELECTIONS``
+    selections (100 by default) or ``SELECT2_BATCH_MAX_IDS`` ids in total
+    (5000 by default) is rejected.
+    """
+    try:
+        selections = json.loads(request.body.decode('utf-8'))['selections']
+    except (ValueError, KeyError, TypeError):
+        selections = None
+    if not isinstance(selections, list):
+        return JsonResponse({
+            'error': "request body must be a JSON object with a 'selections' list",
+        }, status=500)
+    max_selections = getattr(settings, 'SELECT2_BATCH_MAX_SELECTIONS', 100)
+    if max_selections is not None and len(selections) > max_selections:
+        return JsonResponse({
+            'error': "at most %d selections can be looked up at once" % max_selections,
+        }, status=400)
+    max_ids = getattr(settings, 'SELECT2_BATCH_MAX_IDS', 5000)
+
+    results = {}
+    errors = {}
+    groups = {}
+    num_ids = 0
+    for selection in selections:
+        if not isinstance(selection, dict) or 'key' not in selection:
+            continue
+        key = force_str(selection['key'])
+        view = Select2View(
+            request, selection.get('app_label'), selection.get('model_name'),
+            selection.get('field_name'))
+        try:
+            pks = view.parse_selection(selection.get('q'))
+            view.check_rate_limit()
+            group_key = view.get_selection_group_key()
+        except RateLimitExceeded as e:
+            return view.get_error_response(e)
+        except (ViewException, LookupError, FieldDoesNotExist) as e:
+            errors[key] = str(e)
+            continue
+        num_ids += len(pks)
+        if max_ids is not None and num_ids > max_ids:
+            return JsonResponse({
+                'error': "at most %d ids can be looked up at once" % max_ids,
+            }, status=400)
+        groups.setdefault(group_key, []).append((key, view, pks, selection.get('multiple')))
+
+    for group in groups.values():
+        group_pks = set()
+        for key, view, pks, multiple in group:
+            group_pks.update(pks)
+        group_view = group[0][1]
+        results_by_pk = dict([
+            (force_str(value), {'id': value, 'text': label})
+            for value, label, extra_values in group_view.iter_selection_choices(list(group_pks))])
+        for key, view, pks, multiple in group:
+            selection_results = [
+                results_by_pk[force_str(pk)] for pk in pks
+                if force_str(pk) in results_by_pk]
+            results[key] = view.format_selection(selection_results, pks, multiple)
+
+    data = {'results': results}
+    if errors:
+        data['errors'] = errors
+    return JsonResponse(data)
@@ -2,7 +2,9 @@ from itertools import chain
 import json
 
 import django
-from django.urls import reverse
+from django.core.exceptions import FieldDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.urls import NoReverseMatch, reverse
 from django.forms import widgets
 from django.forms.utils import flatatt
 from django.utils.datastructures import MultiValueDict
@@ -43,6 +45,7 @@ class Select(widgets.Input):
         'ajax_quiet_millis': 'quietMillis',
         'quiet_millis': 'quietMillis',
         'data_type': 'dataType',
+        'local_filter': 'localFilter',
     }
 
     js_options = None
@@ -50,6 +53,11 @@ class Select(widgets.Input):
     default_class = ('django-select2',)
     ajax = False
 
+    #: Set by Select2ModelFieldMixin.get_bound_field, so that the initial
+    #: selections of all the widgets of a form are looked up together
+    initial_selections = None
+    selection_field_name = None
+
     def __init__(self, attrs=None, choices=(), js_options=None, *args, **kwargs):
         self.ajax = kwargs.pop('ajax', self.ajax)
         self.js_options = {}
@@ -75,13 +83,47 @@ class Select(widgets.Input):
         self.attrs.update(attrs)
         self.choices = iter(choices)
 
-    def reverse(self, lookup_view):
+    def get_lookup_kwargs(self):
         opts = getattr(self, 'model', self.field.model)._meta
-        return reverse(lookup_view, kwargs={
+        return {
             'app_label': opts.app_label,
             'model_name': opts.object_name.lower(),
             'field_name': self.field.name,
-        })
+        }
+
+    def reverse(self, lookup_view):
+        return reverse(lookup_view, kwargs=self.get_lookup_kwargs())
+
+    def reverse_optional(self, lookup_view, kwargs=None):
+        """
+        Returns the url of ``lookup_view``, or None if the URLconf doesn't
+        route it (projects may route only fetch_items and init_selection)
+        """
+        try:
+            return reverse(lookup_view, kwargs=kwargs)
+        except NoReverseMatch:
+            return None
+
+    def has_recent_choices(self):
+        """Whether the model field of the widget remembers recent choices"""
+        from . import recent
+
+        field = getattr(self, 'field', None)
+        if field is None:
+            return False
+        model = getattr(self, 'model', field.model)
+        try:
+            model_field = model._meta.get_field(field.name)
+        except FieldDoesNotExist:
+            return False
+        return bool(recent.get_size(model_field))
+
+    def get_initial_selection(self, value):
+        field = getattr(self, 'field', None)
+        if field is None or not hasattr(field, 'get_initial_selection'):
+            return None
+        return field.get_initial_selection(
+            value, self.initial_selections, self.selection_field_name)
 
     def option_to_data(self, option_value, option_label):
         if not option_value:
@@ -140,7 +182,20 @@ class Select(widgets.Input):
         if self.ajax:
             attrs.update({
                 'data-init-selection-url': self.reverse('select2_init_selection'),
+                'data-select2-field': json.dumps(self.get_lookup_kwargs()),
             })
+            batch_url = self.reverse_optional('select2_init_selection_batch')
+            if batch_url is not None:
+                attrs['data-init-selection-batch-url'] = batch_url
+            if self.has_recent_choices():
+                recent_url = self.reverse_optional(
+                    'select2_recent_choices', kwargs=self.get_lookup_kwargs())
+                if recent_url is not None:
+                    attrs['data-recent-choices-url'] = recent_url
+            initial_selection = self.get_initial_selection(value)
+            if initial_selection is not None:
+                attrs['data-init-selection'] = json.dumps(
+                    initial_selection, cls=DjangoJSONEncoder)
         if self.ajax or self.sortable:
             self.input_type = 'hidden'
             return super(Select, self).render(name, value, attrs=attrs)
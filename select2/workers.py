@@ -0,0 +1,68 @@
+"""
+A thread pool that runs the COUNT query of a fetch_items request while the
+request thread reads the page of results (see the ``concurrent_count``
+field option), so that the request waits for the slower of the two queries
+rather than for both in turn.
+
+Worker threads have their own database connections, which are opened,
+reused and closed like those of request threads, per the ``CONN_MAX_AGE``
+of each database: with persistent connections (or a connection pool) the
+count does not pay for a new connection. The pool has
+``SELECT2_CONCURRENT_COUNT_WORKERS`` threads (4 by default); counts queue
+up when they are all busy.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+
+
+executor = None
+
+lock = threading.Lock()
+
+
+def get_executor():
+    global executor
+
+    with lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'SELECT2_CONCURRENT_COUNT_WORKERS', 4),
+                thread_name_prefix='select2')
+    return executor
+
+
+def can_submit(using):
+    """
+    Whether queries on the database ``using`` can run on another connection:
+    not inside a transaction, whose changes other connections would not see
+    """
+    return not connections[using].in_atomic_block
+
+
+def run(func, using):
+    connection = connections[using]
+    connection.close_if_unusable_or_obsolete()
+    try:
+        return func()
+    finally:
+        connection.close_if_unusable_or_obsolete()
+
+
+def submit(func, using):
+    """
+    Runs ``func``, which queries the database ``using``, on a worker thread
+    and returns its concurrent.futures.Future
+    """
+    return get_executor().submit(run, func, using)
+
+
+def shutdown():
+    global executor
+
+    with lock:
+        if executor is not None:
+            executor.shutdown()
+            executor = None
@@ -0,0 +1,80 @@
+"""
+Measures the time spent per request by the fetch_items and init_selection
+views, and the part of it spent resolving the field of the request: with
+select2.registry, versus the model and field lookups, queryset copy and
+form field construction the views used to do on every request.
+
+Run from the root of the repository with::
+
+    python -m tests.benchmark [--requests N] [--rows N]
+"""
+import argparse
+import copy
+import os
+import time
+
+
+def timeit(func, number):
+    func()
+    start = time.perf_counter()
+    for i in range(number):
+        func()
+    return (time.perf_counter() - start) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--rows', type=int, default=1000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+    import django
+    django.setup()
+
+    from django.apps import apps
+    from django.test.client import RequestFactory
+    from django.test.utils import setup_databases, teardown_databases
+
+    from select2 import registry, views
+    from tests.models import Author
+
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        Author.objects.bulk_create([
+            Author(first_name="First%d" % i, last_name="Last%d" % i)
+            for i in range(args.rows)])
+        pks = ','.join([str(pk) for pk in Author.objects.values_list('pk', flat=True)[:5]])
+
+        factory = RequestFactory()
+        kwargs = {'app_label': 'tests', 'model_name': 'book', 'field_name': 'authors_ajax'}
+
+        def resolve_per_request():
+            model = apps.get_model('tests', 'book')
+            field = model._meta.get_field('authors_ajax')
+            copy.deepcopy(field.queryset)
+            callable(getattr(model, 'authors_ajax_queryset', None))
+            field.get_search_backend()
+            field.formfield()
+
+        def resolve_registry():
+            registry.get_spec('tests', 'book', 'authors_ajax').get_queryset()
+
+        for name, func in [
+                ('resolve', resolve_per_request),
+                ('resolve registry', resolve_registry)]:
+            print("%-18s %8.1f us/request" % (name, timeit(func, args.requests)))
+
+        for name, view, params in [
+                ('fetch_items', views.fetch_items, {'q': 'last1', 'page_limit': 10}),
+                ('init_selection', views.init_selection, {'q': pks})]:
+            request = factory.get('/', params)
+            elapsed = timeit(lambda: view(request, **kwargs), args.requests)
+            print("%-18s %8.1f us/request" % (name, elapsed))
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""
+A load test of the select2 ajax views, served over HTTP by a local server.
+
+A table of generated authors is searched by simulated typists, each of which
+loads a page (an ``init_selection`` request for a few selected authors), then
+types the start of a random last name one keystroke at a time (a
+``fetch_items`` request per keystroke) and sometimes scrolls to the second
+page of results. Throughput and latency percentiles are reported per
+endpoint. Everything runs on the local machine, without network access.
+
+Run from the root of the repository with::
+
+    python -m tests.loadtest [--clients N] [--duration SECONDS] [--rows N]
+        [--think SECONDS] [--client-mode thread|asyncio]
+        [--server wsgi|asgi] [--async-views] [--option NAME=VALUE ...]
+
+``--server asgi`` requires `uvicorn <https://www.uvicorn.org/>`_. Options
+of the ``authors_ajax`` field under test are set with ``--option``, whose
+value is a Python literal, e.g. ``--option cache_results=True``.
+"""
+import argparse
+import ast
+import asyncio
+import http.client
+import math
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+
+syllables = [
+    'an', 'ber', 'bo', 'ca', 'del', 'dor', 'el', 'fa', 'gan', 'hal', 'in',
+    'ka', 'lan', 'ler', 'ma', 'mon', 'na', 'nel', 'o', 'pa', 'per', 'ri',
+    'ro', 'sa', 'sen', 'ta', 'ton', 'vi', 'wen', 'ya',
+]
+
+
+def make_name(rng):
+    return ''.join(rng.choice(syllables) for i in range(rng.randint(2, 4))).capitalize()
+
+
+def percentile(values, p):
+    """The nearest-rank ``p`` percentile of the sorted list ``values``"""
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        #: Latencies in seconds, keyed on endpoint
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, endpoint, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, elapsed):
+        print("%-16s %9s %7s %9s %9s %9s %9s %9s" % (
+            'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+        rows = sorted(self.latencies.items())
+        rows.append(('total', [s for name, values in rows for s in values]))
+        for endpoint, latencies in rows:
+            latencies = sorted(latencies)
+            if endpoint == 'total':
+                errors = sum(self.errors.values())
+            else:
+                errors = self.errors.get(endpoint, 0)
+            print("%-16s %9d %7d %9.1f %9.1f %9.1f %9.1f %9.1f" % (
+                endpoint, len(latencies), errors, len(latencies) / elapsed,
+                percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+                percentile(latencies, 99) * 1000, latencies[-1] * 1000))
+
+
+def iter_requests(rng, names, pks, urls, page_limit):
+    """
+    Yields the ``(endpoint, path)`` of the requests of one typist, who loads
+    a page and then searches for a name
+    """
+    selected = ','.join([str(pk) for pk in rng.sample(pks, 3)])
+    yield 'init_selection', '%s?%s' % (urls['init_selection'], urlencode({'q': selected}))
+    name = rng.choice(names)
+    q = ''
+    for char in name[:rng.randint(2, 8)]:
+        q += char
+        yield 'fetch_items', '%s?%s' % (urls['fetch_items'], urlencode({
+            'q': q, 'page': 1, 'page_limit': page_limit}))
+    if rng.random() < 0.2:
+        yield 'fetch_items', '%s?%s' % (urls['fetch_items'], urlencode({
+            'q': q, 'page': 2, 'page_limit': page_limit}))
+
+
+def think(rng, seconds):
+    return rng.uniform(0.5, 1.5) * seconds if seconds else 0
+
+
+def run_thread_client(host, port, deadline, stats, rng, args, make_requests):
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    while time.time() < deadline:
+        for endpoint, path in make_requests(rng):
+            if time.time() >= deadline:
+                break
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                ok = False
+            stats.add(endpoint, time.perf_counter() - start, ok)
+            time.sleep(think(rng, args.think))
+    connection.close()
+
+
+async def fetch(host, port, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(('GET %s HTTP/1.0\r\nHost: %s\r\n\r\n' % (path, host)).encode('latin-1'))
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    return int(response.split(b' ', 2)[1])
+
+
+async def run_async_client(host, port, deadline, stats, rng, args, make_requests):
+    while time.time() < deadline:
+        for endpoint, path in make_requests(rng):
+            if time.time() >= deadline:
+                break
+            start = time.perf_counter()
+            try:
+                ok = await asyncio.wait_for(fetch(host, port, path), 30) == 200
+            except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+                ok = False
+            stats.add(endpoint, time.perf_counter() - start, ok)
+            await asyncio.sleep(think(rng, args.think))
+
+
+def start_wsgi_server():
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+    from django.core.wsgi import get_wsgi_application
+
+    class Server(ThreadedWSGIServer):
+        request_queue_size = 1024
+
+    class RequestHandler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = Server(('127.0.0.1', 0), RequestHandler)
+    server.set_app(get_wsgi_application())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1], server.shutdown
+
+
+def start_asgi_server():
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("--server asgi requires uvicorn")
+    from django.core.asgi import get_asgi_application
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(
+        get_asgi_application(), host='127.0.0.1', port=port, log_level='warning',
+        backlog=2048))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    def stop():
+        server.should_exit = True
+    return port, stop
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--page-limit', type=int, default=10)
+    parser.add_argument(
+        '--think', type=float, default=0.1,
+        help="The average seconds between the keystrokes of a typist")
+    parser.add_argument('--client-mode', choices=['thread', 'asyncio'], default='thread')
+    parser.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi')
+    parser.add_argument('--async-views', action='store_true')
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=VALUE')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+    from django.conf import settings
+    # Server threads need their own connections to the test database, so
+    # it must be a file rather than in memory
+    tmpdir = tempfile.mkdtemp()
+    for alias, database in settings.DATABASES.items():
+        database['TEST'] = {'NAME': os.path.join(tmpdir, '%s.sqlite' % alias)}
+    settings.ROOT_URLCONF = 'tests.urls'
+    settings.ALLOWED_HOSTS = ['*']
+    settings.DEBUG = False
+    settings.SELECT2_ASYNC_VIEWS = args.async_views
+
+    import django
+    django.setup()
+
+    from django.test.utils import setup_databases, teardown_databases
+    from django.urls import reverse
+
+    from select2 import registry
+    from tests.models import Author, Book
+
+    field = Book._meta.get_field('authors_ajax')
+    for option in args.option:
+        name, value = option.split('=', 1)
+        setattr(field, name, ast.literal_eval(value))
+    registry.clear()
+
+    rng = random.Random(args.seed)
+    old_config = setup_databases(verbosity=0, interactive=False)
+    stop_server = None
+    try:
+        print("Creating %d authors..." % args.rows)
+        names = sorted(set(make_name(rng) for i in range(max(args.rows // 10, 1))))
+        for start in range(0, args.rows, 10000):
+            Author.objects.bulk_create([
+                Author(first_name=make_name(rng), last_name=rng.choice(names))
+                for i in range(start, min(start + 10000, args.rows))])
+        pks = list(Author.objects.values_list('pk', flat=True))
+
+        kwargs = {'app_label': 'tests', 'model_name': 'book', 'field_name': 'authors_ajax'}
+        urls = {
+            'fetch_items': reverse('select2_fetch_items', kwargs=kwargs),
+            'init_selection': reverse('select2_init_selection', kwargs=kwargs),
+        }
+
+        def make_requests(client_rng):
+            return iter_requests(client_rng, names, pks, urls, args.page_limit)
+
+        if args.server == 'asgi':
+            port, stop_server = start_asgi_server()
+        else:
+            port, stop_server = start_wsgi_server()
+
+        print("Running %d %s clients against the %s server for %gs..." % (
+            args.clients, args.client_mode, args.server, args.duration))
+        stats = Stats()
+        client_rngs = [random.Random(rng.random()) for i in range(args.clients)]
+        start = time.time()
+        deadline = start + args.duration
+        client_args = ('127.0.0.1', port, deadline, stats)
+        if args.client_mode == 'asyncio':
+            async def run_clients():
+                await asyncio.gather(*[
+                    run_async_client(*(client_args + (client_rng, args, make_requests)))
+                    for client_rng in client_rngs])
+            asyncio.run(run_clients())
+        else:
+            threads = [
+                threading.Thread(
+                    target=run_thread_client,
+                    args=client_args + (client_rng, args, make_requests))
+                for client_rng in client_rngs]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        stats.report(time.time() - start)
+    finally:
+        if stop_server is not None:
+            stop_server()
+        teardown_databases(old_config, verbosity=0)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
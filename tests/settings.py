@@ -50,5 +50,7 @@ TEMPLATES = [{
 },]
 
 DATABASES = {
-    'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'db.sqlite'}
+    'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'db.sqlite'},
+    # For testing reads from a replica
+    'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'replica.sqlite'},
 }
@@ -0,0 +1,1326 @@
+import json
+import threading
+import time
+import unittest
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+import django
+from django import forms
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core import signing
+from django.core.management import CommandError, call_command
+from django.db import connection, models, transaction
+from django.db.models import Value
+from django.db.models.functions import Concat
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from select2 import (
+    analytics, cache, encoders, index, recent, registry, singleflight, views, workers)
+from select2.fields import ForeignKey, ModelMultipleChoiceField
+from select2.search import PrefixSearch, RankedSearch, SQLiteFTS5Search, TrigramSearch
+
+from .models import Author, Publisher, Book
+from .test_admin import load_fixtures
+
+
+@override_settings(ROOT_URLCONF='tests.urls')
+class Select2ViewTestCase(TestCase):
+
+    def setUp(self):
+        super(Select2ViewTestCase, self).setUp()
+        cache.get_cache().clear()
+        load_fixtures()
+
+    def url(self, view_name, field_name, model_name='book'):
+        return reverse(view_name, kwargs={
+            'app_label': 'tests',
+            'model_name': model_name,
+            'field_name': field_name,
+        })
+
+    def fetch_items(self, field_name, **params):
+        params.setdefault('q', '')
+        response = self.client.get(self.url('select2_fetch_items', field_name), params)
+        return response.status_code, response.json()
+
+    def init_selection(self, field_name, **params):
+        response = self.client.get(self.url('select2_init_selection', field_name), params)
+        return response.status_code, response.json()
+
+    def patch_field(self, field_name, **attrs):
+        patcher = mock.patch.multiple(Book._meta.get_field(field_name), **attrs)
+        patcher.start()
+        # Registry entries hold resolved field options
+        registry.clear()
+        self.addCleanup(registry.clear)
+        self.addCleanup(patcher.stop)
+
+
+class TestFetchItems(Select2ViewTestCase):
+
+    def test_offset_pagination(self):
+        status, data = self.fetch_items('publisher_ajax', page_limit=3)
+        self.assertEqual(status, 200)
+        self.assertEqual(data['total'], 4)
+        self.assertTrue(data['more'])
+        self.assertNotIn('next', data)
+        self.assertEqual([r['text'] for r in data['results']], [
+            "Columbia University Press", "Penguin Press",
+            "Presses Universitaires de France"])
+
+        status, data = self.fetch_items('publisher_ajax', page_limit=3, page=2)
+        self.assertFalse(data['more'])
+        self.assertEqual([r['text'] for r in data['results']], [
+            "University of Minnesota Press"])
+
+    def test_keyset_pagination(self):
+        self.patch_field('publisher_ajax', pagination='keyset')
+        Publisher.objects.create(pk=5, name="Penguin Press", country="UK")
+
+        texts = []
+        params = {'page_limit': 2}
+        while True:
+            status, data = self.fetch_items('publisher_ajax', **params)
+            self.assertEqual(status, 200)
+            self.assertEqual(data['total'], 5)
+            texts += [r['text'] for r in data['results']]
+            if not data['more']:
+                self.assertNotIn('next', data)
+                break
+            params['next'] = data['next']
+        self.assertEqual(texts, [
+            "Columbia University Press", "Penguin Press", "Penguin Press",
+            "Presses Universitaires de France", "University of Minnesota Press"])
+
+    def test_keyset_pagination_invalid_token(self):
+        self.patch_field('publisher_ajax', pagination='keyset')
+        status, data = self.fetch_items('publisher_ajax', next='garbage')
+        self.assertEqual(status, 500)
+        self.assertIn('error', data)
+
+    def test_count_mode_none(self):
+        self.patch_field('publisher_ajax', count_mode='none')
+        with self.assertNumQueries(1):
+            status, data = self.fetch_items('publisher_ajax', page_limit=3)
+        self.assertNotIn('total', data)
+        self.assertTrue(data['more'])
+        self.assertEqual(len(data['results']), 3)
+
+        status, data = self.fetch_items('publisher_ajax', page_limit=3, page=2)
+        self.assertFalse(data['more'])
+        self.assertEqual(data['total'], 4)
+
+    @override_settings(SELECT2_COUNT_MODE='estimate')
+    def test_count_mode_estimate_unsupported_backend(self):
+        status, data = self.fetch_items('publisher_ajax', page_limit=3)
+        self.assertEqual(status, 200)
+        self.assertNotIn('total', data)
+        self.assertTrue(data['more'])
+
+    def test_label_fields(self):
+        self.patch_field('authors_ajax', label_fields=('first_name', 'last_name'))
+        with self.assertNumQueries(2):
+            status, data = self.fetch_items('authors_ajax', q='leuze')
+        self.assertEqual(data['results'], [{'id': 1, 'text': "Gilles Deleuze"}])
+
+    def test_label_format(self):
+        self.patch_field(
+            'authors_ajax',
+            label_fields=('first_name', 'last_name'), label_format="{last_name}, {first_name}")
+        status, data = self.fetch_items('authors_ajax', q='leuze')
+        self.assertEqual(data['results'], [{'id': 1, 'text': "Deleuze, Gilles"}])
+
+    def test_label_expression(self):
+        self.patch_field('authors_ajax', pagination='keyset', label_expression=Concat(
+            'last_name', Value(', '), 'first_name'))
+        status, data = self.fetch_items('authors_ajax', page_limit=3)
+        self.assertEqual(len(data['results']), 3)
+        status, data = self.fetch_items('authors_ajax', page_limit=3, next=data['next'])
+        self.assertEqual(data['results'], [{'id': 3, 'text': "Pynchon, Thomas"}])
+
+    def test_only(self):
+        self.patch_field('authors_ajax', only=('first_name', 'last_name'))
+        status, data = self.fetch_items('authors_ajax', q='leuze')
+        self.assertEqual(data['results'], [{'id': 1, 'text': "Gilles Deleuze"}])
+
+
+@override_settings(ROOT_URLCONF='tests.urls')
+class TestConcurrentCount(TransactionTestCase):
+    """Worker threads only see committed rows, so tests are not wrapped in a transaction"""
+
+    def setUp(self):
+        super(TestConcurrentCount, self).setUp()
+        cache.get_cache().clear()
+        load_fixtures()
+        self.addCleanup(workers.shutdown)
+        self.count_threads = []
+        get_total_count = views.Select2View.get_total_count
+
+        def record_thread(view, *args, **kwargs):
+            self.count_threads.append(threading.current_thread().name)
+            return get_total_count(view, *args, **kwargs)
+        patcher = mock.patch.object(
+            views.Select2View, 'get_total_count', autospec=True, side_effect=record_thread)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch_items(self, **params):
+        url = reverse('select2_fetch_items', kwargs={
+            'app_label': 'tests', 'model_name': 'book', 'field_name': 'publisher_ajax'})
+        return self.client.get(url, dict({'q': 'press'}, **params)).json()
+
+    def test_concurrent(self):
+        expected = self.fetch_items(page_limit=2)
+        self.assertFalse(self.count_threads[0].startswith('select2'))
+        with override_settings(SELECT2_CONCURRENT_COUNT=True):
+            self.assertEqual(self.fetch_items(page_limit=2), expected)
+        self.assertTrue(self.count_threads[1].startswith('select2'))
+        self.assertEqual(expected['total'], 4)
+
+    @override_settings(SELECT2_CONCURRENT_COUNT=True)
+    def test_in_transaction(self):
+        with transaction.atomic():
+            Publisher.objects.create(pk=5, name="Verso Press", country="UK")
+            data = self.fetch_items(page_limit=2)
+        # Counted on the connection that sees the new row
+        self.assertEqual(data['total'], 5)
+        self.assertFalse(self.count_threads[0].startswith('select2'))
+
+
+class TestRegistry(Select2ViewTestCase):
+
+    def test_populated(self):
+        spec = registry.registry[('tests', 'book', 'authors_ajax')]
+        self.assertIs(spec.field, Book._meta.get_field('authors_ajax'))
+        self.assertIs(spec.target_model, Author)
+        self.assertNotIn(('tests', 'book', 'title'), registry.registry)
+
+    def test_resolved_on_first_use(self):
+        registry.clear()
+        status, data = self.fetch_items('publisher_ajax', page_limit=3)
+        self.assertEqual(status, 200)
+        self.assertIn(('tests', 'book', 'publisher_ajax'), registry.registry)
+
+    def test_no_formfield(self):
+        # The form field is only constructed when the field is registered
+        self.fetch_items('authors_ajax', q='leuze')
+        with mock.patch.object(Book._meta.get_field('authors_ajax'), 'formfield') as formfield:
+            status, data = self.fetch_items('authors_ajax', q='leuze')
+        self.assertEqual(data['results'], [{'id': 1, 'text': "Gilles Deleuze"}])
+        self.assertFalse(formfield.called)
+
+    def test_form_class_labels(self):
+        field = Book._meta.get_field('authors_ajax')
+        formfield = field.formfield
+
+        class AuthorChoiceField(ModelMultipleChoiceField):
+            def label_from_instance(self, obj):
+                return "%s, %s" % (obj.last_name, obj.first_name)
+
+        self.addCleanup(registry.clear)
+        patcher = mock.patch.object(
+            field, 'formfield', lambda **kwargs: formfield(form_class=AuthorChoiceField, **kwargs))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        registry.clear()
+        status, data = self.fetch_items('authors_ajax', q='leuze')
+        self.assertEqual(data['results'], [{'id': 1, 'text': "Deleuze, Gilles"}])
+        response = self.client.get(
+            self.url('select2_init_selection', 'authors_ajax'), {'q': '1', 'multiple': 1})
+        self.assertEqual(response.json()['results'], [{'id': 1, 'text': "Deleuze, Gilles"}])
+
+    def test_missing_model(self):
+        response = self.client.get(
+            self.url('select2_fetch_items', 'publisher', model_name='missing'))
+        self.assertEqual(response.status_code, 500)
+        self.assertIn('error', response.json())
+
+    def test_not_ajax_field(self):
+        for field_name in ('title', 'library', 'publisher', 'missing'):
+            response = self.client.get(self.url('select2_fetch_items', field_name), {'q': ''})
+            self.assertEqual(response.status_code, 500)
+            self.assertIn('error', response.json())
+
+    def test_canonical_key(self):
+        registry.clear()
+        self.fetch_items('publisher_ajax')
+        self.client.get(
+            self.url('select2_fetch_items', 'publisher_ajax', model_name='Book'), {'q': ''})
+        self.assertEqual(list(registry.registry), [('tests', 'book', 'publisher_ajax')])
+
+
+class TestGuardrails(Select2ViewTestCase):
+
+    def get(self, view_name, field_name, **params):
+        return self.client.get(self.url(view_name, field_name), params)
+
+    def test_min_search_length(self):
+        self.patch_field('authors_ajax', min_search_length=2)
+        with self.assertNumQueries(0):
+            response = self.get('select2_fetch_items', 'authors_ajax', q=' p ')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': "q must be at least 2 characters long"})
+        response = self.get('select2_fetch_items', 'authors_ajax', q='py')
+        self.assertEqual(response.status_code, 200)
+
+    def test_min_search_length_widget(self):
+        self.patch_field('authors_ajax', min_search_length=2)
+        widget = Book._meta.get_field('authors_ajax').formfield().widget
+        self.assertEqual(widget.js_options['minimumInputLength'], 2)
+
+    @override_settings(SELECT2_MAX_PAGE_LIMIT=50)
+    def test_max_page_limit(self):
+        response = self.get('select2_fetch_items', 'authors_ajax', q='', page_limit=51)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': "page_limit must be at most 50"})
+        self.patch_field('authors_ajax', max_page_limit=100)
+        response = self.get('select2_fetch_items', 'authors_ajax', q='', page_limit=51)
+        self.assertEqual(response.status_code, 200)
+
+    def test_invalid_page_limit(self):
+        response = self.get('select2_fetch_items', 'authors_ajax', q='', page_limit='all')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json(), {'error': "Invalid page_limit 'all' passed"})
+
+    def test_rate_limit(self):
+        self.patch_field('authors_ajax', rate_limit='2/m')
+        for i in range(2):
+            response = self.get('select2_fetch_items', 'authors_ajax', q='')
+            self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(0):
+            response = self.get('select2_init_selection', 'authors_ajax', q='1')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+
+        # Buckets are per client and per field
+        response = self.client.get(
+            self.url('select2_fetch_items', 'authors_ajax'), {'q': ''}, REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 200)
+        response = self.get('select2_fetch_items', 'publisher_ajax', q='')
+        self.assertEqual(response.status_code, 200)
+
+    def test_rate_limit_refill(self):
+        self.patch_field('authors_ajax', rate_limit='1/s')
+        with mock.patch('time.time', return_value=1000.0):
+            self.assertEqual(self.get('select2_fetch_items', 'authors_ajax', q='').status_code, 200)
+            self.assertEqual(self.get('select2_fetch_items', 'authors_ajax', q='').status_code, 429)
+        with mock.patch('time.time', return_value=1001.0):
+            self.assertEqual(self.get('select2_fetch_items', 'authors_ajax', q='').status_code, 200)
+
+
+class TestReplica(Select2ViewTestCase):
+
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        super(TestReplica, self).setUp()
+        Author.objects.using('replica').create(pk=1, first_name="Gilles", last_name="Deleuze")
+
+    def search(self):
+        status, data = self.fetch_items('authors_ajax', q='')
+        return [r['text'] for r in data['results']]
+
+    def test_using(self):
+        self.assertEqual(len(self.search()), 4)
+        self.patch_field('authors_ajax', using='replica')
+        self.assertEqual(self.search(), ["Gilles Deleuze"])
+        status, data = self.init_selection('authors_ajax', q='1,3')
+        self.assertEqual(data['results'], [{'id': 1, 'text': "Gilles Deleuze"}])
+
+    @override_settings(SELECT2_DATABASE='replica')
+    def test_setting(self):
+        self.assertEqual(self.search(), ["Gilles Deleuze"])
+
+    @override_settings(SELECT2_DATABASE='replica', SELECT2_REPLICA_LAG=5)
+    def test_primary_after_write(self):
+        cache.track_model(Author)
+        self.assertEqual(self.search(), ["Gilles Deleuze"])
+        Author.objects.filter(pk=4).get().save()
+        self.assertEqual(len(self.search()), 4)
+        cache.get_cache().delete(cache.written_key(Author))
+        self.assertEqual(self.search(), ["Gilles Deleuze"])
+
+    def test_router_hint(self):
+        class Router(object):
+            def db_for_read(self, model, **hints):
+                if 'select2_field' in hints:
+                    return 'replica'
+
+        with override_settings(DATABASE_ROUTERS=[Router()]):
+            self.assertEqual(self.search(), ["Gilles Deleuze"])
+
+    @override_settings(SELECT2_REPLICA_LAG=5)
+    def test_router_hint_after_write(self):
+        class Router(object):
+            def db_for_read(self, model, **hints):
+                if 'select2_field' in hints and not hints['select2_recently_written']:
+                    return 'replica'
+
+        with override_settings(DATABASE_ROUTERS=[Router()]):
+            self.assertEqual(self.search(), ["Gilles Deleuze"])
+            Author.objects.filter(pk=4).get().save()
+            self.assertEqual(len(self.search()), 4)
+            cache.get_cache().delete(cache.written_key(Author))
+            self.assertEqual(self.search(), ["Gilles Deleuze"])
+
+
+class TestSearchBackends(Select2ViewTestCase):
+
+    def search(self, field_name, q):
+        status, data = self.fetch_items(field_name, q=q)
+        self.assertEqual(status, 200)
+        return [r['text'] for r in data['results']]
+
+    def test_prefix_search(self):
+        self.patch_field('publisher_ajax', search_backend=PrefixSearch())
+        self.assertEqual(self.search('publisher_ajax', 'pres'), [
+            "Presses Universitaires de France"])
+        self.patch_field('authors_ajax', search_backend=PrefixSearch('first_name'))
+        self.assertEqual(self.search('authors_ajax', 'g'), ["Gilles Deleuze"])
+
+    def test_sqlite_fts5_search(self):
+        backend = SQLiteFTS5Search(['first_name', 'last_name'])
+        with connection.cursor() as cursor:
+            for sql in backend.sql_create(Author, connection):
+                cursor.execute(sql)
+        self.patch_field('authors_full_name_ajax', search_backend=backend)
+
+        self.assertEqual(self.search('authors_full_name_ajax', 'Gil del'), ["Gilles Deleuze"])
+        self.assertEqual(self.search('authors_full_name_ajax', 'ma'), ["Mark Leyner"])
+        self.assertEqual(self.search('authors_full_name_ajax', 'eleuze'), [])
+        self.assertEqual(len(self.search('authors_full_name_ajax', '')), 4)
+
+        Author.objects.filter(pk=4).update(last_name="Twain")
+        Author.objects.create(first_name="Marcel", last_name="Proust")
+        self.assertEqual(self.search('authors_full_name_ajax', 'ma'), [
+            "Marcel Proust", "Mark Twain"])
+        Author.objects.filter(pk=4).delete()
+        self.assertEqual(self.search('authors_full_name_ajax', 'mark'), [])
+
+    def test_trigram_search_ordering(self):
+        # trigram_similar is only registered on PostgreSQL
+        with mock.patch.object(models.QuerySet, 'filter', lambda queryset, **kwargs: queryset):
+            queryset = TrigramSearch('last_name').filter(Author.objects.all(), 'mark', None)
+            ordered = TrigramSearch('last_name').filter(
+                Author.objects.order_by('-last_name'), 'mark', None)
+        self.assertEqual(queryset.query.order_by, (
+            '-select2_similarity', 'first_name', 'last_name', 'pk'))
+        self.assertEqual(ordered.query.order_by, ('-select2_similarity', '-last_name', 'pk'))
+
+    def test_ranked_search(self):
+        Author.objects.bulk_create([
+            Author(first_name="Bob", last_name="Smith Mark"),
+            Author(first_name="Dennis", last_name="Remarkable"),
+            Author(first_name="Markus", last_name="Zusak"),
+        ])
+        self.patch_field('authors_ajax', search_backend=RankedSearch(['first_name', 'last_name']))
+        self.assertEqual(self.search('authors_ajax', 'mark'), [
+            "Mark Leyner", "Markus Zusak", "Bob Smith Mark", "Dennis Remarkable"])
+        self.assertEqual(self.search('authors_ajax', ' MARK  ley'), ["Mark Leyner"])
+        self.assertEqual(self.search('authors_ajax', 'ley mark'), ["Mark Leyner"])
+        self.assertEqual(len(self.search('authors_ajax', '')), 7)
+
+    def test_search_fields(self):
+        field = ForeignKey(
+            Author, ajax=True, search_fields=['first_name', 'last_name'],
+            on_delete=models.CASCADE)
+        self.assertIsInstance(field.search_backend, RankedSearch)
+        self.assertEqual(
+            field.search_backend.get_search_fields(field), ['first_name', 'last_name'])
+
+
+class TestSearchIndex(Select2ViewTestCase):
+
+    def setUp(self):
+        super(TestSearchIndex, self).setUp()
+        index.indexes.clear()
+        self.patch_field('publisher_ajax', search_index=True)
+
+    def search(self, q, **params):
+        status, data = self.fetch_items('publisher_ajax', q=q, **params)
+        self.assertEqual(status, 200)
+        return data
+
+    def test_contains(self):
+        data = self.search('')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.search('Press')['total'], 4)
+            data = self.search('univ', page_limit=1, page=2)
+        self.assertEqual(data, {
+            'total': 3,
+            'more': True,
+            'results': [{'id': 3, 'text': "Presses Universitaires de France"}],
+        })
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [r['text'] for r in self.search('S UN')['results']],
+                ["Presses Universitaires de France"])
+            self.assertEqual(self.search('xyz')['results'], [])
+
+    def test_prefix(self):
+        self.patch_field('publisher_ajax', search_backend=PrefixSearch())
+        self.assertEqual(
+            [r['text'] for r in self.search('P')['results']],
+            ["Penguin Press", "Presses Universitaires de France"])
+        self.assertEqual(self.search('press')['total'], 1)
+
+    def test_rebuilt_on_change(self):
+        self.assertEqual(self.search('Press')['total'], 4)
+        Publisher.objects.create(name="Verso Press", country="UK")
+        self.assertEqual(self.search('Press')['total'], 5)
+
+    def test_limit_choices_to(self):
+        self.patch_field('us_publisher_ajax', search_index=True)
+        status, data = self.fetch_items('us_publisher_ajax', q='Press')
+        self.assertEqual(data['total'], 3)
+
+    def test_stats(self):
+        self.search('')
+        stats = index.get_stats()['tests.book.publisher_ajax']
+        self.assertEqual(stats['entries'], 4)
+        self.assertGreater(stats['memory_bytes'], 0)
+
+
+@override_settings(ROOT_URLCONF='tests.urls')
+class TestSearchIndexRebuild(TransactionTestCase):
+    """Rebuild threads only see committed rows, so tests are not wrapped in a transaction"""
+
+    def setUp(self):
+        super(TestSearchIndexRebuild, self).setUp()
+        cache.get_cache().clear()
+        load_fixtures()
+        index.indexes.clear()
+        patcher = mock.patch.object(Book._meta.get_field('publisher_ajax'), 'search_index', True)
+        patcher.start()
+        registry.clear()
+        self.addCleanup(registry.clear)
+        self.addCleanup(patcher.stop)
+
+    def search(self, q):
+        url = reverse('select2_fetch_items', kwargs={
+            'app_label': 'tests', 'model_name': 'book', 'field_name': 'publisher_ajax'})
+        return self.client.get(url, {'q': q}).json()
+
+    def wait_for_rebuild(self):
+        deadline = time.time() + 10
+        while index.rebuilding and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(index.rebuilding)
+
+    def test_rebuilt_in_background(self):
+        self.assertEqual(self.search('Press')['total'], 4)
+        Publisher.objects.create(name="Verso Press", country="UK")
+        with self.assertNumQueries(0):
+            # Answered from the previous index until the rebuild finishes
+            self.assertEqual(self.search('Press')['total'], 4)
+        self.wait_for_rebuild()
+        self.assertEqual(self.search('Press')['total'], 5)
+
+
+class TestResultCache(Select2ViewTestCase):
+
+    def setUp(self):
+        super(TestResultCache, self).setUp()
+        self.patch_field('publisher_ajax', cache_results=True)
+        self.patch_field('authors_full_name_ajax', cache_results=True)
+
+    def test_cache_hit(self):
+        status, data = self.fetch_items('publisher_ajax', q='Press')
+        with self.assertNumQueries(0):
+            status, cached_data = self.fetch_items('publisher_ajax', q='press')
+        self.assertEqual(cached_data, data)
+
+    def test_limit_choices_to_subquery(self):
+        # Publishers with books
+        field = Book._meta.get_field('publisher_ajax')
+        patcher = mock.patch.object(field, 'get_limit_choices_to', return_value={
+            'pk__in': Book.objects.values('publisher_ajax')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        status, data = self.fetch_items('publisher_ajax', q='Press')
+        self.assertEqual(data['results'], [])
+        # The subquery is not evaluated to build the key
+        with self.assertNumQueries(0):
+            status, data = self.fetch_items('publisher_ajax', q='Press')
+        Book.objects.create(title="Capitalism and Schizophrenia", publisher_ajax_id=1)
+        status, data = self.fetch_items('publisher_ajax', q='Press')
+        self.assertEqual(
+            data['results'], [{'id': 1, 'text': "University of Minnesota Press"}])
+
+    def test_case_sensitive_callable_not_normalized(self):
+        self.fetch_items('authors_full_name_ajax', q='Mark')
+        with self.assertNumQueries(2):
+            self.fetch_items('authors_full_name_ajax', q='mark')
+
+    def test_invalidated_on_save(self):
+        self.fetch_items('publisher_ajax', q='Press')
+        Publisher.objects.filter(pk=2).get().delete()
+        status, data = self.fetch_items('publisher_ajax', q='Press')
+        self.assertEqual(data['total'], 3)
+        Publisher.objects.create(name="Verso Press", country="UK")
+        status, data = self.fetch_items('publisher_ajax', q='Press')
+        self.assertEqual(data['total'], 4)
+
+    def test_invalidated_on_m2m_change(self):
+        self.fetch_items('authors_full_name_ajax', q='Mark')
+        book = Book.objects.create(title="The Sugar Frosted Nutsack")
+        with self.assertNumQueries(0):
+            self.fetch_items('authors_full_name_ajax', q='Mark')
+        generation = cache.get_generation(Author)
+        book.authors_full_name_ajax.add(Author.objects.get(pk=4))
+        self.assertNotEqual(cache.get_generation(Author), generation)
+
+
+class TestSubsumedResults(Select2ViewTestCase):
+
+    def setUp(self):
+        super(TestSubsumedResults, self).setUp()
+        self.patch_field('publisher_ajax', cache_results=True, subsume_results=True)
+
+    def assertUncached(self, data, **params):
+        """Asserts that ``data`` is what the database returns for ``params``"""
+        cache.get_cache().clear()
+        with mock.patch.object(Book._meta.get_field('publisher_ajax'), 'subsume_results', False):
+            registry.clear()
+            status, uncached_data = self.fetch_items('publisher_ajax', **params)
+        registry.clear()
+        self.assertEqual(data, uncached_data)
+
+    def test_longer_terms(self):
+        with self.assertNumQueries(1):
+            # A complete first page is not counted
+            status, data = self.fetch_items('publisher_ajax', q='p')
+        self.assertEqual(data['total'], 4)
+        with self.assertNumQueries(0):
+            for q in ('pr', 'PRE', 'press', 'penguin', 'pressx'):
+                status, data = self.fetch_items('publisher_ajax', q=q)
+        self.assertEqual(data, {'results': [], 'more': False, 'total': 0})
+        status, data = self.fetch_items('publisher_ajax', q='penguin')
+        self.assertUncached(data, q='penguin')
+
+    def test_no_results(self):
+        status, data = self.fetch_items('publisher_ajax', q='xqz')
+        with self.assertNumQueries(0):
+            status, data = self.fetch_items('publisher_ajax', q='xqzw')
+        self.assertEqual(data['results'], [])
+
+    def test_incomplete_results(self):
+        self.fetch_items('publisher_ajax', q='p', page_limit=2)
+        with self.assertNumQueries(1):
+            self.fetch_items('publisher_ajax', q='pr')
+        with self.assertNumQueries(0):
+            self.fetch_items('publisher_ajax', q='pre')
+
+    def test_changed_during_query(self):
+        field = Book._meta.get_field('publisher_ajax')
+        iter_choices = field.iter_choices
+
+        def change_publishers(*args, **kwargs):
+            # A save committed while the query runs
+            cache.bump_generation(Publisher)
+            return iter_choices(*args, **kwargs)
+
+        with mock.patch.object(field, 'iter_choices', side_effect=change_publishers):
+            self.fetch_items('publisher_ajax', q='p')
+        with self.assertNumQueries(1):
+            self.fetch_items('publisher_ajax', q='pr')
+
+    def test_smaller_page_limit(self):
+        self.fetch_items('publisher_ajax', q='')
+        with self.assertNumQueries(0):
+            status, data = self.fetch_items('publisher_ajax', q='press', page_limit=2, page=2)
+        self.assertUncached(data, q='press', page_limit=2, page=2)
+
+    def test_keyset_pagination(self):
+        self.patch_field('publisher_ajax', pagination='keyset')
+        self.fetch_items('publisher_ajax', q='')
+        with self.assertNumQueries(0):
+            status, data = self.fetch_items('publisher_ajax', q='univ', page_limit=1)
+        self.assertIn('next', data)
+        self.assertUncached(data, q='univ', page_limit=1)
+
+    def test_case_sensitive(self):
+        self.patch_field('publisher_ajax', case_sensitive=True)
+        self.fetch_items('publisher_ajax', q='P')
+        with self.assertNumQueries(0):
+            status, data = self.fetch_items('publisher_ajax', q='Pe')
+        self.assertEqual([r['id'] for r in data['results']], [2])
+        with self.assertNumQueries(1):
+            self.fetch_items('publisher_ajax', q='pe')
+
+    def test_invalidated_on_save(self):
+        self.fetch_items('publisher_ajax', q='p')
+        Publisher.objects.create(name="Verso Press", country="UK")
+        status, data = self.fetch_items('publisher_ajax', q='pr')
+        self.assertEqual(data['total'], 5)
+
+
+class TestIndexes(Select2ViewTestCase):
+
+    def select2_indexes(self, **options):
+        stdout = StringIO()
+        call_command('select2_indexes', stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def execute(self, statements):
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+    def test_contains_sqlite(self):
+        output = self.select2_indexes()
+        self.assertIn(
+            '-- tests.Book.publisher_ajax: ContainsSearch on tests.Publisher\n'
+            '-- No index can serve this search on sqlite\n', output)
+        self.assertNotIn('CREATE', output)
+
+    def test_contains_postgresql(self):
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            output = self.select2_indexes()
+        self.assertEqual(output.count('CREATE EXTENSION IF NOT EXISTS pg_trgm;'), 1)
+        self.assertIn(
+            'ON "tests_publisher" USING gin (UPPER("name"::text) gin_trgm_ops);', output)
+        self.assertRegex(output, '-- tests_publisher_[0-9a-f]+_select2 is created above')
+
+    def test_prefix(self):
+        self.patch_field('publisher_ajax', search_backend=PrefixSearch(case_sensitive=True))
+        output = self.select2_indexes()
+        self.assertIn('ON "tests_publisher" ("name" COLLATE NOCASE);', output)
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            output = self.select2_indexes()
+        self.assertIn('ON "tests_publisher" ("name" varchar_pattern_ops);', output)
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', "Requires SQLite")
+    def test_migration(self):
+        self.patch_field('publisher_ajax', search_backend=SQLiteFTS5Search())
+        output = self.select2_indexes(migration='tests')
+        namespace = {}
+        exec(output, namespace)
+        operations = namespace['Migration'].operations
+        self.assertEqual(len(operations), 1)
+        self.execute(operations[0].sql)
+        self.addCleanup(self.execute, operations[0].reverse_sql)
+        status, data = self.fetch_items('publisher_ajax', q='pengu')
+        self.assertEqual([r['id'] for r in data['results']], [2])
+
+    def test_migration_invalid_app(self):
+        with self.assertRaisesMessage(CommandError, "No installed app with label 'nope'"):
+            self.select2_indexes(migration='nope')
+
+
+class TestBrowsePages(Select2ViewTestCase):
+
+    def setUp(self):
+        super(TestBrowsePages, self).setUp()
+        Publisher.objects.bulk_create([
+            Publisher(pk=pk, name="Publisher %d" % pk, country="US") for pk in range(5, 12)])
+
+    def test_pages(self):
+        expected = [
+            self.fetch_items('publisher_ajax', page=page, page_limit=3) for page in (1, 2, 3, 4)]
+        self.patch_field('publisher_ajax', browse_pages=3)
+        # One count and one query for the three pages
+        with self.assertNumQueries(2):
+            self.assertEqual(self.fetch_items('publisher_ajax', page_limit=3), expected[0])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.fetch_items('publisher_ajax', page=2, page_limit=3), expected[1])
+            self.assertEqual(self.fetch_items('publisher_ajax', page=3, page_limit=3), expected[2])
+        self.assertEqual(self.fetch_items('publisher_ajax', page=4, page_limit=3), expected[3])
+        # Searches are not served from the browse pages
+        with self.assertNumQueries(2):
+            self.fetch_items('publisher_ajax', q='press', page_limit=3)
+
+    def test_invalidated(self):
+        self.patch_field('publisher_ajax', browse_pages=1)
+        self.fetch_items('publisher_ajax', page_limit=20)
+        Publisher.objects.create(pk=12, name="Verso", country="UK")
+        status, data = self.fetch_items('publisher_ajax', page_limit=20)
+        self.assertEqual(data['total'], 12)
+        self.assertIn("Verso", [r['text'] for r in data['results']])
+
+    def test_keyset_pagination(self):
+        self.patch_field('publisher_ajax', pagination='keyset', count_mode='none')
+        status, first = self.fetch_items('publisher_ajax', page_limit=4)
+        status, second = self.fetch_items('publisher_ajax', page_limit=4, next=first['next'])
+        self.patch_field('publisher_ajax', browse_pages=2)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.fetch_items('publisher_ajax', page_limit=4), (200, first))
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.fetch_items('publisher_ajax', page_limit=4, page=2, next=first['next']),
+                (200, second))
+        # The third page is not cached
+        with self.assertNumQueries(1):
+            status, data = self.fetch_items('publisher_ajax', page_limit=4, next=second['next'])
+        self.assertEqual(status, 200)
+        self.assertFalse(data['more'])
+
+
+class TestSingleFlight(Select2ViewTestCase):
+
+    def start_leader(self, key, result=None, error=None):
+        """Starts a call for ``key`` in a thread, which returns when ``release`` is set"""
+        started = threading.Event()
+        self.release = threading.Event()
+        self.leader_results = []
+
+        def compute():
+            started.set()
+            self.release.wait(5)
+            if error is not None:
+                raise error
+            return result
+
+        def run():
+            try:
+                self.leader_results.append(singleflight.do(key, compute))
+            except ValueError:
+                pass
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.release.set)
+        started.wait(5)
+
+    def release_later(self):
+        timer = threading.Timer(0.1, self.release.set)
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+    def test_concurrent_calls_coalesced(self):
+        data = {'results': [], 'more': False}
+        self.start_leader('key', data)
+        self.release_later()
+        result = singleflight.do('key', mock.Mock(side_effect=AssertionError))
+        self.assertIs(result, data)
+        self.assertEqual(singleflight.calls, {})
+
+    def test_leader_failed(self):
+        self.start_leader('key', error=ValueError())
+        self.release_later()
+        self.assertEqual(singleflight.do('key', lambda: 'computed'), 'computed')
+
+    def test_lease_held_by_other_process(self):
+        backend = cache.get_cache()
+        backend.add(singleflight.lease_key('key'), True)
+        timer = threading.Timer(0.1, backend.set, ['key', 'stored'])
+        timer.start()
+        self.addCleanup(timer.cancel)
+        func = mock.Mock(side_effect=AssertionError)
+        self.assertEqual(singleflight.do('key', func, shared=True), 'stored')
+
+    @override_settings(SELECT2_COALESCE_TIMEOUT=0.1)
+    def test_lease_expired(self):
+        cache.get_cache().add(singleflight.lease_key('key'), True)
+        self.assertEqual(singleflight.do('key', lambda: 'computed', shared=True), 'computed')
+
+    def test_fetch_items(self):
+        self.patch_field('publisher_ajax', cache_results=True, coalesce='cache')
+        patcher = mock.patch.object(singleflight, 'run_leased', wraps=singleflight.run_leased)
+        with patcher as run_leased:
+            status, data = self.fetch_items('publisher_ajax', q='Press')
+            self.assertEqual(run_leased.call_count, 1)
+            self.assertEqual(data['total'], 4)
+            self.fetch_items('publisher_ajax', q='Press')
+            self.assertEqual(run_leased.call_count, 1)
+        self.assertIsNone(cache.get_cache().get(singleflight.lease_key(run_leased.call_args[0][0])))
+
+    def test_fetch_items_uncoalesced(self):
+        self.patch_field('publisher_ajax', cache_results=True, coalesce='none')
+        with mock.patch.object(singleflight, 'do') as do:
+            self.fetch_items('publisher_ajax', q='Press')
+        self.assertFalse(do.called)
+
+
+class TestAnalytics(Select2ViewTestCase):
+
+    def setUp(self):
+        super(TestAnalytics, self).setUp()
+        analytics.clear()
+        self.addCleanup(analytics.clear)
+        self.patch_field('publisher_ajax', record_terms=True, cache_results=True)
+
+    @override_settings(SELECT2_RECORD_TERMS_INTERVAL=0)
+    def test_top_terms(self):
+        for q in ('Press', 'press', ' PRESS', 'Verso'):
+            self.fetch_items('publisher_ajax', q=q)
+        self.fetch_items('author_ajax', q='Press')
+        self.assertEqual(analytics.get_field_keys(), ['tests.book.publisher_ajax'])
+        terms = analytics.get_top_terms('tests.book.publisher_ajax')
+        self.assertEqual([(term, hits) for term, hits, seconds in terms], [
+            ('press', 2), (' press', 1), ('verso', 1)])
+
+    def test_pending_until_flushed(self):
+        self.fetch_items('publisher_ajax', q='Press')
+        self.assertIsNone(cache.get_cache().get(analytics.fields_key))
+        self.assertEqual(len(analytics.get_top_terms('tests.book.publisher_ajax')), 1)
+
+    @override_settings(SELECT2_RECORD_TERMS_INTERVAL=0, SELECT2_RECORD_TERMS_MAX=1)
+    def test_pruned(self):
+        for q in ('Press', 'press', 'Verso'):
+            self.fetch_items('publisher_ajax', q=q)
+        terms = analytics.get_top_terms('tests.book.publisher_ajax')
+        self.assertEqual([term for term, hits, seconds in terms], ['press'])
+
+    def test_warm(self):
+        self.fetch_items('publisher_ajax', q='Press')
+        status, data = self.fetch_items('publisher_ajax', q='Verso')
+        # Invalidates the cached results
+        cache.bump_generation(Publisher)
+        stdout = StringIO()
+        call_command('select2_warm', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'tests.book.publisher_ajax: warmed 2 of 2 terms\n')
+        with self.assertNumQueries(0):
+            status, warmed_data = self.fetch_items('publisher_ajax', q='Verso')
+        self.assertEqual(warmed_data, data)
+
+    def test_warm_invalid_field(self):
+        with self.assertRaisesMessage(CommandError, "Invalid field 'tests.book'"):
+            call_command('select2_warm', field=['tests.book'])
+
+
+class BookForm(forms.ModelForm):
+
+    class Meta:
+        model = Book
+        fields = ('title', 'publisher_ajax', 'authors_ajax')
+
+
+class TestRecentChoices(Select2ViewTestCase):
+
+    def setUp(self):
+        super(TestRecentChoices, self).setUp()
+        self.patch_field('publisher_ajax', recent_choices=2)
+        self.patch_field('authors_ajax', recent_choices=3)
+        self.user = User.objects.create_user('editor')
+        self.client.force_login(self.user)
+
+    def recent_choices(self, field_name):
+        response = self.client.get(self.url('select2_recent_choices', field_name))
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def save(self, data, instance=None):
+        form = BookForm(data, instance=instance)
+        self.assertTrue(form.is_valid(), form.errors)
+        book = form.save()
+        request = RequestFactory().post('/')
+        request.user = self.user
+        recent.record_form(request, form)
+        return book
+
+    def test_frequent_then_recent(self):
+        self.save({'title': "A", 'publisher_ajax': '2'})
+        self.save({'title': "B", 'publisher_ajax': '2'})
+        self.save({'title': "C", 'publisher_ajax': '4'})
+        self.assertEqual(self.recent_choices('publisher_ajax'), [
+            {'id': 2, 'text': "Penguin Press"},
+            {'id': 4, 'text': "Columbia University Press"},
+        ])
+        # The least used choice makes way for the new one
+        self.save({'title': "D", 'publisher_ajax': '1'})
+        self.assertEqual([r['id'] for r in self.recent_choices('publisher_ajax')], [2, 1])
+
+    def test_added_values(self):
+        book = self.save({'title': "A", 'authors_ajax': '3,1'})
+        self.save({'title': "A", 'authors_ajax': '3,1,2'}, instance=book)
+        # Only the author added by the second save is picked again
+        self.assertEqual([r['id'] for r in self.recent_choices('authors_ajax')], [2, 3, 1])
+
+    def test_labels_stored(self):
+        self.save({'title': "A", 'publisher_ajax': '2'})
+        self.recent_choices('publisher_ajax')
+        request = RequestFactory().get(self.url('select2_recent_choices', 'publisher_ajax'))
+        request.user = self.user
+        with self.assertNumQueries(0):
+            response = views.recent_choices(request, 'tests', 'book', 'publisher_ajax')
+        self.assertEqual(json.loads(response.content)['results'], [
+            {'id': 2, 'text': "Penguin Press"}])
+        self.assertIn('private', response['Cache-Control'])
+
+        Publisher.objects.filter(pk=2).update(name="Penguin Books")
+        Publisher.objects.get(pk=2).save()
+        self.assertEqual(self.recent_choices('publisher_ajax'), [
+            {'id': 2, 'text': "Penguin Books"}])
+        Publisher.objects.get(pk=2).delete()
+        self.assertEqual(self.recent_choices('publisher_ajax'), [])
+
+    def test_per_user(self):
+        self.save({'title': "A", 'publisher_ajax': '2'})
+        self.client.force_login(User.objects.create_user('reviewer'))
+        self.assertEqual(self.recent_choices('publisher_ajax'), [])
+        self.client.logout()
+        self.assertEqual(self.recent_choices('publisher_ajax'), [])
+
+    def test_disabled(self):
+        self.save({'title': "A", 'publisher_ajax': '2'})
+        self.patch_field('publisher_ajax', recent_choices=0)
+        self.assertEqual(self.recent_choices('publisher_ajax'), [])
+        self.assertNotIn('data-recent-choices-url', str(BookForm()['publisher_ajax']))
+
+    def test_widget(self):
+        self.assertIn(
+            'data-recent-choices-url="%s"' % self.url('select2_recent_choices', 'publisher_ajax'),
+            str(BookForm()['publisher_ajax']))
+
+    def test_anonymous_not_recorded(self):
+        form = BookForm({'title': "A", 'publisher_ajax': '2'})
+        self.assertTrue(form.is_valid())
+        request = RequestFactory().post('/')
+        request.user = AnonymousUser()
+        recent.record_form(request, form)
+        self.assertEqual(self.recent_choices('publisher_ajax'), [])
+
+
+class TestResponseEncoding(Select2ViewTestCase):
+
+    def get(self, field_name, **params):
+        params.setdefault('q', '')
+        return self.client.get(self.url('select2_fetch_items', field_name), params)
+
+    def get_content(self, response):
+        if response.streaming:
+            return b''.join(response.streaming_content)
+        return response.content
+
+    def test_streaming(self):
+        self.patch_field('publisher_ajax', pagination='keyset', count_mode='none')
+        # The signed cursors would differ if the requests fell in different seconds
+        patcher = mock.patch.object(signing.TimestampSigner, 'timestamp', return_value='0')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for params in [{'page_limit': 3}, {'page_limit': 10}, {'q': 'press', 'page_limit': 2}]:
+            registry.clear()
+            expected = self.get('publisher_ajax', **params).json()
+            self.patch_field('publisher_ajax', streaming=True)
+            response = self.get('publisher_ajax', **params)
+            self.assertTrue(response.streaming)
+            self.assertEqual(json.loads(self.get_content(response)), expected)
+            self.patch_field('publisher_ajax', streaming=False)
+
+    def test_streaming_invalid_params(self):
+        self.patch_field('publisher_ajax', streaming=True)
+        response = self.get('publisher_ajax', next='invalid')
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(response.streaming)
+
+    def test_jsonp(self):
+        for streaming in (False, True):
+            self.patch_field('publisher_ajax', streaming=streaming)
+            response = self.get('publisher_ajax', page_limit=1, callback='cb')
+            self.assertEqual(response['Content-Type'], 'text/javascript')
+            content = self.get_content(response)
+            self.assertTrue(content.startswith(b'cb(\n'))
+            self.assertEqual(json.loads(content[4:-2])['results'], [
+                {'id': 4, 'text': "Columbia University Press"}])
+
+    @override_settings(SELECT2_JSON_ENCODER='tests.test_views.encode_json')
+    def test_custom_encoder(self):
+        response = self.get('publisher_ajax', page_limit=1)
+        self.assertEqual(response.content, b'"encoded"')
+
+    @override_settings(SELECT2_JSON_ENCODER='json')
+    def test_json_encoder(self):
+        self.assertEqual(encoders.dumps({'id': Decimal('1.5')}), b'{"id": "1.5"}')
+
+
+def encode_json(obj):
+    return '"encoded"'
+
+
+class TestHttpCaching(Select2ViewTestCase):
+
+    def get(self, view_name, field_name, params, **headers):
+        return self.client.get(self.url(view_name, field_name), params, **headers)
+
+    def test_etag(self):
+        self.patch_field('authors_ajax', etag=True)
+        response = self.get('select2_fetch_items', 'authors_ajax', {'q': 'e', '_': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.get(
+                'select2_fetch_items', 'authors_ajax', {'q': 'e', '_': '2'},
+                HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        response = self.get(
+            'select2_fetch_items', 'authors_ajax', {'q': 'el'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_changes_with_data(self):
+        self.patch_field('authors_ajax', etag=True)
+        etag = self.get('select2_fetch_items', 'authors_ajax', {'q': 'e'})['ETag']
+        Author.objects.create(first_name="Marcel", last_name="Proust")
+        response = self.get(
+            'select2_fetch_items', 'authors_ajax', {'q': 'e'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_init_selection_etag(self):
+        self.patch_field('authors_ajax', etag=True, max_age=60)
+        response = self.get('select2_init_selection', 'authors_ajax', {'q': '3,1'})
+        self.assertEqual(response['Cache-Control'], 'max-age=60')
+        response = self.get(
+            'select2_init_selection', 'authors_ajax', {'q': '3,1'},
+            HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_disabled(self):
+        response = self.get('select2_fetch_items', 'authors_ajax', {'q': 'e'})
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Cache-Control'))
+        response = self.get('select2_fetch_items', 'authors_ajax', {})
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(response.has_header('ETag'))
+
+
+class TestInitSelection(Select2ViewTestCase):
+
+    def test_preserves_order(self):
+        status, data = self.init_selection('authors_ajax', q='3,1')
+        self.assertEqual(status, 200)
+        self.assertEqual(data['results'], [
+            {'id': 3, 'text': "Thomas Pynchon"},
+            {'id': 1, 'text': "Gilles Deleuze"},
+        ])
+
+    def test_single_fk(self):
+        status, data = self.init_selection('publisher_ajax', q='2')
+        self.assertEqual(data['results'], {'id': 2, 'text': "Penguin Press"})
+
+    def test_no_distinct_without_joins(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.init_selection('alive_authors_ajax', q='3,4')
+        self.assertNotIn('DISTINCT', queries[0]['sql'])
+
+    def test_distinct_with_joins(self):
+        hook = staticmethod(lambda queryset: queryset.filter(book_set1__title__isnull=False))
+        with mock.patch.object(Book, 'authors_ajax_queryset', hook, create=True):
+            registry.clear()
+            self.addCleanup(registry.clear)
+            with CaptureQueriesContext(connection) as queries:
+                self.init_selection('authors_ajax', q='3,4')
+        self.assertIn('DISTINCT', queries[0]['sql'])
+
+    @override_settings(SELECT2_SELECTION_BATCH_SIZE=2)
+    def test_batches(self):
+        url = self.url('select2_init_selection', 'authors_ajax')
+        with self.assertNumQueries(2):
+            response = self.client.get(url, {'q': '4,3,3,2,1'})
+            content = b''.join(response.streaming_content)
+        self.assertEqual(json.loads(content), {
+            'results': [
+                {'id': 4, 'text': "Mark Leyner"},
+                {'id': 3, 'text': "Thomas Pynchon"},
+                {'id': 2, 'text': "F\u00e9lix Guattari"},
+                {'id': 1, 'text': "Gilles Deleuze"},
+            ],
+            'total': 4,
+            'more': False,
+        })
+
+    @override_settings(SELECT2_SELECTION_BATCH_SIZE=2)
+    def test_streamed_single_result(self):
+        url = self.url('select2_init_selection', 'publisher_ajax')
+        for params, results, total in [
+                ({'q': '2,998,999'}, {'id': 2, 'text': "Penguin Press"}, 1),
+                ({'q': '2,998,999', 'multiple': 1}, [{'id': 2, 'text': "Penguin Press"}], 1),
+                ({'q': '997,998,999'}, [], 0)]:
+            response = self.client.get(url, params)
+            data = json.loads(b''.join(response.streaming_content))
+            self.assertEqual(data, {'results': results, 'total': total, 'more': False})
+
+
+class TestInitSelectionBatch(Select2ViewTestCase):
+
+    def init_selection_batch(self, selections):
+        response = self.client.post(
+            reverse('select2_init_selection_batch'),
+            json.dumps({'selections': selections}), content_type='application/json')
+        return response.status_code, response.json()
+
+    def selection(self, key, field_name, q, **kwargs):
+        return dict(
+            key=key, app_label='tests', model_name='book', field_name=field_name,
+            q=q, **kwargs)
+
+    def test_batch(self):
+        # One query for each combination of target model and limit_choices_to
+        with self.assertNumQueries(4):
+            status, data = self.init_selection_batch([
+                self.selection('0', 'publisher_ajax', '2'),
+                self.selection('1', 'publisher_ajax', '1'),
+                self.selection('2', 'authors_ajax', '3,1'),
+                self.selection('3', 'authors_full_name_ajax', '4', multiple=1),
+                self.selection('4', 'us_publisher_ajax', '3'),
+                self.selection('5', 'alive_authors_ajax', '3,1'),
+            ])
+        self.assertEqual(status, 200)
+        self.assertEqual(data['results'], {
+            '0': {'id': 2, 'text': "Penguin Press"},
+            '1': {'id': 1, 'text': "University of Minnesota Press"},
+            '2': [{'id': 3, 'text': "Thomas Pynchon"}, {'id': 1, 'text': "Gilles Deleuze"}],
+            '3': [{'id': 4, 'text': "Mark Leyner"}],
+            '4': [],
+            '5': [{'id': 3, 'text': "Thomas Pynchon"}],
+        })
+        self.assertNotIn('errors', data)
+
+    def test_mixed_label_options(self):
+        field = Book._meta.get_field('authors_ajax')
+        with mock.patch.object(field, 'label_fields', ('last_name',)):
+            status, data = self.init_selection_batch([
+                self.selection('0', 'authors_full_name_ajax', '1'),
+                self.selection('1', 'authors_ajax', '1'),
+            ])
+        self.assertEqual(status, 200)
+        self.assertEqual(data['results'], {
+            '0': [{'id': 1, 'text': "Gilles Deleuze"}],
+            '1': [{'id': 1, 'text': "Deleuze"}],
+        })
+
+    def test_limit_choices_to_subqueries(self):
+        Publisher.objects.bulk_create([
+            Publisher(name="A Press %02d" % i, country='US') for i in range(21)])
+        us_publishers = Publisher.objects.filter(country='US')
+        for field_name, limit_choices_to in [
+                ('publisher_ajax', {'pk__in': us_publishers}),
+                ('us_publisher_ajax', {'pk__in': us_publishers.exclude(pk=4)})]:
+            patcher = mock.patch.object(
+                Book._meta.get_field(field_name), 'get_limit_choices_to',
+                return_value=limit_choices_to)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # The reprs of the querysets are the same, truncated to their first 20 rows
+        status, data = self.init_selection_batch([
+            self.selection('0', 'publisher_ajax', '4'),
+            self.selection('1', 'us_publisher_ajax', '4'),
+        ])
+        self.assertEqual(data['results'], {
+            '0': {'id': 4, 'text': "Columbia University Press"},
+            '1': [],
+        })
+
+    def test_errors(self):
+        status, data = self.init_selection_batch([
+            self.selection('0', 'publisher_ajax', '2'),
+            self.selection('1', 'publisher_ajax', 'abc'),
+            self.selection('2', 'nonexistent', '1'),
+        ])
+        self.assertEqual(status, 200)
+        self.assertEqual(data['results'], {'0': {'id': 2, 'text': "Penguin Press"}})
+        self.assertEqual(sorted(data['errors']), ['1', '2'])
+
+    @override_settings(SELECT2_BATCH_MAX_SELECTIONS=2, SELECT2_BATCH_MAX_IDS=3)
+    def test_max_size(self):
+        status, data = self.init_selection_batch([
+            self.selection('0', 'publisher_ajax', '2'),
+            self.selection('1', 'authors_ajax', '3,1'),
+        ])
+        self.assertEqual(status, 200)
+        status, data = self.init_selection_batch([
+            self.selection(str(i), 'publisher_ajax', '2') for i in range(3)])
+        self.assertEqual(status, 400)
+        status, data = self.init_selection_batch([
+            self.selection('0', 'publisher_ajax', '2'),
+            self.selection('1', 'authors_ajax', '3,1,2'),
+        ])
+        self.assertEqual(status, 400)
+
+    @override_settings(SELECT2_RATE_LIMIT='3/m')
+    def test_rate_limit(self):
+        status, data = self.init_selection_batch([
+            self.selection('0', 'publisher_ajax', '2'),
+            self.selection('1', 'publisher_ajax', '1'),
+        ])
+        self.assertEqual(status, 200)
+        # The second lookup of this batch exceeds the limit
+        response = self.client.post(
+            reverse('select2_init_selection_batch'), json.dumps({'selections': [
+                self.selection('0', 'publisher_ajax', '2'),
+                self.selection('1', 'publisher_ajax', '1'),
+            ]}), content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        # Other fields have buckets of their own
+        status, data = self.init_selection_batch([self.selection('0', 'authors_ajax', '1')])
+        self.assertEqual(status, 200)
+
+    def test_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        body = json.dumps({'selections': [self.selection('0', 'publisher_ajax', '2')]})
+        response = client.post(
+            reverse('select2_init_selection_batch'), body, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        token = 'a' * 32
+        client.cookies[settings.CSRF_COOKIE_NAME] = token
+        response = client.post(
+            reverse('select2_init_selection_batch'), body, content_type='application/json',
+            HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 200)
+
+    def test_invalid_body(self):
+        response = self.client.post(
+            reverse('select2_init_selection_batch'), 'garbage',
+            content_type='application/json')
+        self.assertEqual(response.status_code, 500)
+
+
+@unittest.skipIf(django.VERSION < (4, 1), "async views require Django 4.1")
+class TestAsyncViews(Select2ViewTestCase):
+
+    async def call(self, view, field_name, **params):
+        from django.test.client import AsyncRequestFactory
+
+        request = AsyncRequestFactory().get('/', params)
+        response = await view(
+            request, app_label='tests', model_name='book', field_name=field_name)
+        return response.status_code, json.loads(response.content)
+
+    async def test_fetch_items(self):
+        status, data = await self.call(views.afetch_items, 'publisher_ajax', q='', page_limit=3)
+        self.assertEqual(status, 200)
+        self.assertEqual(data['total'], 4)
+        self.assertTrue(data['more'])
+        self.assertEqual(len(data['results']), 3)
+
+    async def test_label_fields_keyset(self):
+        self.patch_field(
+            'authors_ajax', pagination='keyset',
+            label_fields=('first_name', 'last_name'), label_format="{last_name}, {first_name}")
+        status, data = await self.call(views.afetch_items, 'authors_ajax', q='', page_limit=3)
+        self.assertEqual(len(data['results']), 3)
+        status, data = await self.call(
+            views.afetch_items, 'authors_ajax', q='', page_limit=3, next=data['next'])
+        self.assertEqual(data['results'], [{'id': 3, 'text': "Pynchon, Thomas"}])
+
+    async def test_invalid_params(self):
+        status, data = await self.call(views.afetch_items, 'publisher_ajax')
+        self.assertEqual(status, 500)
+        self.assertEqual(data['error'], "q parameter required")
+
+    async def test_init_selection(self):
+        status, data = await self.call(views.ainit_selection, 'authors_ajax', q='3,1')
+        self.assertEqual(status, 200)
+        self.assertEqual([r['id'] for r in data['results']], [3, 1])
+
+    def test_sync_response_matches(self):
+        from asgiref.sync import async_to_sync
+
+        request = RequestFactory().get('/', {'q': 'press', 'page_limit': 2})
+        kwargs = {'app_label': 'tests', 'model_name': 'book', 'field_name': 'publisher_ajax'}
+        self.assertEqual(
+            async_to_sync(views.afetch_items)(request, **kwargs).content,
+            views.fetch_items(request, **kwargs).content)
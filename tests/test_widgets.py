@@ -0,0 +1,129 @@
+import json
+import re
+from unittest import mock
+
+from django import forms
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import re_path
+
+import select2.views
+
+from .models import Author, Book
+from .test_admin import load_fixtures
+
+
+class BookForm(forms.ModelForm):
+
+    class Meta:
+        model = Book
+        fields = [
+            'publisher_ajax', 'us_publisher_ajax', 'authors_ajax',
+            'alive_authors_ajax', 'authors_full_name_ajax']
+
+
+def get_init_selection(html, name):
+    match = re.search(r'<input[^>]* name="%s"[^>]*>' % name, html)
+    attr = re.search(r'data-init-selection="([^"]*)"', match.group(0))
+    if attr is None:
+        return None
+    return json.loads(attr.group(1).replace('&quot;', '"'))
+
+
+# A URLconf that routes only the views that widgets have always needed
+urlpatterns = [
+    re_path(
+        r'^fetch_items/(?P<app_label>[^/]+)/(?P<model_name>[^/]+)/(?P<field_name>[^/]+)/$',
+        select2.views.fetch_items, name='select2_fetch_items'),
+    re_path(
+        r'^init_selection/(?P<app_label>[^/]+)/(?P<model_name>[^/]+)/(?P<field_name>[^/]+)/$',
+        select2.views.init_selection, name='select2_init_selection'),
+]
+
+
+@override_settings(ROOT_URLCONF='tests.urls')
+class TestInitialSelections(TestCase):
+
+    def setUp(self):
+        super(TestInitialSelections, self).setUp()
+        load_fixtures()
+
+    def test_rendered_inline(self):
+        form = BookForm(initial={
+            'publisher_ajax': 2,
+            'us_publisher_ajax': 4,
+            'authors_ajax': [3, 1],
+            'authors_full_name_ajax': [4],
+        })
+        # One query for each target model and queryset
+        with self.assertNumQueries(3):
+            html = str(form)
+        self.assertEqual(
+            get_init_selection(html, 'publisher_ajax'), {'id': 2, 'text': "Penguin Press"})
+        self.assertEqual(
+            get_init_selection(html, 'us_publisher_ajax'),
+            {'id': 4, 'text': "Columbia University Press"})
+        self.assertEqual(get_init_selection(html, 'authors_ajax'), [
+            {'id': 3, 'text': "Thomas Pynchon"},
+            {'id': 1, 'text': "Gilles Deleuze"},
+        ])
+        self.assertEqual(
+            get_init_selection(html, 'authors_full_name_ajax'),
+            [{'id': 4, 'text': "Mark Leyner"}])
+        self.assertIsNone(get_init_selection(html, 'alive_authors_ajax'))
+
+    def test_label_options(self):
+        field = Book._meta.get_field('authors_ajax')
+        with mock.patch.object(field, 'label_fields', ('last_name',)):
+            html = str(BookForm(initial={'authors_ajax': [1], 'authors_full_name_ajax': [1]}))
+        self.assertEqual(
+            get_init_selection(html, 'authors_ajax'), [{'id': 1, 'text': "Deleuze"}])
+        self.assertEqual(
+            get_init_selection(html, 'authors_full_name_ajax'),
+            [{'id': 1, 'text': "Gilles Deleuze"}])
+
+    @override_settings(ROOT_URLCONF='tests.test_widgets', SELECT2_RECENT_CHOICES=5)
+    def test_optional_urls(self):
+        html = str(BookForm(initial={'authors_ajax': [1]}))
+        self.assertIn('data-init-selection-url=', html)
+        self.assertNotIn('data-init-selection-batch-url', html)
+        self.assertNotIn('data-recent-choices-url', html)
+        self.assertEqual(
+            get_init_selection(html, 'authors_ajax'), [{'id': 1, 'text': "Gilles Deleuze"}])
+
+    def test_bound_form(self):
+        form = BookForm(data={'authors_ajax': '4,2', 'alive_authors_ajax': '3'})
+        html = str(form)
+        self.assertEqual(get_init_selection(html, 'authors_ajax'), [
+            {'id': 4, 'text': "Mark Leyner"},
+            {'id': 2, 'text': "Félix Guattari"},
+        ])
+        self.assertEqual(
+            get_init_selection(html, 'alive_authors_ajax'), [{'id': 3, 'text': "Thomas Pynchon"}])
+
+    def test_missing_choice(self):
+        # Deleuze is excluded by limit_choices_to, so the selection is left
+        # to the init_selection view
+        html = str(BookForm(initial={'alive_authors_ajax': [3, 1]}))
+        self.assertIsNone(get_init_selection(html, 'alive_authors_ajax'))
+
+    def test_model_instance(self):
+        book = Book.objects.create(title="Against the Day")
+        book.authors_ajax.add(Author.objects.get(pk=3))
+        html = str(BookForm(instance=book))
+        self.assertEqual(
+            get_init_selection(html, 'authors_ajax'), [{'id': 3, 'text': "Thomas Pynchon"}])
+
+    def test_admin_widget_wrapper(self):
+        request = RequestFactory().get('/')
+        request.user = User(is_superuser=True, is_active=True)
+        book = Book.objects.create(title="Against the Day")
+        book.authors_ajax.add(Author.objects.get(pk=3))
+        model_admin = admin.site._registry[Book]
+        form_cls = model_admin.get_form(request, book, fields=BookForm._meta.fields)
+        html = str(form_cls(instance=book, initial={'publisher_ajax': 2}))
+        self.assertEqual(
+            get_init_selection(html, 'publisher_ajax'), {'id': 2, 'text': "Penguin Press"})
+        self.assertEqual(
+            get_init_selection(html, 'authors_ajax'), [{'id': 3, 'text': "Thomas Pynchon"}])